@@ -0,0 +1,109 @@
+# Compare reading a year of daily raw files with the monthly files of raw_compaction, on synthetic
+# google-analytics/stats and marketo/activity data written to a local folder.
+#
+# Usage : python compaction_benchmark.py [rows per day of stats] [rows per day of activity] [S3 request ms]
+# Planning is the time to list the files and read their footers, scan the time to read one month
+# (filter on the partitions) and one column over the whole year. Local files are much faster to
+# open than S3 objects : the last column estimates the S3 request overhead as files x request ms.
+
+import os
+import sys
+import time
+import random
+import shutil
+import tempfile
+from datetime import date, timedelta
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'src', 'python'))
+
+import pyarrow as pa
+import pyarrow.parquet as pq
+import pyarrow.dataset as ds
+from datalake_paths import partition_key
+from arrow_schemas import activity_schema, conform
+from raw_compaction import sources, prepare_day, row_group_rows
+
+segments = ['Mobile segment - no HQ', 'Desktop segment - no HQ']
+source_mediums = ['google / organic', 'google / cpc', '(direct) / (none)', 'linkedin / social', 'newsletter / email']
+
+def stats_day(dt, nb_rows, rnd):
+    return pa.table({
+        'sampling': pa.array([100.0] * nb_rows),
+        'segment': [segments[i % 2] for i in range(nb_rows)],
+        'date_hour': [dt.replace('-', '') + '%02d' % (i % 24) for i in range(nb_rows)],
+        'source_medium': [rnd.choice(source_mediums) for _ in range(nb_rows)],
+        'sessions': [rnd.randint(0, 500) for _ in range(nb_rows)],
+        'total_session_duration': [rnd.random() * 10000 for _ in range(nb_rows)],
+        'bounces': [rnd.randint(0, 300) for _ in range(nb_rows)],
+    })
+
+def activity_day(dt, nb_rows, rnd):
+    return conform(pa.table({
+        'id': pa.array([rnd.randint(1, 10**9) for _ in range(nb_rows)], pa.int64()),
+        'marketoGUID': pa.array([rnd.randint(1, 10**9) for _ in range(nb_rows)], pa.int64()),
+        'leadId': pa.array([rnd.randint(1, 10**6) for _ in range(nb_rows)], pa.int64()),
+        'activityDate': pa.array([f'{dt}T%02d:%02d:00Z' % (rnd.randint(0, 23), rnd.randint(0, 59)) for _ in range(nb_rows)]).cast(pa.timestamp('s', tz='UTC')),
+        'activityTypeId': pa.array([rnd.choice([2, 12, 22, 34]) for _ in range(nb_rows)], pa.int64()),
+        'campaignId': pa.array([float(rnd.randint(1, 50)) for _ in range(nb_rows)]),
+        'primaryAttributeValueId': pa.array([rnd.randint(1, 1000) for _ in range(nb_rows)], pa.int64()),
+        'primaryAttributeValue': [rnd.choice(['Web form', 'Score', 'Opportunity']) for _ in range(nb_rows)],
+        'attributes': pa.array([[{'name': 'Change Value', 'value': str(rnd.randint(-10, 10))}] for _ in range(nb_rows)], activity_schema.field('attributes').type),
+    }), activity_schema)
+
+def write_year(root, source_name, make_day, nb_rows):
+    # Daily files of a year, and the monthly files compacted from them
+    source = sources[source_name]
+    partitions = {'view_id': '147595912'} if source['partitions'] else {}
+    rnd = random.Random(0)
+    monthly = {}
+    day = date(2021, 1, 1)
+    while day.year == 2021:
+        dt = day.strftime('%Y-%m-%d')
+        table = make_day(dt, nb_rows, rnd)
+        path = os.path.join(root, 'daily', partition_key(source['prefix'], dt, f'{dt}.parquet', **partitions))
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        pq.write_table(table, path, compression=source['compression'], row_group_size=nb_rows)
+        monthly.setdefault(dt[0:7], []).append(prepare_day(table, day.day, source['sort_by']))
+        day += timedelta(days=1)
+
+    for month, tables in monthly.items():
+        folders = [f'{k}={v}' for k, v in partitions.items()] + [f'year={month[0:4]}', f'month={month[5:7]}']
+        path = os.path.join(root, 'monthly', source['monthly_prefix'], *folders, f'{month}.parquet')
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        pq.write_table(pa.concat_tables(tables), path, compression=source['compression'], row_group_size=row_group_rows)
+
+def measure(path, column):
+    start = time.perf_counter()
+    dataset = ds.dataset(path, format='parquet', partitioning='hive')
+    fragments = list(dataset.get_fragments())
+    for fragment in fragments:
+        fragment.ensure_complete_metadata()
+    planning = time.perf_counter() - start
+
+    start = time.perf_counter()
+    month_rows = dataset.to_table(filter=ds.field('month') == 6).num_rows
+    year_column = dataset.to_table(columns=[column]).num_rows
+    scan = time.perf_counter() - start
+
+    size = sum(os.path.getsize(f.path) for f in fragments)
+    return len(fragments), size, planning, scan, month_rows + year_column
+
+if __name__ == '__main__':
+    stats_rows = int(sys.argv[1]) if len(sys.argv) > 1 else 2000
+    activity_rows = int(sys.argv[2]) if len(sys.argv) > 2 else 5000
+    request_ms = float(sys.argv[3]) if len(sys.argv) > 3 else 20
+
+    root = tempfile.mkdtemp()
+    try:
+        print(f"{'source':>24} {'layout':>8} {'files':>6} {'MB':>7} {'planning s':>11} {'scan s':>8} {'S3 requests s':>14}")
+        for source_name, make_day, nb_rows, column in [
+            ('google-analytics-stats', stats_day, stats_rows, 'sessions'),
+            ('marketo-activity', activity_day, activity_rows, 'leadId'),
+        ]:
+            write_year(root, source_name, make_day, nb_rows)
+            source = sources[source_name]
+            for layout, prefix in [('daily', source['prefix']), ('monthly', source['monthly_prefix'])]:
+                files, size, planning, scan, _ = measure(os.path.join(root, layout, prefix), column)
+                print(f"{source_name:>24} {layout:>8} {files:>6} {size / 2**20:>7.1f} {planning:>11.3f} {scan:>8.3f} {files * request_ms / 1000:>14.1f}")
+    finally:
+        shutil.rmtree(root)
@@ -0,0 +1,126 @@
+# Compare the single-pass Arrow decoder of google-analytics-stats with the previous
+# list-comprehension + pandas implementation on a synthetic batchGet report.
+#
+# Usage : python ga_decoder_benchmark.py [nb_rows ...]
+# Each implementation runs in its own process so that peak memory is not shared between runs.
+
+import os
+import sys
+import time
+import random
+import tracemalloc
+import multiprocessing
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'src', 'python'))
+
+stats_metrics = [
+    ('ga:sessions', 'INTEGER'),
+    ('ga:sessionDuration', 'TIME'),
+    ('ga:bounces', 'INTEGER'),
+    ('ga:goal1Completions', 'INTEGER'),
+    ('ga:goal2Completions', 'INTEGER'),
+    ('ga:goal3Completions', 'INTEGER'),
+    ('ga:goal4Completions', 'INTEGER'),
+]
+
+def make_report(nb_rows, seed=0):
+    rnd = random.Random(seed)
+    segments = ['Mobile segment - no HQ', 'Desktop segment - no HQ']
+    sources = ['google / organic', 'google / cpc', '(direct) / (none)', 'linkedin / social', 'newsletter / email']
+    rows = []
+    for i in range(nb_rows):
+        rows.append({
+            'dimensions': [segments[i % 2], '2022010%d%02d' % (1 + i % 9, i % 24), rnd.choice(sources)],
+            'metrics': [{'values': [
+                str(rnd.randint(0, 500)),
+                '%.1f' % (rnd.random() * 10000),
+                str(rnd.randint(0, 300)),
+                str(rnd.randint(0, 20)),
+                str(rnd.randint(0, 20)),
+                str(rnd.randint(0, 20)),
+                str(rnd.randint(0, 20)),
+            ]}],
+        })
+    return {
+        'columnHeader': {
+            'dimensions': ['ga:segment', 'ga:dateHour', 'ga:sourceMedium'],
+            'metricHeader': {'metricHeaderEntries': [{'name': n, 'type': t} for n, t in stats_metrics]},
+        },
+        'data': {'rows': rows, 'rowCount': nb_rows},
+    }
+
+def legacy_decode(report):
+    # Previous implementation of lambda_handler in google-analytics-stats.py
+    import pandas as pd
+    import pyarrow as pa
+
+    raw_data = {'response': {'reports': [report]}}
+    segment = [r['dimensions'][0] for r in raw_data['response']['reports'][0]['data']['rows']]
+    date_hour = [r['dimensions'][1] for r in raw_data['response']['reports'][0]['data']['rows']]
+    sessions = [int(r['metrics'][0]['values'][0]) for r in raw_data['response']['reports'][0]['data']['rows']]
+    total_session_duration = [float(r['metrics'][0]['values'][1]) for r in raw_data['response']['reports'][0]['data']['rows']]
+    bounces = [int(r['metrics'][0]['values'][2]) for r in raw_data['response']['reports'][0]['data']['rows']]
+    goal1Completions = [int(r['metrics'][0]['values'][3]) for r in raw_data['response']['reports'][0]['data']['rows']]
+    goal2Completions = [float(r['metrics'][0]['values'][4]) for r in raw_data['response']['reports'][0]['data']['rows']]
+    goal3Completions = [int(r['metrics'][0]['values'][5]) for r in raw_data['response']['reports'][0]['data']['rows']]
+    goal4Completions = [int(r['metrics'][0]['values'][6]) for r in raw_data['response']['reports'][0]['data']['rows']]
+
+    df = pd.DataFrame({
+        'date_hour': date_hour,
+        'segment': segment,
+        'sessions': sessions,
+        'total_session_duration': total_session_duration,
+        'bounces': bounces,
+        'purchase': goal1Completions,
+        'engaged_users': goal2Completions,
+        'registrations': goal3Completions,
+        'checkout': goal4Completions
+    })
+    return pa.Table.from_pandas(df)
+
+def arrow_decode(report):
+    from ga_decoder import decode_report
+    return decode_report(report)
+
+def run(name, nb_rows, queue):
+    import pyarrow as pa
+
+    decode = legacy_decode if name == 'legacy' else arrow_decode
+    # warm up so that imports are not measured
+    decode(make_report(10))
+    report = make_report(nb_rows)
+    pool = pa.default_memory_pool()
+    arrow_before = pool.bytes_allocated()
+
+    tracemalloc.start()
+    start = time.perf_counter()
+    table = decode(report)
+    elapsed = time.perf_counter() - start
+    _, python_peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+
+    queue.put({
+        'name': name,
+        'rows': table.num_rows,
+        'seconds': elapsed,
+        'python_peak_mb': python_peak / 2**20,
+        'arrow_peak_mb': (pool.max_memory() - arrow_before) / 2**20,
+    })
+
+def measure(name, nb_rows):
+    ctx = multiprocessing.get_context('spawn')
+    queue = ctx.Queue()
+    process = ctx.Process(target=run, args=(name, nb_rows, queue))
+    process.start()
+    result = queue.get()
+    process.join()
+    return result
+
+if __name__ == '__main__':
+    sizes = [int(n) for n in sys.argv[1:]] or [1000, 10000, 100000]
+
+    print(f"{'rows':>8} {'decoder':>8} {'rows/s':>12} {'python peak MB':>15} {'arrow peak MB':>14}")
+    for nb_rows in sizes:
+        for name in ['legacy', 'arrow']:
+            r = measure(name, nb_rows)
+            print(f"{nb_rows:>8} {name:>8} {r['rows'] / r['seconds']:>12,.0f} {r['python_peak_mb']:>15.1f} {r['arrow_peak_mb']:>14.1f}")
@@ -0,0 +1,375 @@
+# Local stand-ins for the AWS services and APIs used by the Lambda functions, so a lambda_handler can
+# run unchanged on a plain Linux box : install() puts them in sys.modules before the handler is
+# loaded (boto3 clients for S3, SSM, Athena, Glue and Lambda, the Google Analytics client, the
+# Marketo client and requests for the export files). Objects are kept in memory.
+#
+# The time spent in the stand-ins (building the API payloads, copying S3 bodies) is added up per
+# service in `timings`, so a benchmark can tell it apart from the time of the pipeline itself.
+
+import io
+import math
+import os
+import sys
+import time
+import types
+import hashlib
+import threading
+import importlib.util
+
+import payloads
+
+src_path = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'src', 'python')
+
+# Size of the generated payloads, set by the benchmark before running a handler
+config = {
+    # rows of a request of the whole day and of the ga_segments segments of the report; requests of
+    # fewer hours or segments get their share of the rows
+    'ga_rows_per_request': 1000,
+    'ga_segments': 1,
+    # with ga_sampling (ex. 0.25), reports of more than ga_unsampled_hours hours x segments are sampled
+    'ga_sampling': None,
+    'ga_unsampled_hours': 24,
+    'activity_rows_per_call': 1000,
+    'leads_rows': 1000,
+    'query_seconds': 0,
+}
+
+timings = {}
+timings_lock = threading.Lock()
+
+def add_time(service, seconds):
+    with timings_lock:
+        timings[service] = timings.get(service, 0) + seconds
+
+def timed(service):
+    def decorator(function):
+        def wrapper(*args, **kwargs):
+            start = time.perf_counter()
+            try:
+                return function(*args, **kwargs)
+            finally:
+                add_time(service, time.perf_counter() - start)
+        return wrapper
+    return decorator
+
+def timed_iter(service, iterator):
+    # Generated pages are built when the handler asks for the next one
+    while True:
+        start = time.perf_counter()
+        try:
+            item = next(iterator)
+        except StopIteration:
+            return
+        finally:
+            add_time(service, time.perf_counter() - start)
+        yield item
+
+try:
+    from botocore.exceptions import ClientError
+except ImportError:
+    class ClientError(Exception):
+        def __init__(self, error_response, operation_name):
+            super().__init__(f"{operation_name} : {error_response.get('Error')}")
+            self.response = error_response
+
+def client_error(code, status, operation):
+    return {'Error': {'Code': code, 'Message': code}, 'ResponseMetadata': {'HTTPStatusCode': status}}, operation
+
+def read_body(body):
+    if isinstance(body, (bytes, bytearray)):
+        return bytes(body)
+    if isinstance(body, str):
+        return body.encode('utf-8')
+    return body.read()
+
+def split_uri(uri):
+    bucket, _, key = uri[len('s3://'):].partition('/')
+    return bucket, key
+
+class Paginator:
+    def __init__(self, s3):
+        self.s3 = s3
+
+    def paginate(self, Bucket, Prefix='', Delimiter=None):
+        keys = sorted(k for b, k in self.s3.objects if b == Bucket and k.startswith(Prefix))
+        if Delimiter:
+            folders, files = [], []
+            for key in keys:
+                rest = key[len(Prefix):]
+                if Delimiter in rest:
+                    folder = Prefix + rest.split(Delimiter)[0] + Delimiter
+                    if not folders or folders[-1] != folder:
+                        folders.append(folder)
+                else:
+                    files.append(key)
+            yield {'CommonPrefixes': [{'Prefix': f} for f in folders], 'Contents': self.s3.contents(Bucket, files)}
+            return
+        for offset in range(0, max(len(keys), 1), 1000):
+            yield {'Contents': self.s3.contents(Bucket, keys[offset:offset + 1000])}
+
+class LocalS3:
+    class exceptions:
+        ClientError = ClientError
+
+        class NoSuchKey(ClientError):
+            pass
+
+    def __init__(self):
+        self.objects = {}
+        self.uploads = {}
+        self.lock = threading.Lock()
+
+    def contents(self, bucket, keys):
+        return [{'Key': k, 'ETag': self.objects[(bucket, k)][1], 'Size': len(self.objects[(bucket, k)][0])} for k in keys]
+
+    def store(self, bucket, key, data):
+        with self.lock:
+            self.objects[(bucket, key)] = (data, '"%s"' % hashlib.md5(data).hexdigest())
+
+    @timed('s3')
+    def put_object(self, Bucket, Key, Body=b'', IfMatch=None, IfNoneMatch=None, **kwargs):
+        data = read_body(Body)
+        with self.lock:
+            # conditional writes : IfMatch an ETag, or IfNoneMatch='*' for a key that must not exist
+            current = self.objects.get((Bucket, Key))
+            if (IfMatch is not None and (current is None or current[1] != IfMatch)) or (IfNoneMatch == '*' and current is not None):
+                raise ClientError(*client_error('PreconditionFailed', 412, 'PutObject'))
+            self.objects[(Bucket, Key)] = (data, '"%s"' % hashlib.md5(data).hexdigest())
+            return {'ETag': self.objects[(Bucket, Key)][1]}
+
+    @timed('s3')
+    def get_object(self, Bucket, Key, IfNoneMatch=None, **kwargs):
+        if (Bucket, Key) not in self.objects:
+            raise self.exceptions.NoSuchKey(*client_error('NoSuchKey', 404, 'GetObject'))
+        data, etag = self.objects[(Bucket, Key)]
+        if IfNoneMatch == etag:
+            raise ClientError(*client_error('304', 304, 'GetObject'))
+        return {'Body': io.BytesIO(data), 'ETag': etag, 'ContentLength': len(data)}
+
+    @timed('s3')
+    def head_object(self, Bucket, Key):
+        if (Bucket, Key) not in self.objects:
+            raise ClientError(*client_error('404', 404, 'HeadObject'))
+        data, etag = self.objects[(Bucket, Key)]
+        return {'ETag': etag, 'ContentLength': len(data)}
+
+    @timed('s3')
+    def copy_object(self, Bucket, Key, CopySource):
+        self.store(Bucket, Key, self.objects[(CopySource['Bucket'], CopySource['Key'])][0])
+
+    @timed('s3')
+    def delete_object(self, Bucket, Key):
+        with self.lock:
+            self.objects.pop((Bucket, Key), None)
+
+    @timed('s3')
+    def delete_objects(self, Bucket, Delete):
+        with self.lock:
+            for o in Delete['Objects']:
+                self.objects.pop((Bucket, o['Key']), None)
+        return {}
+
+    def get_paginator(self, name):
+        return Paginator(self)
+
+    @timed('s3')
+    def create_multipart_upload(self, Bucket, Key):
+        upload_id = f'upload-{len(self.uploads) + 1}'
+        self.uploads[upload_id] = {}
+        return {'UploadId': upload_id}
+
+    @timed('s3')
+    def upload_part(self, Bucket, Key, UploadId, PartNumber, Body):
+        data = read_body(Body)
+        self.uploads[UploadId][PartNumber] = data
+        return {'ETag': '"%s"' % hashlib.md5(data).hexdigest()}
+
+    @timed('s3')
+    def complete_multipart_upload(self, Bucket, Key, UploadId, MultipartUpload):
+        parts = self.uploads.pop(UploadId)
+        self.store(Bucket, Key, b''.join(parts[p['PartNumber']] for p in MultipartUpload['Parts']))
+
+    @timed('s3')
+    def abort_multipart_upload(self, Bucket, Key, UploadId):
+        self.uploads.pop(UploadId, None)
+
+    def size(self, bucket=None, prefix=''):
+        # Bytes stored under prefix, used as the output size of a run
+        return sum(len(data) for (b, k), (data, _) in self.objects.items()
+                   if (bucket is None or b == bucket) and k.startswith(prefix))
+
+class LocalSSM:
+    # Every parameter exists; its value is an empty dict literal (the GA service account key)
+    def __init__(self):
+        self.values = {}
+
+    def get_parameters(self, Names, WithDecryption=False):
+        return {'Parameters': [{'Name': n, 'Value': self.values.get(n, '{}')} for n in Names], 'InvalidParameters': []}
+
+class LocalAthena:
+    # Queries are not run : they succeed after config['query_seconds'] with a one line CSV result
+    def __init__(self, s3):
+        self.s3 = s3
+        self.executions = {}
+
+    @timed('athena')
+    def start_query_execution(self, QueryString, QueryExecutionContext=None, ResultConfiguration=None, **kwargs):
+        execution_id = f'query-{len(self.executions) + 1:06d}'
+        location = ResultConfiguration['OutputLocation'].rstrip('/')
+        self.executions[execution_id] = {'query': QueryString, 'location': location, 'started': time.time()}
+        bucket, key = split_uri(location)
+        self.s3.store(bucket, f'{key}/{execution_id}.csv', b'"value"\n"1"\n')
+        return {'QueryExecutionId': execution_id}
+
+    def execution(self, execution_id):
+        e = self.executions[execution_id]
+        done = time.time() - e['started'] >= config['query_seconds']
+        return {
+            'QueryExecutionId': execution_id,
+            'Query': e['query'],
+            'Status': {'State': 'SUCCEEDED' if done else 'RUNNING'},
+            'Statistics': {'TotalExecutionTimeInMillis': int(config['query_seconds'] * 1000), 'DataScannedInBytes': 10 << 20},
+        }
+
+    @timed('athena')
+    def get_query_execution(self, QueryExecutionId):
+        return {'QueryExecution': self.execution(QueryExecutionId)}
+
+    @timed('athena')
+    def batch_get_query_execution(self, QueryExecutionIds):
+        return {'QueryExecutions': [self.execution(i) for i in QueryExecutionIds], 'UnprocessedQueryExecutionIds': []}
+
+    @timed('athena')
+    def get_query_results(self, QueryExecutionId, MaxResults=None):
+        return {'ResultSet': {'ResultSetMetadata': {'ColumnInfo': [{'Name': 'value', 'Type': 'varchar'}]}, 'Rows': []}}
+
+class LocalGlue:
+    class exceptions:
+        class EntityNotFoundException(Exception):
+            pass
+
+    def __init__(self):
+        self.tables = {}
+
+    def get_table(self, DatabaseName, Name):
+        if Name not in self.tables:
+            raise self.exceptions.EntityNotFoundException(Name)
+        return {'Table': self.tables[Name]}
+
+    def create_table(self, DatabaseName, TableInput):
+        self.tables[TableInput['Name']] = TableInput
+
+    update_table = create_table
+
+class LocalLambda:
+    def __init__(self):
+        self.invocations = []
+
+    def invoke(self, **kwargs):
+        self.invocations.append(kwargs)
+        return {'StatusCode': 202}
+
+class LocalAnalytics:
+    # analytics.reports().batchGet(body=...).execute()
+    def reports(self):
+        return self
+
+    def batchGet(self, body):
+        return types.SimpleNamespace(execute=lambda: self.execute(body))
+
+    def report(self, request):
+        size = len(payloads.request_hours(request)) * max(len(request.get('segments', [])), 1)
+        nb_rows = math.ceil(config['ga_rows_per_request'] * size / 24 / config['ga_segments'])
+        sampled = config['ga_sampling'] is not None and size > config['ga_unsampled_hours']
+        return payloads.ga_report(request, nb_rows, config['ga_sampling'] if sampled else None)
+
+    @timed('google-analytics')
+    def execute(self, body):
+        return {'reports': [self.report(r) for r in body['reportRequests']]}
+
+class LocalMarketo:
+    def __init__(self, munchkin_id, client_id, client_secret, api_limit=None, max_retry_time=None):
+        self.host = f'https://{munchkin_id}.mktorest.com'
+        self.token = None
+        self.valid_until = None
+
+    def authenticate(self):
+        self.token = 'token'
+        self.valid_until = time.time() + 3600
+
+    @timed('marketo')
+    def execute(self, method, **kwargs):
+        if method == 'get_lead_activities_yield':
+            pages = payloads.activity_pages(kwargs['activityTypeIds'][0], kwargs['sinceDatetime'], kwargs['untilDatetime'],
+                                            config['activity_rows_per_call'])
+            return timed_iter('marketo', pages)
+        if method == 'create_leads_export_job':
+            return [{'exportId': 'export-1'}]
+        if method == 'enqueue_leads_export_job':
+            return [{'exportId': kwargs['job_id'], 'status': 'Queued'}]
+        if method == 'get_leads_export_job_status':
+            return [{'exportId': kwargs['job_id'], 'status': 'Completed'}]
+        raise NotImplementedError(method)
+
+class LocalResponse:
+    def __init__(self, data):
+        self.raw = io.BytesIO(data)
+
+    def raise_for_status(self):
+        pass
+
+    def close(self):
+        pass
+
+@timed('marketo')
+def requests_get(url, headers=None, stream=False):
+    # Export file of the Marketo bulk API; the start date of the file is not known here
+    return LocalResponse(payloads.leads_csv(config['leads_rows'], '2022-01-01'))
+
+def module(name, **attributes):
+    m = types.ModuleType(name)
+    m.__dict__.update(attributes)
+    return m
+
+def install(throttling=False):
+    # Replace the clients in sys.modules and return the stand-ins; the token buckets of the API
+    # quotas are disabled unless throttling is True, so the time measured is the pipeline's
+    s3 = LocalS3()
+    clients = {'s3': s3, 'ssm': LocalSSM(), 'athena': LocalAthena(s3), 'glue': LocalGlue(), 'lambda': LocalLambda()}
+
+    sys.modules['boto3'] = module('boto3', client=lambda name, *args, **kwargs: clients[name])
+    if 'botocore' not in sys.modules and importlib.util.find_spec('botocore') is None:
+        sys.modules['botocore'] = module('botocore')
+        sys.modules['botocore.exceptions'] = module('botocore.exceptions', ClientError=ClientError)
+    sys.modules['apiclient'] = module('apiclient')
+    sys.modules['apiclient.discovery'] = module('apiclient.discovery', build=lambda *args, **kwargs: LocalAnalytics())
+    sys.modules['oauth2client'] = module('oauth2client')
+    sys.modules['oauth2client.service_account'] = module('oauth2client.service_account', ServiceAccountCredentials=types.SimpleNamespace(
+        from_json_keyfile_dict=lambda key, scope: None))
+    sys.modules['marketorestpython'] = module('marketorestpython')
+    sys.modules['marketorestpython.client'] = module('marketorestpython.client', MarketoClient=LocalMarketo)
+    sys.modules['requests'] = module('requests', get=requests_get)
+
+    if src_path not in sys.path:
+        sys.path.insert(0, src_path)
+    if not throttling:
+        import throttling as throttling_module
+        throttling_module.TokenBucket.acquire = lambda self: None
+    return clients
+
+class LocalContext:
+    def __init__(self, timeout=900):
+        self.deadline = time.time() + timeout
+        self.invoked_function_arn = 'arn:aws:lambda:eu-west-1:000000000000:function:benchmark'
+
+    def get_remaining_time_in_millis(self):
+        return int((self.deadline - time.time()) * 1000)
+
+def load_handler(filename, **environment):
+    # Load a Lambda function script (ex. google-analytics-stats.py) as packaged, with its environment
+    os.environ.update(environment)
+    os.environ.setdefault('AWS_DEFAULT_REGION', 'eu-west-1')
+    spec = importlib.util.spec_from_file_location('lambda_function', os.path.join(src_path, filename))
+    handler = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(handler)
+    return handler
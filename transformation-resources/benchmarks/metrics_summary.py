@@ -0,0 +1,77 @@
+# Summarize the metrics records printed by the Lambda functions (lambda_metrics.py) : per source,
+# the stages taking the most time, and the p50 / p95 duration of the invocations per day.
+#
+# Usage : python metrics_summary.py <log file> [...]   (standard input without files)
+# The logs can be exported with the AWS CLI, ex.
+#   aws logs tail /aws/lambda/${ProjectName}-${Env}-marketo-activity-parquet --since 7d > activity.log
+# Every line containing a JSON record with an "_aws" key is read, whatever comes before it.
+# Stage times are summed over the threads of an invocation : their share of the duration can be
+# over 100% for the concurrent stages.
+
+import sys
+import json
+import math
+from datetime import datetime, timezone
+
+def read_records(lines):
+    for line in lines:
+        start = line.find('{"_aws"')
+        if start < 0:
+            continue
+        try:
+            yield json.loads(line[start:])
+        except ValueError:
+            continue
+
+def percentile(values, p):
+    # nearest rank
+    values = sorted(values)
+    return values[max(0, math.ceil(p / 100 * len(values)) - 1)]
+
+def summarize(records):
+    by_source = {}
+    for record in records:
+        by_source.setdefault(record['source'], []).append(record)
+
+    for source, records in sorted(by_source.items()):
+        durations = [r['duration_seconds'] for r in records]
+        errors = sum(1 for r in records if r.get('status') != 'ok')
+        print(f"\n{source} : {len(records)} invocations, {errors} errors, duration p50 {percentile(durations, 50):.2f}s "
+              f"p95 {percentile(durations, 95):.2f}s, peak RSS {max(r.get('peak_rss_mb', 0) for r in records):.0f} MB")
+
+        stages = {}
+        for record in records:
+            for name, value in record.items():
+                if name.endswith('_seconds') and name != 'duration_seconds':
+                    stages.setdefault(name[:-len('_seconds')], []).append(value)
+        total = sum(durations)
+        print(f"  {'stage':>18} {'total s':>10} {'share':>7} {'p50 s':>8} {'p95 s':>8}")
+        for name, values in sorted(stages.items(), key=lambda item: -sum(item[1])):
+            print(f"  {name:>18} {sum(values):>10.2f} {sum(values) / total if total else 0:>7.1%} "
+                  f"{percentile(values, 50):>8.3f} {percentile(values, 95):>8.3f}")
+
+        counts = {}
+        for record in records:
+            for name in ('rows', 'output_bytes', 'archive_bytes', 'api_pages', 'retries', 'queries', 'snapshot_changes'):
+                if name in record:
+                    counts[name] = counts.get(name, 0) + record[name]
+        if counts:
+            print('  ' + ', '.join(f'{name} {value:,}' for name, value in counts.items()))
+
+        days = {}
+        for record in records:
+            day = datetime.fromtimestamp(record['_aws']['Timestamp'] / 1000, timezone.utc).strftime('%Y-%m-%d')
+            days.setdefault(day, []).append(record['duration_seconds'])
+        print(f"  {'day':>18} {'runs':>6} {'p50 s':>8} {'p95 s':>8}")
+        for day, values in sorted(days.items()):
+            print(f"  {day:>18} {len(values):>6} {percentile(values, 50):>8.2f} {percentile(values, 95):>8.2f}")
+
+if __name__ == '__main__':
+    if len(sys.argv) > 1:
+        records = []
+        for path in sys.argv[1:]:
+            with open(path) as f:
+                records += list(read_records(f))
+    else:
+        records = list(read_records(sys.stdin))
+    summarize(records)
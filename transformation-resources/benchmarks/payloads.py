@@ -0,0 +1,106 @@
+# Synthetic API payloads for the benchmarks : Google Analytics batchGet reports built from the
+# report requests (dimensions, metrics, segments, pagination and sampling fields), Marketo activity
+# pages and Marketo lead export CSV files. Values are random but reproducible (seeded).
+
+import random
+from datetime import datetime, timedelta
+
+source_mediums = ['google / organic', 'google / cpc', '(direct) / (none)', 'linkedin / social', 'newsletter / email']
+bu_values = ['B2B', 'B2C', 'Industry', None]
+lead_statuses = ['New', 'MQL', 'SQL', 'Recycled', 'Disqualified']
+activity_attributes = ['Change Value', 'Old Value', 'Reason', 'Webpage ID', 'Client IP Address']
+
+def request_hours(request):
+    # Hours of the day read by the request : its ga:hour IN_LIST filter, or the whole day
+    for clause in request.get('dimensionFilterClauses', []):
+        for f in clause['filters']:
+            if f['dimensionName'] == 'ga:hour' and f['operator'] == 'IN_LIST':
+                return f['expressions']
+    return ['%02d' % hour for hour in range(24)]
+
+def dimension_value(name, request, i, rnd):
+    if name == 'ga:segment':
+        segments = [s['dynamicSegment']['name'] for s in request.get('segments', [])] or ['All Users']
+        return segments[i % len(segments)]
+    if name in ('ga:dateHour', 'ga:hour'):
+        hours = request_hours(request)
+        hour = hours[i // 7 % len(hours)]
+        return request['dateRanges'][0]['startDate'].replace('-', '') + hour if name == 'ga:dateHour' else hour
+    if name == 'ga:sourceMedium':
+        return rnd.choice(source_mediums)
+    return f'{name[3:]} {rnd.randint(0, 50)}'
+
+def metric_value(formatting_type, rnd):
+    if formatting_type == 'INTEGER':
+        return str(rnd.randint(0, 500))
+    return '%.1f' % (rnd.random() * 10000)
+
+def ga_report(request, nb_rows, sampling=None, seed=0):
+    # Page of the report of a batchGet request : nb_rows rows in total, pageSize rows per page
+    # from the row offset in pageToken. sampling (ex. 0.25) adds the samplesReadCounts and
+    # samplingSpaceSizes of a sampled report.
+    offset = int(request.get('pageToken', 0))
+    page_rows = min(request.get('pageSize', 1000), nb_rows - offset)
+    rnd = random.Random(f"{seed}-{request['viewId']}-{request.get('filtersExpression')}-{offset}")
+    dimensions = [d['name'] for d in request.get('dimensions', [])]
+    metrics = request['metrics']
+
+    rows = []
+    for i in range(offset, offset + page_rows):
+        rows.append({
+            'dimensions': [dimension_value(name, request, i, rnd) for name in dimensions],
+            'metrics': [{'values': [metric_value(m.get('formattingType', 'INTEGER'), rnd) for m in metrics]}],
+        })
+
+    data = {'rows': rows, 'rowCount': nb_rows}
+    if sampling is not None:
+        space = 1000000
+        data['samplesReadCounts'] = [str(int(space * sampling))]
+        data['samplingSpaceSizes'] = [str(space)]
+    report = {
+        'columnHeader': {
+            'dimensions': dimensions,
+            'metricHeader': {'metricHeaderEntries': [
+                {'name': m['expression'], 'type': m.get('formattingType', 'INTEGER')} for m in metrics]},
+        },
+        'data': data,
+    }
+    if offset + page_rows < nb_rows:
+        report['nextPageToken'] = str(offset + page_rows)
+    return report
+
+def activity_pages(activity_type_id, since, until, nb_rows, page_size=300, seed=0):
+    # Pages of get_lead_activities_yield : nb_rows activities of the type between since and until
+    # (ISO 8601 datetimes ending with Z)
+    rnd = random.Random(f'{seed}-{activity_type_id}-{since}')
+    start = datetime.strptime(since, '%Y-%m-%dT%H:%M:%SZ')
+    seconds = int((datetime.strptime(until, '%Y-%m-%dT%H:%M:%SZ') - start).total_seconds())
+    for offset in range(0, nb_rows, page_size):
+        page = []
+        for i in range(offset, min(offset + page_size, nb_rows)):
+            page.append({
+                'id': rnd.randint(1, 10**9),
+                'marketoGUID': str(rnd.randint(1, 10**9)),
+                'leadId': rnd.randint(1, 10**6),
+                'activityDate': (start + timedelta(seconds=seconds * i // max(nb_rows, 1))).strftime('%Y-%m-%dT%H:%M:%SZ'),
+                'activityTypeId': int(activity_type_id),
+                'campaignId': rnd.randint(1, 500),
+                'primaryAttributeValueId': rnd.randint(1, 1000),
+                'primaryAttributeValue': rnd.choice(['Web form', 'Score', 'Opportunity']),
+                'attributes': [{'name': name, 'value': rnd.choice([rnd.randint(-10, 10), 'text value', True])}
+                               for name in rnd.sample(activity_attributes, rnd.randint(0, 3))],
+            })
+        yield page
+
+def leads_csv(nb_rows, start_date, seed=0):
+    # Export file of create_leads_export_job, with the fields of marketo-api-leads.py
+    rnd = random.Random(seed)
+    lines = ['id,BU__c,webformRequestMostrecent,leadStatus,SFDCType,createdAt,updatedAt']
+    for i in range(nb_rows):
+        bu = rnd.choice(bu_values)
+        webform = rnd.choice(['', f'"Request, form {rnd.randint(1, 40)}"'])
+        lines.append(','.join([
+            str(i + 1), bu or '', webform, rnd.choice(lead_statuses), rnd.choice(['Lead', 'Contact', '']),
+            f'2019-0{rnd.randint(1, 9)}-1{rnd.randint(0, 9)}T10:00:00Z', f'{start_date}T{rnd.randint(10, 23)}:00:00Z',
+        ]))
+    return ('\n'.join(lines) + '\n').encode('utf-8')
@@ -0,0 +1,145 @@
+# Run the Lambda handlers end to end on synthetic payloads, with local stand-ins for GA, Marketo,
+# SSM, S3 and Athena (local_aws.py, payloads.py), so a change of the ingestion or SQL code can be
+# measured on a plain Linux box before and after it.
+#
+# Usage : python pipeline_benchmark.py [scenario,...] [rows ...]
+# Scenarios : ga-stats, ga-stats-sampled, ga-forms, marketo-activity, marketo-leads, dashboard-sql (all by default);
+# rows default to 1000 10000 100000 1000000. For dashboard-sql the rows are the upstream files of
+# the scheduled refresh (listed and fingerprinted), the queries themselves are not run.
+#
+# Each scenario and size runs in a new process. The API and S3 columns are the time spent in the
+# stand-ins (generating payloads, copying bodies), summed over the threads of the handler : they
+# can be larger than the wall time. CPU is the CPU time of the process during the handler, peak
+# RSS the maximum resident memory of the process and output the bytes written to S3. The wall time
+# includes the imports of a cold start and, for dashboard-sql, the polling delays of the queries.
+
+import os
+import sys
+import time
+import math
+import json
+import resource
+import contextlib
+import multiprocessing
+from datetime import datetime, timedelta
+
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+
+import local_aws
+
+query_date = '2022-03-10'
+raw_bucket = 'datalake-dev-raw'
+std_bucket = 'datalake-dev-standardized'
+credentials = {'MUNCHKIN_ID': '/marketo/munchkin_id', 'CLIENT_ID': '/marketo/client_id', 'CLIENT_SECRET': '/marketo/client_secret'}
+
+def next_day(dt):
+    return (datetime.strptime(dt, '%Y-%m-%d') + timedelta(days=1)).strftime('%Y-%m-%d')
+
+def ga(report_name, sampling=None, unsampled_hours=24):
+    # sampled : reports of more than unsampled_hours hours x segments are sampled and get split
+    def setup(s3, nb_rows):
+        from ga_specs import report_requests
+        requests = report_requests(report_name, '1', query_date)
+        local_aws.config['ga_rows_per_request'] = math.ceil(nb_rows / len(requests))
+        local_aws.config['ga_segments'] = max(len(requests[0][1].get('segments', [])), 1)
+        local_aws.config['ga_sampling'] = sampling
+        local_aws.config['ga_unsampled_hours'] = unsampled_hours
+        handler = local_aws.load_handler(f'google-analytics-{report_name}.py', GCP_SERVICE_ACCOUNT_KEY='/ga/service_account_key', OUTPUT_BUCKET=raw_bucket)
+        return handler, {'view_id': '1', 'date': query_date}
+    return setup
+
+def marketo_activity(s3, nb_rows):
+    from marketo_activity import slice_hours
+    local_aws.config['activity_rows_per_call'] = math.ceil(nb_rows / (24 // slice_hours))
+    handler = local_aws.load_handler('marketo-api-activity.py', **credentials)
+    return handler, {'start_date': query_date, 'end_date_exclusive': next_day(query_date), 'list_activity_ids': [2]}
+
+def marketo_leads(s3, nb_rows):
+    local_aws.config['leads_rows'] = nb_rows
+    handler = local_aws.load_handler('marketo-api-leads.py', **credentials)
+    return handler, {'start_date': query_date, 'end_date_exclusive': next_day(query_date)}
+
+def dashboard_sql(s3, nb_rows):
+    # SQL files using every placeholder, and nb_rows activity and lead change files spread over the
+    # days before the date
+    sql_bucket = 'datalake-dev-lambda-resources'
+    s3.store(sql_bucket, 'sql/bu_sql_config.json', json.dumps({'B2B': {'BU_FILTER': "'B2B'"}, 'B2C': {'BU_FILTER': "'B2C'"}}).encode('utf-8'))
+    for filename in ['bu_stats_daily.sql', 'bu_stats_monthly.sql']:
+        s3.store(sql_bucket, f'sql/{filename}', b'SELECT * FROM activity WHERE PARTITION_FILTER AND bu = BU_FILTER AND date = QUERY_DATE AND QUERY_MONTH > QUERY_YTD AND id IN (SELECT id FROM leads LEADS_LIMIT)')
+    for filename in ['global_stats_daily.sql', 'global_stats_monthly.sql']:
+        s3.store(sql_bucket, f'sql/{filename}', b'SELECT * FROM activity WHERE PARTITION_FILTER AND date = QUERY_DATE AND QUERY_MONTH > QUERY_YTD AND id IN (SELECT id FROM leads LEADS_LIMIT)')
+    for filename in ['pbi_combine.sql', 'pbi_combine_daily.sql']:
+        s3.store(sql_bucket, f'sql/{filename}', b'SELECT * FROM b2b_stats UNION ALL SELECT * FROM b2c_stats WHERE date = QUERY_DATE')
+
+    days = [(datetime.strptime(query_date, '%Y-%m-%d') - timedelta(days=n)).strftime('%Y-%m-%d') for n in range(7)]
+    for i in range(nb_rows):
+        dt = days[i % len(days)]
+        bucket, folder = (std_bucket, 'marketo/leads-changes') if i % 2 else (raw_bucket, 'marketo/activity')
+        s3.store(bucket, f'{folder}/year={dt[0:4]}/month={dt[5:7]}/day={dt[8:10]}/part-{i:07d}.parquet', b'')
+
+    handler = local_aws.load_handler('dashboard-sql.py')
+    with open(os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'datamart-stack.yml')) as stack:
+        scheduled = next(line for line in stack if line.strip().startswith("Input: '{\"jobs\""))
+    event = json.loads(scheduled.strip()[len("Input: '"):-1])
+    event.update({'query_date': query_date})
+    for job in event['jobs']:
+        job['start_date'] = days[-1]
+    return handler, event
+
+scenarios = {
+    'ga-stats': ga('stats'),
+    'ga-stats-sampled': ga('stats', sampling=0.25, unsampled_hours=6),
+    'ga-forms': ga('forms'),
+    'marketo-activity': marketo_activity,
+    'marketo-leads': marketo_leads,
+    'dashboard-sql': dashboard_sql,
+}
+
+def cpu_seconds():
+    usage = resource.getrusage(resource.RUSAGE_SELF)
+    return usage.ru_utime + usage.ru_stime
+
+def run(scenario, nb_rows, queue):
+    s3 = local_aws.install()['s3']
+    handler, event = scenarios[scenario](s3, nb_rows)
+    size_before = s3.size()
+    local_aws.timings.clear()
+
+    cpu_before = cpu_seconds()
+    start = time.perf_counter()
+    with open(os.devnull, 'w') as devnull, contextlib.redirect_stdout(devnull):
+        handler.lambda_handler(event, local_aws.LocalContext())
+    wall = time.perf_counter() - start
+
+    timings = local_aws.timings
+    queue.put({
+        'wall': wall,
+        'api': timings.get('google-analytics', 0) + timings.get('marketo', 0),
+        's3': timings.get('s3', 0) + timings.get('athena', 0),
+        'cpu': cpu_seconds() - cpu_before,
+        'peak_rss_mb': resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024,
+        'output_mb': (s3.size() - size_before) / 2**20,
+    })
+
+def measure(scenario, nb_rows):
+    ctx = multiprocessing.get_context('spawn')
+    queue = ctx.Queue()
+    process = ctx.Process(target=run, args=(scenario, nb_rows, queue))
+    process.start()
+    result = queue.get()
+    process.join()
+    return result
+
+if __name__ == '__main__':
+    arguments = sys.argv[1:]
+    names = list(scenarios)
+    if arguments and not arguments[0].isdigit():
+        names = arguments.pop(0).split(',')
+    sizes = [int(n) for n in arguments] or [1000, 10000, 100000, 1000000]
+
+    print(f"{'scenario':>17} {'rows':>8} {'wall s':>8} {'API s':>7} {'S3 s':>7} {'CPU s':>7} {'rows/s':>11} {'peak RSS MB':>12} {'output MB':>10}")
+    for name in names:
+        for nb_rows in sizes:
+            r = measure(name, nb_rows)
+            print(f"{name:>17} {nb_rows:>8} {r['wall']:>8.2f} {r['api']:>7.2f} {r['s3']:>7.2f} {r['cpu']:>7.2f} "
+                  f"{nb_rows / r['wall']:>11,.0f} {r['peak_rss_mb']:>12.0f} {r['output_mb']:>10.2f}")
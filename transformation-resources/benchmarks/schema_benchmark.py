@@ -0,0 +1,119 @@
+# Size of the raw files with the column types of arrow_schemas compared with the types used before
+# (timestamps as the strings sent by the APIs, plain strings instead of dictionaries, 64 bit
+# integers and a float campaignId), on a sample of synthetic Google Analytics stats, Marketo
+# activities and Marketo leads (payloads.py).
+#
+# Usage : python schema_benchmark.py [rows ...]   (100000 by default)
+# The files are written in memory by the parquet sink, with the compression and encodings of their
+# Lambda function. "Query" is the compressed size of the columns read by a typical dashboard query,
+# an estimate of the bytes scanned by Athena.
+
+import io
+import os
+import sys
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'src', 'python'))
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+
+import pyarrow as pa
+import pyarrow.compute as pc
+import pyarrow.csv as pv
+import pyarrow.parquet as pq
+import payloads
+from local_aws import LocalS3
+from arrow_schemas import schema, conform, delta_encoding
+from s3_parquet_sink import S3ParquetSink
+from ga_decoder import decode_report_batch
+from ga_specs import report_requests, report_columns
+from marketo_activity import activities_to_batch
+
+query_date = '2022-03-10'
+row_group_rows = 50000
+
+def stats_sample(nb_rows):
+    requests = report_requests('stats', '1', query_date)
+    batches = []
+    for _, request in requests:
+        request = dict(request, pageSize=nb_rows)
+        report = payloads.ga_report(request, nb_rows // len(requests))
+        batches.append(decode_report_batch(report, report_columns('stats'), {'sampling': 100.0}))
+    return conform(pa.Table.from_batches(batches), schema('google-analytics-stats'))
+
+def activity_sample(nb_rows):
+    type_ids = [2, 12, 22, 34]
+    since, until = f'{query_date}T00:00:00Z', f'{query_date}T23:59:59Z'
+    batches = [activities_to_batch(page)
+               for type_id in type_ids
+               for page in payloads.activity_pages(type_id, since, until, nb_rows // len(type_ids))]
+    return pa.Table.from_batches(batches).sort_by('activityDate')
+
+def leads_sample(nb_rows):
+    leads_schema = schema('marketo-leads')
+    return pv.read_csv(
+        io.BytesIO(payloads.leads_csv(nb_rows, query_date)),
+        convert_options=pv.ConvertOptions(
+            column_types={field.name: field.type for field in leads_schema},
+            null_values=['', 'null'],
+            strings_can_be_null=True,
+        ))
+
+datasets = {
+    # name : (sample, compression, column encodings, format of the timestamps sent by the API, typical query columns)
+    'ga-stats': (stats_sample, 'snappy', None, '%Y%m%d%H', ['date_hour', 'segment', 'source_medium', 'sessions']),
+    'marketo-activity': (activity_sample, 'zstd', delta_encoding('activityDate'), '%Y-%m-%dT%H:%M:%SZ', ['activityDate', 'activityTypeId', 'leadId', 'campaignId']),
+    'marketo-leads': (leads_sample, 'snappy', None, '%Y-%m-%dT%H:%M:%SZ', ['id', 'BU__c', 'leadStatus', 'updatedAt']),
+}
+
+def legacy_column(name, column, timestamp_format):
+    # The column as it was stored before arrow_schemas
+    type = column.type
+    if pa.types.is_dictionary(type):
+        column, type = column.cast(type.value_type), type.value_type
+    if pa.types.is_timestamp(type):
+        return pc.strftime(column, format=timestamp_format)
+    if name == 'campaignId':
+        return column.cast(pa.float64())
+    if pa.types.is_integer(type):
+        return column.cast(pa.int64())
+    return column
+
+def legacy_table(table, timestamp_format):
+    return pa.table({name: legacy_column(name, table[name], timestamp_format) for name in table.column_names})
+
+def column_sizes(table, compression, column_encoding=None):
+    # Compressed bytes of each column of the parquet file of the table, and the file size
+    s3 = LocalS3()
+    sink = S3ParquetSink(s3, 'raw', 'sample.parquet', compression=compression, row_group_rows=row_group_rows,
+                         column_encoding=column_encoding)
+    sink.write(table)
+    sink.close()
+    data = s3.objects[('raw', 'sample.parquet')][0]
+    metadata = pq.read_metadata(io.BytesIO(data))
+    sizes = {}
+    for i in range(metadata.num_row_groups):
+        row_group = metadata.row_group(i)
+        for j in range(row_group.num_columns):
+            column = row_group.column(j)
+            name = column.path_in_schema.split('.')[0]
+            sizes[name] = sizes.get(name, 0) + column.total_compressed_size
+    return sizes, len(data)
+
+def compare(name, nb_rows):
+    sample, compression, column_encoding, timestamp_format, query_columns = datasets[name]
+    table = sample(nb_rows)
+    before, before_bytes = column_sizes(legacy_table(table, timestamp_format), compression)
+    after, after_bytes = column_sizes(table, compression, column_encoding)
+    query_before = sum(before[c] for c in query_columns)
+    query_after = sum(after[c] for c in query_columns)
+    print(f"{name:>17} {table.num_rows:>8} {before_bytes / 2**20:>10.2f} {after_bytes / 2**20:>9.2f} {after_bytes / before_bytes - 1:>8.1%} "
+          f"{query_before / 2**10:>11.1f} {query_after / 2**10:>10.1f} {query_after / query_before - 1:>8.1%}")
+    changed = [c for c in table.column_names if before[c] != after[c]]
+    for column in changed:
+        print(f"{'':>17} {column:>30} {before[column]:>10,} -> {after[column]:>10,} bytes")
+
+if __name__ == '__main__':
+    sizes = [int(n) for n in sys.argv[1:]] or [100000]
+    print(f"{'dataset':>17} {'rows':>8} {'before MB':>10} {'after MB':>9} {'change':>8} {'query KB':>11} {'after KB':>10} {'change':>8}")
+    for nb_rows in sizes:
+        for name in datasets:
+            compare(name, nb_rows)
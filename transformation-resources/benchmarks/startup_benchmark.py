@@ -0,0 +1,65 @@
+# Measure cold-start and warm-start latency of a deployed Lambda function.
+#
+# Usage : python startup_benchmark.py <function name> '<event json>' [nb_runs]
+# Run it once on the previous deployment and once on the new one to compare them.
+#
+# Each run forces a cold start by changing an environment variable of the function (Lambda then
+# creates new execution environments), invokes it once (cold) and once more (warm), and reads the
+# Init Duration and Duration of the REPORT line returned in the invocation logs.
+
+import re
+import sys
+import json
+import time
+import base64
+import statistics
+import boto3
+
+lambda_client = boto3.client('lambda')
+
+def force_cold_start(function_name):
+    configuration = lambda_client.get_function_configuration(FunctionName=function_name)
+    variables = configuration.get('Environment', {}).get('Variables', {})
+    variables['BENCHMARK_COLD_START'] = str(time.time())
+    lambda_client.update_function_configuration(FunctionName=function_name, Environment={'Variables': variables})
+    lambda_client.get_waiter('function_updated').wait(FunctionName=function_name)
+
+def invoke(function_name, event):
+    response = lambda_client.invoke(
+        FunctionName=function_name,
+        Payload=json.dumps(event).encode('utf-8'),
+        LogType='Tail')
+    logs = base64.b64decode(response['LogResult']).decode('utf-8')
+    report = re.search(r'REPORT .*', logs).group(0)
+
+    init = re.search(r'Init Duration: ([\d.]+) ms', report)
+    return {
+        'init_ms': float(init.group(1)) if init else 0.0,
+        'duration_ms': float(re.search(r'\tDuration: ([\d.]+) ms', report).group(1)),
+        'max_memory_mb': int(re.search(r'Max Memory Used: (\d+) MB', report).group(1)),
+        'error': response.get('FunctionError'),
+    }
+
+def summary(name, runs):
+    totals = [r['init_ms'] + r['duration_ms'] for r in runs]
+    print(f"{name:>5} : median {statistics.median(totals):8.0f} ms "
+          f"(init {statistics.median(r['init_ms'] for r in runs):6.0f} ms, "
+          f"handler {statistics.median(r['duration_ms'] for r in runs):8.0f} ms, "
+          f"max memory {max(r['max_memory_mb'] for r in runs)} MB)")
+
+if __name__ == '__main__':
+    function_name = sys.argv[1]
+    event = json.loads(sys.argv[2])
+    nb_runs = int(sys.argv[3]) if len(sys.argv) > 3 else 3
+
+    cold, warm = [], []
+    for i in range(nb_runs):
+        force_cold_start(function_name)
+        cold.append(invoke(function_name, event))
+        warm.append(invoke(function_name, event))
+        for r in (cold[-1], warm[-1]):
+            if r['error']:
+                print(f"Run {i} returned an error : {r['error']}")
+
+    summary('cold', cold)
+    summary('warm', warm)
@@ -0,0 +1,121 @@
+import pyarrow as pa
+import pyarrow.compute as pc
+
+# The writers use APIs of pyarrow 17 (ParquetWriter.add_key_value_metadata, column encodings) :
+# fail on import instead of in the middle of a file with an older Lambda layer
+min_pyarrow_version = (17, 0)
+if tuple(int(n) for n in pa.__version__.split('.')[:2]) < min_pyarrow_version:
+    raise ImportError(f"pyarrow {pa.__version__} is too old, the Lambda layer must provide pyarrow 17 or later")
+
+# Arrow types of the files written by the ingestion functions, in one place so every writer stores
+# a column the same way :
+#   - timestamps are parsed once, when the API response is decoded (Marketo dates are UTC, Google
+#     Analytics hours are in the time zone of the view)
+#   - low cardinality strings (and the activity type ids) are dictionary encoded
+#   - integers use the narrowest type holding their values, ids keep 64 bits as they only grow
+# The parquet sink conforms every page to the schema of its file with vectorized casts : a value
+# that does not fit its type (ex. an integer over the int32 range) fails the write of the file
+# instead of being stored truncated.
+
+utc_timestamp = pa.timestamp('s', tz='UTC')
+local_timestamp = pa.timestamp('s')
+category = pa.dictionary(pa.int32(), pa.string())
+
+# Google Analytics Reporting API v4 metric types
+ga_metric_types = {
+    'INTEGER': pa.int32(),
+    'FLOAT': pa.float64(),
+    'CURRENCY': pa.float64(),
+    'PERCENT': pa.float64(),
+    'TIME': pa.float64(),
+}
+
+# Google Analytics dimensions that are not stored as plain strings, and the format of the dates
+ga_dimension_types = {
+    'ga:dateHour': local_timestamp,
+    'ga:date': local_timestamp,
+    'ga:segment': category,
+    'ga:sourceMedium': category,
+    'ga:source': category,
+    'ga:medium': category,
+    'ga:deviceCategory': category,
+    'ga:country': category,
+}
+ga_timestamp_formats = {
+    'ga:dateHour': '%Y%m%d%H',
+    'ga:date': '%Y%m%d',
+}
+
+def ga_dimension_type(name):
+    return ga_dimension_types.get(name, pa.string())
+
+attribute_type = pa.struct([pa.field('name', pa.string()), pa.field('value', pa.string())])
+
+activity_schema = pa.schema([
+    pa.field('id', pa.int64()),
+    pa.field('marketoGUID', pa.int64()),
+    pa.field('leadId', pa.int64()),
+    pa.field('activityDate', utc_timestamp),
+    pa.field('activityTypeId', pa.dictionary(pa.int32(), pa.int32())),
+    pa.field('campaignId', pa.int32()),
+    pa.field('primaryAttributeValueId', pa.int32()),
+    pa.field('primaryAttributeValue', pa.string()),
+    pa.field('attributes', pa.list_(attribute_type)),
+])
+
+leads_schema = pa.schema([
+    pa.field('id', pa.int64()),
+    pa.field('BU__c', category),
+    pa.field('webformRequestMostrecent', pa.string()),
+    pa.field('leadStatus', category),
+    pa.field('SFDCType', category),
+    pa.field('createdAt', utc_timestamp),
+    pa.field('updatedAt', utc_timestamp),
+])
+
+schemas = {
+    'marketo-activity': activity_schema,
+    'marketo-leads': leads_schema,
+}
+
+def schema(source):
+    # Schema of the files of a source, named like its Athena table (ex. marketo-leads)
+    if source.startswith('google-analytics-'):
+        # the Google Analytics columns depend on the report definitions
+        from ga_specs import output_schema
+        return output_schema(source[len('google-analytics-'):])
+    return schemas[source]
+
+# Files sorted on a timestamp column store it delta encoded : consecutive values differ by a few
+# seconds and take a few bits each, where a dictionary page stores every distinct value
+def delta_encoding(*names):
+    return {name: 'DELTA_BINARY_PACKED' for name in names}
+
+def parse_strings(array, type, timestamp_format=None):
+    # Strings of an API response as type : timestamps with their format, other types by a cast
+    if pa.types.is_timestamp(type) and timestamp_format:
+        return pc.strptime(array, format=timestamp_format, unit=type.unit).cast(type)
+    return cast_column(array, type)
+
+def cast_column(column, type):
+    if column.type == type:
+        return column
+    if pa.types.is_dictionary(type) and not pa.types.is_dictionary(column.type):
+        # Arrow only casts strings to dictionaries : other values are cast and encoded
+        return column.cast(type.value_type).dictionary_encode().cast(type)
+    return column.cast(type)
+
+def conform(page, schema):
+    # Table of the columns of schema, cast column by column (safe casts : out of range or
+    # unparsable values raise a ValueError naming the column)
+    if page.schema.equals(schema):
+        return page
+    columns = []
+    for field in schema:
+        if field.name not in page.column_names:
+            raise ValueError(f"Column {field.name} is missing")
+        try:
+            columns.append(cast_column(page[field.name], field.type))
+        except (pa.ArrowInvalid, pa.ArrowNotImplementedError) as e:
+            raise ValueError(f"Column {field.name} can not be stored as {field.type} : {e}") from e
+    return pa.Table.from_arrays(columns, schema=schema)
@@ -0,0 +1,155 @@
+import time
+from lambda_metrics import stage
+
+# Runs a set of Athena queries with dependencies : independent queries run concurrently and a
+# query starts as soon as all the queries it depends on have succeeded.
+
+# Poll delays in seconds : the delay grows while no query changes state and is reset when one does
+min_poll_delay = 1
+max_poll_delay = 10
+
+# batch_get_query_execution accepts at most 50 ids per call
+max_ids_per_call = 50
+
+terminal_states = ('SUCCEEDED', 'FAILED', 'CANCELLED')
+
+def check_jobs(jobs):
+    names = [job['name'] for job in jobs]
+    if len(names) != len(set(names)):
+        raise ValueError(f"Duplicate job names in {names}")
+    for job in jobs:
+        for dependency in job.get('depends_on', []):
+            if dependency not in names:
+                raise ValueError(f"Job {job['name']} depends on unknown job {dependency}")
+
+    # a dependency cycle would leave jobs waiting forever
+    done = set()
+    remaining = list(jobs)
+    while remaining:
+        ready = [job for job in remaining if set(job.get('depends_on', [])) <= done]
+        if not ready:
+            raise ValueError(f"Dependency cycle between {[job['name'] for job in remaining]}")
+        done.update(job['name'] for job in ready)
+        remaining = [job for job in remaining if job['name'] not in done]
+
+def poll_executions(athena, execution_ids):
+    # QueryExecution of every id, with batched calls
+    executions = {}
+    for offset in range(0, len(execution_ids), max_ids_per_call):
+        response = athena.batch_get_query_execution(QueryExecutionIds=execution_ids[offset:offset + max_ids_per_call])
+        for execution in response['QueryExecutions']:
+            executions[execution['QueryExecutionId']] = execution
+    return executions
+
+def job_result(execution):
+    statistics = execution.get('Statistics', {})
+    status = execution['Status']
+    return {
+        'state': status['State'],
+        'execution_id': execution['QueryExecutionId'],
+        'runtime_ms': statistics.get('TotalExecutionTimeInMillis'),
+        'bytes_scanned': statistics.get('DataScannedInBytes'),
+        'reason': status.get('StateChangeReason'),
+    }
+
+def combined_result(executions):
+    # Result of a job that started several queries (ex. one per date) : it succeeds when all of them did
+    states = [result['state'] for result in executions.values()]
+    failed = [state for state in states if state in ('FAILED', 'CANCELLED')]
+    return {
+        'state': failed[0] if failed else 'SUCCEEDED',
+        'runtime_ms': sum(result['runtime_ms'] or 0 for result in executions.values()),
+        'bytes_scanned': sum(result['bytes_scanned'] or 0 for result in executions.values()),
+        'executions': executions,
+    }
+
+def run_jobs(athena, jobs, start_query, context=None, margin=30, on_done=None):
+    # jobs : [{'name': ..., 'depends_on': [names], ...}]; start_query(job) starts the query of a job
+    # and returns its execution id, or a list of ids when the job runs several queries; a result
+    # (job_result) can be returned instead of an id for a query that does not need to run.
+    # Returns {name: {'state', 'execution_id', 'runtime_ms', 'bytes_scanned', 'reason'}}, with the
+    # totals and the result of every query in 'executions' for jobs of several queries; jobs whose
+    # dependencies failed are SKIPPED, and jobs not started or still running when the Lambda
+    # timeout is close are returned as PENDING or RUNNING. on_done(job, result) is called when the
+    # queries of a job succeeded, before the jobs depending on it start; the job fails if it raises.
+    check_jobs(jobs)
+    jobs_by_name = {job['name']: job for job in jobs}
+    results = {job['name']: {'state': 'PENDING'} for job in jobs}
+    running = {}
+    delay = min_poll_delay
+
+    def finish(name, result):
+        if on_done is not None and result['state'] == 'SUCCEEDED':
+            try:
+                on_done(jobs_by_name[name], result)
+            except Exception as e:
+                result = dict(result, state='FAILED', reason=str(e))
+        results[name] = result
+
+    def time_left():
+        return context.get_remaining_time_in_millis() / 1000 if context is not None else float('inf')
+
+    while True:
+        changed = False
+        for job in jobs:
+            if results[job['name']]['state'] != 'PENDING':
+                continue
+            states = [results[d]['state'] for d in job.get('depends_on', [])]
+            if any(state in ('FAILED', 'CANCELLED', 'SKIPPED') for state in states):
+                results[job['name']] = {'state': 'SKIPPED', 'reason': 'a dependency did not succeed'}
+                changed = True
+            elif all(state == 'SUCCEEDED' for state in states):
+                try:
+                    execution_ids = start_query(job)
+                except Exception as e:
+                    results[job['name']] = {'state': 'FAILED', 'reason': str(e)}
+                else:
+                    # results returned instead of ids are finished already (ex. reused results)
+                    if isinstance(execution_ids, dict):
+                        finish(job['name'], execution_ids)
+                        execution_ids = []
+                    elif not isinstance(execution_ids, list):
+                        results[job['name']] = {'state': 'RUNNING', 'execution_id': execution_ids}
+                        execution_ids = [execution_ids]
+                    else:
+                        executions = {}
+                        for item in execution_ids:
+                            if isinstance(item, dict):
+                                executions[item['execution_id']] = item
+                            else:
+                                executions[item] = {'state': 'RUNNING'}
+                        execution_ids = [item for item in execution_ids if not isinstance(item, dict)]
+                        if execution_ids:
+                            results[job['name']] = {'state': 'RUNNING', 'executions': executions}
+                        else:
+                            # nothing to run
+                            finish(job['name'], combined_result(executions))
+                    running.update((execution_id, job['name']) for execution_id in execution_ids)
+                changed = True
+
+        if changed:
+            # started or skipped jobs can unblock other jobs without waiting for a poll
+            continue
+        if not running:
+            return results
+        if time_left() - delay < margin:
+            print(f"Lambda timeout is close, {len(running)} queries still running")
+            return results
+
+        with stage('athena_wait'):
+            time.sleep(delay)
+            polled = poll_executions(athena, list(running))
+        for execution_id, execution in polled.items():
+            if execution['Status']['State'] in terminal_states:
+                name = running.pop(execution_id)
+                changed = True
+                if 'executions' in results[name]:
+                    executions = results[name]['executions']
+                    executions[execution_id] = job_result(execution)
+                    if any(result['state'] == 'RUNNING' for result in executions.values()):
+                        continue
+                    finish(name, combined_result(executions))
+                else:
+                    finish(name, job_result(execution))
+                print(f"{name} : {results[name]}")
+        delay = min_poll_delay if changed else min(delay * 2, max_poll_delay)
@@ -1,77 +1,140 @@
 import json
-import time
 import boto3
 from datetime import datetime, timedelta
-import re
+from lambda_runtime import get_cached_object
+from lambda_metrics import instrumented, stage, count
+from sql_templates import Template
+from athena_orchestrator import run_jobs
+from datamart_refresh import load_watermark, save_watermark, plan_refresh, commit_refresh, fingerprint
+from result_cache import ResultCache, cache_key
+from s3_bulk_delete import delete_prefix
+from versioned_output import new_version, version_prefix, table_name, result_columns, delete_result_metadata, switch_table, delete_old_versions
 
 database = 'datalake_dev_database'
 output_bucket = 'datalake-dev-landing'
+raw_bucket = 'datalake-dev-raw'
+std_bucket = 'datalake-dev-standardized'
+sql_bucket = 'datalake-dev-lambda-resources'
+
+# Placeholders of the marketo queries; the keys of the BU config are placeholders too
+date_placeholders = ('LEADS_LIMIT', 'LEADS_AS_OF', 'QUERY_DATE', 'QUERY_MONTH', 'QUERY_YTD', 'PARTITION_FILTER')
+
+# Input folders of each SQL file, fingerprinted for the incremental refresh and the reuse of
+# results : {year}, {month}, {day} and {date} are filled with the date of the query, and the files
+# of date partitions after it are left out. Jobs can give their own list in "upstream".
+# The leads as of a date only change with the change log files up to the date : every export file
+# has its change log in the same partition, and the snapshot files, rewritten by every merge, are
+# left out (the raw export files also expire after 30 days)
+leads_upstream = [(std_bucket, 'marketo/leads-changes/')]
+daily_upstream = [
+    (raw_bucket, 'marketo/activity/year={year}/month={month}/day={day}/'),
+    (std_bucket, 'marketo/activity-monthly/year={year}/month={month}/'),
+] + leads_upstream
+monthly_upstream = [
+    (raw_bucket, 'marketo/activity/year={year}/month={month}/'),
+    (std_bucket, 'marketo/activity-monthly/year={year}/month={month}/'),
+] + leads_upstream
+upstreams = {
+    'bu_stats_daily.sql': daily_upstream,
+    'global_stats_daily.sql': daily_upstream,
+    'bu_stats_monthly.sql': monthly_upstream,
+    'global_stats_monthly.sql': monthly_upstream,
+    'pbi_combine_daily.sql': [
+        (output_bucket, 'dashboard/marketo/b2b_stats/{date}/'),
+        (output_bucket, 'dashboard/marketo/b2c_stats/{date}/'),
+        (output_bucket, 'dashboard/marketo/global_stats/{date}/'),
+    ],
+    'pbi_combine.sql': [
+        (output_bucket, 'dashboard/marketo/b2b_stats/'),
+        (output_bucket, 'dashboard/marketo/b2c_stats/'),
+        (output_bucket, 'dashboard/marketo/global_stats/'),
+    ],
+}
+
+# Compiled templates kept across warm invocations : file name -> (ETag, placeholders, Template)
+templates = {}
+
+# Incremental jobs of the running invocation : name -> (output_path, watermark state, planned dates, {execution id: date})
+refreshes = {}
+
+# Versioned jobs of the running invocation : name -> (output_path, version)
+versions = {}
+
+# Index of the query results, loaded for each invocation
+result_cache = None
 
 s3_client = boto3.client('s3')
 athena_client = boto3.client('athena')
+glue_client = boto3.client('glue')
+
+def cleanup(output_path, keep=()):
+    # Batched deletion : the query must not start while old result files are left in its output
+    summary = delete_prefix(s3_client, output_bucket, output_path, keep)
+    if summary['errors']:
+        raise RuntimeError(f"{len(summary['errors'])} files of {output_path} could not be deleted : {summary['errors'][:5]}")
+
+def read_bu_config():
+    # BU config indexed by query_config, parsed once per version of the file
+    return get_cached_object(s3_client, sql_bucket, 'sql/bu_sql_config.json', json.loads)[1]
 
-def cleanup(output_path):
-    session = boto3.Session()
-    s3 = session.resource('s3')
-    my_bucket = s3.Bucket(output_bucket)
-    for item in my_bucket.objects.filter(Prefix=output_path):
-        item.delete()
+def placeholders():
+    return tuple(sorted(set(date_placeholders).union(*read_bu_config().values())))
 
 def read_query(filename):
-    file_contents = s3_client.get_object(Bucket="datalake-dev-lambda-resources", Key=f'sql/{filename}')
-    return file_contents['Body'].read().decode('utf-8')
+    # Template of the SQL file, downloaded and compiled again only when the file changed
+    etag, text = get_cached_object(s3_client, sql_bucket, f'sql/{filename}')
+    names = placeholders()
+    cached = templates.get(filename)
+    if cached is None or cached[:2] != (etag, names):
+        cached = (etag, names, Template(text, names))
+        templates[filename] = cached
+    return cached[2]
+
+def adapt_query(template, event, date, leads_limit, monthly=False):
+    # Date placeholders are filled for every query type, the SQL files use the ones they need
+    year, month, day = int(date[0:4]), int(date[5:7]), int(date[8:10])
+    values = {
+        'LEADS_LIMIT': leads_limit,
+        'LEADS_AS_OF': leads_as_of(date),
+        'QUERY_DATE': f"'{date}'",
+        'QUERY_MONTH': f"'{date[0:7]}'",
+        'QUERY_YTD': f"'{date[0:4]}'",
+        # partitions of the raw tables read by the query : the month of the date for the monthly queries
+        'PARTITION_FILTER': f"(year = {year} AND month = {month})" if monthly else f"(year = {year} AND month = {month} AND day = {day})",
+    }
 
-def adapt_query(query, event, date, leads_limit):
     if event['query_type'] == "marketo_bu":
-        
-        query = query.replace("LEADS_LIMIT", leads_limit)
-        
-        query = query.replace("QUERY_DATE", f"'{date}'")
-        query = query.replace("QUERY_MONTH", f"'{date[0:7]}'")
-        query = query.replace("QUERY_YTD", f"'{date[0:4]}'")
-        
-        query_config = event['query_config']
-        query_params_all = s3_client.get_object(Bucket="datalake-dev-lambda-resources", Key='sql/bu_sql_config.json')['Body'].read().decode('utf-8')
-        query_params = json.loads(query_params_all)[query_config]
-        print(query_params)
-        
-        for param in query_params:
-            query = query.replace(param, query_params[param])
-    
-    elif event['query_type'] == "marketo_global":
-        
-        query = query.replace("LEADS_LIMIT", leads_limit)
-        
-        query = query.replace("QUERY_DATE", f"'{date}'")
-        query = query.replace("QUERY_MONTH", f"'{date[0:7]}'")
-        query = query.replace("QUERY_YTD", f"'{date[0:4]}'")
-
-    # print(query)
-    print(date)
-    return query
+        values.update(read_bu_config()[event['query_config']])
 
-def lambda_handler(event, context):
-    
-    ### GET PARAMETERS
-    output_path = f"dashboard/{event['output_path']}"
-    query_type = event['query_type']
-    truncate = event['truncate']
-    
-    if truncate == "True":
-        cleanup(output_path)
-    
-    
-    # historique/rattrapage ou lancement quotidien
-    try:
-        query_date = event['query_date']
-        exec_day = (datetime.strptime(query_date, "%Y-%m-%d") + timedelta(days=1)).strftime('%d')
-        leads_limit = "WHERE SUBSTR(updatedat, 1, 10) <= QUERY_DATE"
-    except:
-        query_date = (datetime.today() - timedelta(days=1)).strftime('%Y-%m-%d')
-        exec_day = datetime.today().strftime('%d')
-        leads_limit = ""
+    return template.render(values)
+
+def dated_parameters(query_date):
+    # (exec_day, leads_limit) of a query computed for a given date
+    exec_day = (datetime.strptime(query_date, "%Y-%m-%d") + timedelta(days=1)).strftime('%d')
+    # the partition predicate lets Athena skip the lead files written after the query date
+    year, month, day = int(query_date[0:4]), int(query_date[5:7]), int(query_date[8:10])
+    leads_limit = ("WHERE (year < {0} OR (year = {0} AND month < {1}) OR (year = {0} AND month = {1} AND day <= {2})) "
+                   "AND CAST(updatedat AS date) <= DATE '{3}'").format(year, month, day, query_date)
+    return exec_day, leads_limit
 
+def leads_as_of(query_date):
+    # Subquery of the leads as they were at the end of the date : the snapshot rows of the leads not
+    # updated since, and the previous state of the first change after the date of the others. The
+    # change log files of an export are in the partition of its first day, at most 31 days before its changes.
+    first = (datetime.strptime(query_date, "%Y-%m-%d") - timedelta(days=31)).strftime('%Y-%m-%d')
+    year, month, day = int(first[0:4]), int(first[5:7]), int(first[8:10])
+    columns = ['bu__c', 'webformrequestmostrecent', 'leadstatus', 'sfdctype', 'createdat', 'updatedat']
+    return (
+        f"(SELECT id, {', '.join(columns)} FROM \"marketo-leads-snapshot\" WHERE CAST(updatedat AS date) <= DATE '{query_date}' "
+        f"UNION ALL "
+        f"SELECT id, {', '.join(f'previous_{c} AS {c}' for c in columns)} FROM ("
+        f"SELECT *, row_number() OVER (PARTITION BY id ORDER BY updatedat) AS change_rank FROM \"marketo-leads-changes\" "
+        f"WHERE (year > {year} OR (year = {year} AND month > {month}) OR (year = {year} AND month = {month} AND day >= {day})) "
+        f"AND CAST(updatedat AS date) > DATE '{query_date}') "
+        f"WHERE change_rank = 1 AND previous_updatedat IS NOT NULL)"
+    )
 
+def query_file(query_type, exec_day, incremental=False):
     # use monthly query or daily query
     if (query_type == "marketo_bu") & (exec_day == "01"):
         query_path = "bu_stats_monthly.sql"
@@ -82,46 +145,173 @@ def lambda_handler(event, context):
     elif query_type == "marketo_global":
         query_path = "global_stats_daily.sql"
     elif query_type == "pbi_combine":
-        query_path = "pbi_combine.sql"
+        # the incremental refresh computes the combined table one date at a time
+        query_path = "pbi_combine_daily.sql" if incremental else "pbi_combine.sql"
+    return query_path
+
+def upstream_of(event, query_path):
+    return event.get('upstream') or upstreams[query_path]
+
+def start_execution(event, query_date, exec_day, leads_limit, clear_prefix=None, incremental=False,
+                    reuse=False, input_fingerprint=None, location=None):
+    # Delete clear_prefix and start the query, or with reuse, copy the result of the same query run
+    # earlier on the same input files. Returns the Athena response, or the result of the reused query.
+    query_path = query_file(event['query_type'], exec_day, incremental)
 
     # Load SQL    
-    query = read_query(query_path)
-    query = adapt_query(query, event, query_date, leads_limit)
+    template = read_query(query_path)
+    query = adapt_query(template, event, query_date, leads_limit, monthly=query_path.endswith('_monthly.sql'))
+    location = location or f"dashboard/{event['output_path']}/{query_date}"
+
+    key = None
+    if reuse and event.get('reuse') != "False":
+        if input_fingerprint is None:
+            input_fingerprint = fingerprint(s3_client, upstream_of(event, query_path), query_date)
+        key = cache_key(query, input_fingerprint)
+        entry = result_cache.lookup(key)
+        if entry is not None:
+            result_key = f"{location}/{entry['result_key'].split('/')[-1]}"
+            if entry['result_key'] != result_key:
+                s3_client.copy_object(Bucket=output_bucket, Key=result_key,
+                                      CopySource={'Bucket': output_bucket, 'Key': entry['result_key']})
+            if clear_prefix:
+                cleanup(clear_prefix, keep={result_key})
+            result_cache.reuse(key, entry, result_key)
+            return {'state': 'SUCCEEDED', 'execution_id': entry['execution_id'], 'runtime_ms': 0,
+                    'bytes_scanned': 0, 'reason': None, 'reused': True}
+
+    if clear_prefix:
+        cleanup(clear_prefix)
 
     # Execution
-    response = athena_client.start_query_execution(
-        QueryString=query,
-        QueryExecutionContext={
-            'Database': database
-        },
-        ResultConfiguration={
-            'OutputLocation': f's3://{output_bucket}/{output_path}/{query_date}',
-        }
-    )
-   
+    with stage('athena_submit'):
+        response = athena_client.start_query_execution(
+            QueryString=query,
+            QueryExecutionContext={
+                'Database': database
+            },
+            ResultConfiguration={
+                'OutputLocation': f"s3://{output_bucket}/{location}",
+            }
+        )
+    count('queries')
+
+    if key is not None:
+        execution_id = response['QueryExecutionId']
+        result_cache.add(key, execution_id, f"{location}/{execution_id}.csv")
     return response
+
+def start_query(event):
+    # Start the query of a job (query_type, output_path, truncate, optional query_date)
     
-    # # Decomment if you need to check any errors and commet "return response" above
-    # print(f's3://{output_bucket}/{output_path}/{query_date}')
-    # print(query_date, exec_day)
-    # max_execution = 5
-    # state = 'RUNNING'
+    ### GET PARAMETERS
+    output_path = f"dashboard/{event['output_path']}"
+    truncate = event.get('truncate')
     
-    # while (max_execution > 0 and state in ['RUNNING', 'QUEUED']):
-    #     print(max_execution)
-    #     max_execution = max_execution - 1
-    #     result = athena_client.get_query_execution(QueryExecutionId = response['QueryExecutionId'])
-
-    #     if 'QueryExecution' in result and \
-    #             'Status' in result['QueryExecution'] and \
-    #             'State' in result['QueryExecution']['Status']:
-    #         state = result['QueryExecution']['Status']['State']
-    #         if state == 'FAILED':
-    #             # return json.loads(json.dumps(result, default=str))
-    #             print(result)
-    #         elif state == 'SUCCEEDED':
-    #             s3_path = result['QueryExecution']['ResultConfiguration']['OutputLocation']
-    #             filename = re.findall('.*\/(.*)', s3_path)[0]
-    #             # return filename
-    #             print(result)
-    #     time.sleep(30)
\ No newline at end of file
+    # historique/rattrapage ou lancement quotidien
+    # the result of a query with a date is reused when its input files did not change since it last ran
+    try:
+        query_date = event['query_date']
+        exec_day, leads_limit = dated_parameters(query_date)
+        reuse = True
+    except:
+        query_date = (datetime.today() - timedelta(days=1)).strftime('%Y-%m-%d')
+        exec_day = datetime.today().strftime('%d')
+        leads_limit = ""
+        reuse = False
+
+    if event.get('versioned') == "True":
+        # the result is written to a new version folder, the table is switched to it once complete
+        version = new_version()
+        versions[event['name']] = (event['output_path'], version)
+        return start_execution(event, query_date, exec_day, leads_limit,
+                               location=version_prefix(event['output_path'], version).rstrip('/'))
+
+    return start_execution(event, query_date, exec_day, leads_limit,
+                           clear_prefix=output_path if truncate == "True" else None, reuse=reuse)
+
+def start_refresh(event):
+    # Incremental mode : start one query per date to compute (see datamart_refresh.py), each one
+    # replacing the folder of its date only, and return their execution ids (or reused results)
+    output_path = event['output_path']
+    last_date = event.get('query_date') or (datetime.today() - timedelta(days=1)).strftime('%Y-%m-%d')
+
+    def date_upstream(query_date):
+        return upstream_of(event, query_file(event['query_type'], dated_parameters(query_date)[0], incremental=True))
+
+    state = load_watermark(s3_client, output_bucket, output_path)
+    with stage('refresh_planning'):
+        planned = plan_refresh(s3_client, state, date_upstream, last_date, event.get('start_date'))
+    print(f"{output_path} : watermark {state['watermark']}, computing {sorted(planned)}")
+
+    executions = []
+    execution_dates = {}
+    for query_date in sorted(planned):
+        exec_day, leads_limit = dated_parameters(query_date)
+        execution = start_execution(event, query_date, exec_day, leads_limit,
+                                    clear_prefix=f"dashboard/{output_path}/{query_date}/", incremental=True,
+                                    reuse=True, input_fingerprint=planned[query_date])
+        if 'reused' in execution:
+            executions.append(execution)
+            execution_dates[execution['execution_id']] = query_date
+        else:
+            executions.append(execution['QueryExecutionId'])
+            execution_dates[execution['QueryExecutionId']] = query_date
+    refreshes[event['name']] = (output_path, state, planned, execution_dates)
+    return executions
+
+def start_job(job):
+    if job.get('incremental') == "True":
+        return start_refresh(job)
+    execution = start_query(job)
+    return execution if 'reused' in execution else execution['QueryExecutionId']
+
+def switch_version(job, result):
+    # Versioned job succeeded : point its table to the new version and delete the old versions
+    if job['name'] not in versions:
+        return
+    output_path, version = versions.pop(job['name'])
+    columns = result_columns(athena_client, result['execution_id'])
+    delete_result_metadata(s3_client, output_bucket, version_prefix(output_path, version), result['execution_id'])
+    location = f"s3://{output_bucket}/{version_prefix(output_path, version)}"
+    switch_table(glue_client, database, job.get('table', table_name(output_path)), location, columns)
+    print(f"{job['name']} : table switched to {location}")
+    delete_old_versions(s3_client, output_bucket, output_path, version)
+
+def save_refreshes(results):
+    # Watermarks of the incremental jobs, moved over the dates whose query succeeded
+    for name, (output_path, state, planned, execution_dates) in refreshes.items():
+        executions = results[name].get('executions', {})
+        succeeded = {execution_dates[i] for i, result in executions.items() if result['state'] == 'SUCCEEDED'}
+        save_watermark(s3_client, output_bucket, output_path, commit_refresh(state, planned, succeeded))
+    refreshes.clear()
+
+@instrumented('dashboard-sql')
+def lambda_handler(event, context):
+    global result_cache
+    result_cache = ResultCache(s3_client, athena_client, output_bucket)
+
+    # Orchestrator mode : {"jobs": [{"name": ..., "depends_on": [...], <query event>}, ...]} runs all
+    # the queries of the datamart refresh in one invocation, each one as soon as its inputs succeeded.
+    # Incremental and versioned queries run as jobs too : their watermark is saved, or their table
+    # switched, once their queries completed.
+    if 'jobs' in event or event.get('incremental') == "True" or event.get('versioned') == "True":
+        jobs = event.get('jobs') or [dict(event, name=event['output_path'])]
+        jobs = [dict(job, query_date=event['query_date']) if 'query_date' in event else job for job in jobs]
+        refreshes.clear()
+        versions.clear()
+        results = run_jobs(athena_client, jobs, start_job, context, on_done=switch_version)
+        save_refreshes(results)
+        result_cache.save()
+
+        failed = [name for name, result in results.items() if result['state'] != 'SUCCEEDED']
+        if failed:
+            print(f"ERROR : queries {failed} did not succeed")
+        return {
+            'statusCode': 500 if failed else 200,
+            'body': results
+        }
+
+    response = start_query(event)
+    result_cache.save()
+    return response
@@ -0,0 +1,23 @@
+# Keys of the raw files. Files are written under Hive style partitions (key=value folders) so the
+# Athena tables can use partition projection instead of crawlers :
+#   <prefix>/[view_id=<view id>/]year=<YYYY>/month=<MM>/day=<DD>/<file name>
+
+def date_partition(dt):
+    # 'YYYY-MM-DD' -> 'year=YYYY/month=MM/day=DD'
+    return f'year={dt[0:4]}/month={dt[5:7]}/day={dt[8:10]}'
+
+def partition_key(prefix, dt, filename, **partitions):
+    # Partitions given as keyword arguments come before the date partitions
+    folders = [f'{name}={value}' for name, value in partitions.items()]
+    return '/'.join([prefix] + folders + [date_partition(dt), filename])
+
+def hidden_key(key):
+    # Keys under a folder or with a name starting with _ or . (ex. the _jobs/ and _checkpoints/ state
+    # files), which Athena does not read
+    return any(part[:1] in ('_', '.') for part in key.split('/'))
+
+def partition_date(key):
+    # 'YYYY-MM-DD' of a key under date partitions, None for other keys
+    if '/year=' not in key or '/day=' not in key:
+        return None
+    return '-'.join(key.split(f'/{name}=')[1].split('/')[0] for name in ('year', 'month', 'day'))
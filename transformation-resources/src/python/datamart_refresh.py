@@ -0,0 +1,97 @@
+import json
+import hashlib
+from datetime import datetime, timedelta
+from datalake_paths import partition_date, hidden_key
+
+# Incremental refresh of the dashboard outputs. The output of a query is written in one folder per
+# date (dashboard/<output path>/<date>/) and keeps a watermark : the last date computed, with the
+# fingerprint of the upstream files each recent date was computed from. A run computes the dates
+# after the watermark and recomputes the recent dates whose upstream files changed (late or
+# re-ingested data), so its cost depends on the days refreshed and not on the whole history.
+
+# Dates up to the watermark checked for upstream changes
+recheck_days = 7
+
+# New dates computed per run : catching up after an outage is spread over several runs instead of
+# starting more queries than Athena runs concurrently
+max_new_dates = 5
+
+watermark_prefix = 'dashboard/_watermarks'
+
+def watermark_key(output_path):
+    return f"{watermark_prefix}/{output_path.replace('/', '.')}.json"
+
+def load_watermark(s3, bucket, output_path):
+    try:
+        return json.loads(s3.get_object(Bucket=bucket, Key=watermark_key(output_path))['Body'].read())
+    except s3.exceptions.NoSuchKey:
+        return {'watermark': None, 'fingerprints': {}}
+
+def save_watermark(s3, bucket, output_path, state):
+    s3.put_object(Bucket=bucket, Key=watermark_key(output_path), Body=json.dumps(state).encode('utf-8'))
+
+def shift(dt, days):
+    return (datetime.strptime(dt, '%Y-%m-%d') + timedelta(days=days)).strftime('%Y-%m-%d')
+
+def date_range(first, last):
+    dates = []
+    while first <= last:
+        dates.append(first)
+        first = shift(first, 1)
+    return dates
+
+def upstream_folders(upstream, dt):
+    # upstream : [(bucket, folder template)], templates use {year}, {month}, {day} and {date}
+    return [(bucket, template.format(year=dt[0:4], month=dt[5:7], day=dt[8:10], date=dt)) for bucket, template in upstream]
+
+def fingerprint(s3, upstream, dt):
+    # Hash of the keys and ETags of the upstream files of a date : it changes when a file is added,
+    # replaced or deleted (ex. daily files replaced by the monthly file of the compaction). Files of
+    # date partitions after the date are left out, as the query of the date does not read them, and
+    # so are the state files of the functions (_jobs/, _checkpoints/...), rewritten on every run.
+    digest = hashlib.sha256()
+    for bucket, folder in upstream_folders(upstream, dt):
+        for page in s3.get_paginator('list_objects_v2').paginate(Bucket=bucket, Prefix=folder):
+            for o in page.get('Contents', []):
+                if not hidden_key(o['Key']) and (partition_date(o['Key']) or dt) <= dt:
+                    digest.update(f"{bucket}/{o['Key']} {o['ETag']}\n".encode('utf-8'))
+    return digest.hexdigest()
+
+def plan_refresh(s3, state, upstream_of, last_date, start_date=None):
+    # {date: upstream fingerprint} of the dates to compute : the dates after the watermark (from
+    # start_date, or last_date only, on the first run) and the recent dates whose upstream changed.
+    # upstream_of(date) returns the upstream of the query of a date.
+    if state['watermark'] is None:
+        new_dates = date_range(start_date or last_date, last_date)
+        recheck = []
+    else:
+        new_dates = date_range(shift(state['watermark'], 1), last_date)
+        recheck = date_range(shift(state['watermark'], 1 - recheck_days), min(state['watermark'], last_date))
+
+    planned = {}
+    for dt in recheck:
+        # dates before the first run were never computed
+        if dt not in state['fingerprints']:
+            continue
+        current = fingerprint(s3, upstream_of(dt), dt)
+        if state['fingerprints'][dt] != current:
+            planned[dt] = current
+    for dt in new_dates[:max_new_dates]:
+        planned[dt] = fingerprint(s3, upstream_of(dt), dt)
+    return planned
+
+def commit_refresh(state, planned, succeeded):
+    # Save the fingerprints of the dates computed and move the watermark to the last new date
+    # before the first one that failed; failed dates are computed again by the next run
+    for dt in sorted(planned):
+        if dt in succeeded:
+            state['fingerprints'][dt] = planned[dt]
+            if state['watermark'] is None or dt == shift(state['watermark'], 1):
+                state['watermark'] = dt
+        elif state['watermark'] is None or dt > state['watermark']:
+            break
+
+    if state['watermark'] is not None:
+        oldest = shift(state['watermark'], 1 - recheck_days)
+        state['fingerprints'] = {dt: fp for dt, fp in state['fingerprints'].items() if dt >= oldest}
+    return state
@@ -0,0 +1,69 @@
+import json
+from datetime import datetime, timedelta
+from concurrent.futures import wait, FIRST_COMPLETED
+from lambda_metrics import InstrumentedExecutor
+from throttling import QuotaExhausted
+
+# Stop submitting new dates when less than this time is left before the Lambda timeout
+time_margin_ms = 60000
+
+def date_range(start_date, end_date):
+    # All dates from start_date to end_date, both inclusive, as YYYY-MM-DD strings
+    start = datetime.strptime(start_date, '%Y-%m-%d')
+    end = datetime.strptime(end_date, '%Y-%m-%d')
+    return [(start + timedelta(days=i)).strftime('%Y-%m-%d') for i in range((end - start).days + 1)]
+
+def load_checkpoint(s3, bucket, key):
+    try:
+        body = s3.get_object(Bucket=bucket, Key=key)['Body'].read()
+    except s3.exceptions.NoSuchKey:
+        return set()
+    return set(json.loads(body)['completed'])
+
+def save_checkpoint(s3, bucket, key, completed):
+    body = json.dumps({'completed': sorted(completed)})
+    s3.put_object(Bucket=bucket, Key=key, Body=body.encode('utf-8'))
+
+def run_backfill(dates, process_date, s3, bucket, checkpoint_key, context=None, max_workers=4):
+    # Run process_date(dt) for every date not yet in the checkpoint, at most max_workers at a time.
+    # The checkpoint is saved as soon as a date is written so that a run stopped by the Lambda
+    # timeout can be invoked again with the same event and resume where it stopped.
+    completed = load_checkpoint(s3, bucket, checkpoint_key)
+    remaining = [dt for dt in dates if dt not in completed]
+    failed = {}
+    quota_exhausted = False
+
+    with InstrumentedExecutor(max_workers=max_workers) as executor:
+        running = {}
+        while remaining or running:
+            while remaining and len(running) < max_workers and not quota_exhausted:
+                if context is not None and context.get_remaining_time_in_millis() < time_margin_ms:
+                    print(f"Lambda timeout is close, {len(remaining)} dates left for the next run")
+                    break
+                dt = remaining.pop(0)
+                running[executor.submit(process_date, dt)] = dt
+
+            if not running:
+                break
+
+            done, _ = wait(running, return_when=FIRST_COMPLETED)
+            for future in done:
+                dt = running.pop(future)
+                try:
+                    future.result()
+                    completed.add(dt)
+                    save_checkpoint(s3, bucket, checkpoint_key, completed)
+                except QuotaExhausted as e:
+                    print(f"{e}, {dt} left for the next run")
+                    quota_exhausted = True
+                    remaining.insert(0, dt)
+                except Exception as e:
+                    print(f"Backfill of {dt} failed : {e}")
+                    failed[dt] = str(e)
+
+    remaining.sort()
+    return {
+        'completed': sorted(dt for dt in dates if dt in completed),
+        'failed': failed,
+        'remaining': remaining,
+    }
@@ -0,0 +1,66 @@
+import pyarrow as pa
+from arrow_schemas import ga_metric_types, ga_dimension_type, ga_timestamp_formats, parse_strings
+
+def report_fields(report, names=None):
+    # Build the output fields from the report's columnHeader; names maps GA names (ex. ga:dateHour)
+    # to output column names, otherwise the 'ga:' prefix is dropped
+    names = names or {}
+    header = report['columnHeader']
+
+    fields = []
+    for dimension in header.get('dimensions', []):
+        fields.append(pa.field(names.get(dimension, dimension.replace('ga:', '')), ga_dimension_type(dimension)))
+    for metric in header['metricHeader']['metricHeaderEntries']:
+        metric_type = ga_metric_types.get(metric.get('type'), pa.float64())
+        fields.append(pa.field(names.get(metric['name'], metric['name'].replace('ga:', '')), metric_type))
+
+    return fields
+
+def decode_arrays(report, fields):
+    # Each column is gathered straight from the dimension and metric lists of the rows (no per-row
+    # lists to transpose), built as an Arrow string array and cast in bulk instead of calling
+    # int()/float() on every value.
+    # Dates are parsed with their format (ex. ga:dateHour is YYYYMMDDHH).
+    rows = report.get('data', {}).get('rows', [])
+    header = report['columnHeader']
+    dimension_names = header.get('dimensions', [])
+    ga_names = dimension_names + [m['name'] for m in header['metricHeader']['metricHeaderEntries']]
+
+    if not rows:
+        return [pa.array([], f.type) for f in fields]
+
+    dimensions = [r['dimensions'] for r in rows] if dimension_names else []
+    values = [r['metrics'][0]['values'] for r in rows]
+    columns = [[d[i] for d in dimensions] for i in range(len(dimension_names))]
+    columns += [[v[i] for v in values] for i in range(len(fields) - len(dimension_names))]
+
+    arrays = []
+    for field, ga_name, column in zip(fields, ga_names, columns):
+        array = pa.array(column, pa.string())
+        if field.type != pa.string():
+            array = parse_strings(array, field.type, ga_timestamp_formats.get(ga_name))
+        arrays.append(array)
+
+    return arrays
+
+def decode_report(report, names=None):
+    # Decode one report of a batchGet response into an Arrow table
+    fields = report_fields(report, names)
+    return pa.Table.from_arrays(decode_arrays(report, fields), schema=pa.schema(fields))
+
+def decode_report_batch(report, names=None, constants=None):
+    # Decode one report into an Arrow record batch; constants (ex. the report's filter expression or
+    # sampling) are added first, string constants as dictionary-encoded columns so the value is
+    # stored once per batch
+    fields = report_fields(report, names)
+    arrays = decode_arrays(report, fields)
+    nb_rows = len(arrays[0]) if arrays else 0
+
+    for name, value in reversed(list((constants or {}).items())):
+        array = pa.repeat(value, nb_rows)
+        if isinstance(value, str):
+            array = array.dictionary_encode()
+        fields.insert(0, pa.field(name, array.type))
+        arrays.insert(0, array)
+
+    return pa.RecordBatch.from_arrays(arrays, schema=pa.schema(fields))
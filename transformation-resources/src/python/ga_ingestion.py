@@ -0,0 +1,104 @@
+import threading
+from ga_decoder import decode_report_batch
+from ga_specs import report_requests, report_columns, output_schema
+from ga_reporting import run_report_plan, replay_report_pages, archive_keys, sampling, event_view_ids, event_dates, view_limiters, requests_per_second
+from s3_parquet_sink import S3ParquetSink
+from ga_backfill import date_range, run_backfill
+from datalake_paths import partition_key
+from raw_archive import ArchiveWriter, archive_bucket
+from lambda_metrics import stage
+
+# Ingestion of a report of ga_report_specs.json (ex. stats, forms) into one parquet file per view
+# and date of google-analytics/<report>/, shared by the Google Analytics Lambda functions
+
+def ingest(s3, bucket, report_name, analytics, view_ids, dates, limiters=None, max_workers=4, replay=False):
+    # One output file per view and date. The report requests of all views and dates are packed into
+    # as few batchGet calls as possible, the calls run concurrently and every page is decoded into a
+    # record batch written as its own row group of the file of its view and date, streamed to S3.
+    # A report with several filters has one request per filter, tagged with its constant columns.
+    prefix = f'google-analytics/{report_name}'
+    tagged_requests = []
+    constants_of = {}
+    for view_id in view_ids:
+        for dt in dates:
+            for constants, report_request in report_requests(report_name, view_id, dt):
+                tag = (view_id, dt) + tuple(constants.values())
+                constants_of[tag] = constants
+                tagged_requests.append((tag, report_request))
+
+    output_filenames = {
+        (view_id, dt): partition_key(prefix, dt, f'{report_name}_{dt}.parquet', view_id=view_id)
+        for view_id in view_ids for dt in dates}
+    writers = {file: S3ParquetSink(s3, bucket, key, output_schema(report_name)) for file, key in output_filenames.items()}
+    # pages are handled from the worker threads
+    report_rows = {tag: 0 for tag, _ in tagged_requests}
+    rows_lock = threading.Lock()
+    archive_files = archive_keys(prefix, tagged_requests)
+    archives = {} if replay or not archive_bucket else {
+        file: ArchiveWriter(s3, archive_bucket, key) for file, key in archive_files.items()}
+
+    def handle_page(tag, report):
+        if archives:
+            archives[tag[:2]].write({'tag': tag, 'report': report})
+        with stage('decode'):
+            batch = decode_report_batch(report, report_columns(report_name), dict(constants_of[tag], sampling=sampling(report)))
+        if batch.num_rows > 0:
+            with rows_lock:
+                report_rows[tag] += batch.num_rows
+            writers[tag[:2]].write(batch)
+
+    try:
+        if replay:
+            # pages of the archive files, without any API call
+            levels = replay_report_pages(s3, archive_bucket, archive_files.values(), handle_page, max_workers)
+        else:
+            # sampled reports are split until they are not : the lowest sampling left is kept in the file metadata
+            levels = run_report_plan(analytics, tagged_requests, handle_page, limiters, max_workers)
+        for archive in archives.values():
+            archive.close()
+
+        for tag, nb_rows in report_rows.items():
+            if nb_rows == 0 and len(tag) > 2:
+                print(f"There is no data in {tag[2]} for view {tag[0]} on {tag[1]}")
+
+        written = []
+        for (view_id, dt), writer in writers.items():
+            level = min([levels[tag] for tag in levels if tag[:2] == (view_id, dt)], default=100.0)
+            if writer.close(metadata={'ga_sampling': str(level)}):
+                written.append(output_filenames[(view_id, dt)])
+            else:
+                print(f"No file was written for view {view_id} on {dt} as the reports were empty")
+
+        return written
+    finally:
+        # uploads of the files not closed (ex. quota exhausted)
+        for writer in writers.values():
+            writer.abort()
+
+def backfill(s3, bucket, report_name, analytics, event, context, view_ids):
+    # Backfill mode : every date from start_date to end_date (inclusive) is queried concurrently
+    # under the views' API quotas, and finished dates are checkpointed to resume after a timeout
+    dates = date_range(event['start_date'], event['end_date'])
+    limiters = view_limiters(view_ids, event.get('requests_per_second', requests_per_second))
+    replay = event.get('replay') == "True"
+    checkpoint_key = f"google-analytics/{report_name}/_checkpoints/{'replay_' if replay else ''}{'_'.join(view_ids)}/{event['start_date']}_{event['end_date']}.json"
+
+    return run_backfill(
+        dates,
+        lambda dt: ingest(s3, bucket, report_name, analytics, view_ids, [dt], limiters, max_workers=len(view_ids), replay=replay),
+        s3, bucket, checkpoint_key, context,
+        max_workers=int(event.get('max_workers', 4)))
+
+def handle_event(s3, bucket, report_name, analytics, event, context):
+    # Body of the Lambda functions : backfill with start_date and end_date, replay of the archive
+    # with replay, the views and dates of the event (yesterday by default) otherwise.
+    # analytics is a function returning the calling thread's API client.
+    view_ids = event_view_ids(event)
+
+    if event.get('start_date') and event.get('end_date'):
+        return backfill(s3, bucket, report_name, analytics, event, context, view_ids)
+
+    if event.get('replay') == "True":
+        return ingest(s3, bucket, report_name, None, view_ids, event_dates(event), max_workers=int(event.get('max_workers', 4)), replay=True)
+
+    return ingest(s3, bucket, report_name, analytics, view_ids, event_dates(event), view_limiters(view_ids), int(event.get('max_workers', 4)))
@@ -0,0 +1,215 @@
+import json
+import threading
+from collections import deque
+from datetime import datetime, timedelta
+from throttling import retry, TokenBucket, QuotaExhausted
+from lambda_metrics import stage, count, InstrumentedExecutor
+from raw_archive import archive_key, read_archive
+
+# Limits of the Google Analytics Reporting API v4
+max_page_size = 100000
+max_requests_per_batch = 5
+
+# Reporting API quotas for one view : 10,000 requests per day and 100 requests per 100 seconds for
+# the service account, with at most 10 concurrent requests. The rate is throttled per invocation;
+# the daily quota is shared by all the invocations and functions, it is detected from the errors
+# of the API.
+requests_per_second = 1
+requests_burst = 10
+
+# Sampled reports are split into smaller requests : one per segment first, then halves of the
+# hours of the day, down to a single hour
+all_hours = tuple('%02d' % hour for hour in range(24))
+
+def is_daily_quota_error(e):
+    # googleapiclient HttpError of a daily quota (ex. "Quota exceeded for quota metric 'Requests'
+    # and limit 'Requests per day per view'"), which retries within the day can not fix
+    status = getattr(getattr(e, 'resp', None), 'status', None)
+    content = getattr(e, 'content', None) or b''
+    if isinstance(content, bytes):
+        content = content.decode('utf-8', 'replace')
+    content = content.lower()
+    return status is not None and int(status) in (403, 429) and ('per day' in content or 'dailylimitexceeded' in content)
+
+def is_retryable_http_error(e):
+    # googleapiclient HttpError : rate limiting (429) and server errors (5xx)
+    status = getattr(getattr(e, 'resp', None), 'status', None)
+    return status is not None and (int(status) == 429 or int(status) >= 500) and not is_daily_quota_error(e)
+
+def is_sampled(report):
+    # The API only returns the sample sizes of sampled reports
+    return bool(report.get('data', {}).get('samplesReadCounts'))
+
+def sampling(report):
+    # Percentage of the sessions read for the report, 100 when it was not sampled
+    data = report.get('data', {})
+    if not is_sampled(report):
+        return 100.0
+    return round(int(data['samplesReadCounts'][0]) / int(data['samplingSpaceSizes'][0]) * 100, 2)
+
+def with_hours(report_request, hours):
+    # Request restricted to the hours of the day (ga:hour values), added to its dimension filters
+    if hours is None:
+        return report_request
+    clause = {'filters': [{'dimensionName': 'ga:hour', 'operator': 'IN_LIST', 'expressions': list(hours)}]}
+    return dict(report_request, dimensionFilterClauses=report_request.get('dimensionFilterClauses', []) + [clause])
+
+def split_request(report_request, hours=None):
+    # (request, hours) pairs reading the same rows as a sampled request in smaller parts : one per
+    # segment when it has several, otherwise two halves of its hours; [] for a single hour
+    segments = report_request.get('segments', [])
+    if len(segments) > 1:
+        return [(dict(report_request, segments=[segment]), hours) for segment in segments]
+    hours = hours or all_hours
+    if len(hours) == 1:
+        return []
+    half = len(hours) // 2
+    return [(report_request, hours[:half]), (report_request, hours[half:])]
+
+def iter_report_pages(analytics, report_requests, page_size=max_page_size, limiter=None, replace=None):
+    # Yield (request index, report) for every page of every report request, following nextPageToken.
+    # Requests are sent by groups of 5 (batchGet limit) and must be compatible (see plan_batches);
+    # a request is dropped from the next call of its group once its last page has been read, so only
+    # one page per report is held in memory. When replace(index, report) returns True for the first
+    # page of a request, the page is not yielded and the following pages are not read.
+    for offset in range(0, len(report_requests), max_requests_per_batch):
+        pending = {}
+        for i, report_request in enumerate(report_requests[offset:offset + max_requests_per_batch]):
+            pending[offset + i] = dict(report_request, pageSize=page_size)
+
+        while pending:
+            indexes = list(pending)
+            batch_get = analytics.reports().batchGet(body={'reportRequests': [pending[i] for i in indexes]})
+            with stage('api_call'):
+                try:
+                    response = retry(batch_get.execute, is_retryable_http_error, limiter=limiter)
+                except Exception as e:
+                    if is_daily_quota_error(e):
+                        raise QuotaExhausted(f"Daily quota of view {pending[indexes[0]]['viewId']} exhausted") from e
+                    raise
+            count('api_pages', len(response['reports']))
+
+            for i, report in zip(indexes, response['reports']):
+                if replace is not None and 'pageToken' not in pending[i] and replace(i, report):
+                    del pending[i]
+                    continue
+                next_page_token = report.get('nextPageToken')
+                if next_page_token:
+                    pending[i] = dict(pending[i], pageToken=next_page_token)
+                else:
+                    del pending[i]
+                yield i, report
+
+def event_view_ids(event):
+    # view_ids (list) or view_id
+    view_ids = event.get('view_ids') or [event['view_id']]
+    return [str(view_id) for view_id in view_ids]
+
+def event_dates(event):
+    # dates (list) or date, yesterday by default
+    if event.get('dates'):
+        return [str(dt) for dt in event['dates']]
+    if event.get('date'):
+        return [str(event['date'])]
+    return [(datetime.today() - timedelta(days=1)).strftime('%Y-%m-%d')]
+
+def view_limiters(view_ids, rate=requests_per_second):
+    # The Reporting API quotas apply per view, so each view gets its own token bucket
+    return {view_id: TokenBucket(rate, requests_burst) for view_id in view_ids}
+
+def batch_key(report_request):
+    # Report requests of one batchGet call must share the viewId, dateRanges, segments,
+    # samplingLevel and cohortGroup
+    return (
+        report_request['viewId'],
+        json.dumps(report_request.get('dateRanges'), sort_keys=True),
+        json.dumps(report_request.get('segments'), sort_keys=True),
+        report_request.get('samplingLevel'),
+        json.dumps(report_request.get('cohortGroup'), sort_keys=True),
+    )
+
+def plan_batches(tagged_requests, key=batch_key):
+    # Pack (tag, report request) pairs into as few batchGet calls as possible : requests are grouped
+    # by key (batch_key of the request) and every group is cut in calls of at most 5 requests
+    groups = {}
+    for tag, report_request in tagged_requests:
+        groups.setdefault(key(report_request), []).append((tag, report_request))
+
+    batches = []
+    for group in groups.values():
+        for offset in range(0, len(group), max_requests_per_batch):
+            batches.append(group[offset:offset + max_requests_per_batch])
+    return batches
+
+def part_key(part):
+    # batch_key of a (report request, hours) part of a request
+    return batch_key(part[0])
+
+def run_report_plan(analytics, tagged_requests, handle_page, limiters=None, max_workers=4, split_sampled=True):
+    # Run the planned batchGet calls concurrently and hand every page back with the tag of its
+    # request : handle_page(tag, report) is called from the worker threads.
+    # analytics is a function returning the calling thread's API client (see lambda_runtime.get_analytics).
+    # A sampled report is replaced by the reports of its split requests (split_request), run with
+    # the same tag under the limiter of the view until they are not sampled, so the pages of a tag
+    # hold the unsampled rows. Returns {tag: lowest sampling percentage of the pages handed back}.
+    limiters = limiters or {}
+    levels = {}
+    lock = threading.Lock()
+    futures = deque()
+
+    def run_batch(batch):
+        # batch : [(tag, (report request, hours)), ...]
+        report_requests = [with_hours(report_request, hours) for _, (report_request, hours) in batch]
+        limiter = limiters.get(report_requests[0]['viewId'])
+
+        def replace(index, report):
+            tag, (report_request, hours) = batch[index]
+            parts = split_request(report_request, hours) if split_sampled and is_sampled(report) else []
+            if not parts:
+                return False
+            print(f"Report of {tag} sampled at {sampling(report)}%, split in {len(parts)} requests")
+            count('split_requests', len(parts))
+            for sub_batch in plan_batches([(tag, part) for part in parts], key=part_key):
+                futures.append(executor.submit(run_batch, sub_batch))
+            return True
+
+        for index, report in iter_report_pages(analytics(), report_requests, limiter=limiter, replace=replace):
+            tag = batch[index][0]
+            with lock:
+                levels[tag] = min(levels.get(tag, 100.0), sampling(report))
+            handle_page(tag, report)
+
+    with InstrumentedExecutor(max_workers=max_workers) as executor:
+        for batch in plan_batches([(tag, (report_request, None)) for tag, report_request in tagged_requests], key=part_key):
+            futures.append(executor.submit(run_batch, batch))
+        # split requests are queued by the running batches before they finish
+        while futures:
+            futures.popleft().result()
+    return levels
+
+def archive_keys(source, tagged_requests):
+    # Archive file (see raw_archive) of each view and date, named after the requests of the view
+    # and date; tags start with (view id, date)
+    requests = {}
+    for tag, report_request in tagged_requests:
+        requests.setdefault(tag[:2], []).append(report_request)
+    return {(view_id, dt): archive_key(source, dt, spec, view_id=view_id) for (view_id, dt), spec in requests.items()}
+
+def replay_report_pages(s3, bucket, keys, handle_page, max_workers=4):
+    # Hand back the pages of archive files as run_report_plan does, without any API call : the
+    # files are read concurrently and handle_page(tag, report) is called for every archived page.
+    # Returns {tag: lowest sampling percentage of the pages}.
+    levels = {}
+    lock = threading.Lock()
+
+    def replay(key):
+        for record in read_archive(s3, bucket, key):
+            tag = tuple(record['tag'])
+            with lock:
+                levels[tag] = min(levels.get(tag, 100.0), sampling(record['report']))
+            handle_page(tag, record['report'])
+
+    with InstrumentedExecutor(max_workers=max_workers) as executor:
+        for future in [executor.submit(replay, key) for key in keys]:
+            future.result()
+    return levels
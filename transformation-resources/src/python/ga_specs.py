@@ -0,0 +1,145 @@
+import os
+import re
+import json
+import functools
+import pyarrow as pa
+from arrow_schemas import ga_metric_types, ga_dimension_type, category
+
+# Report definitions (metrics, dimensions, segments, filters) live in ga_report_specs.json.
+# A report is compiled once per container into batchGet request templates; only viewId and
+# dateRanges are filled in for each query.
+
+spec_path = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'ga_report_specs.json')
+
+name_pattern = re.compile(r'^ga:[a-zA-Z][a-zA-Z0-9]*$')
+segment_operators = {
+    'REGEXP', 'BEGINS_WITH', 'ENDS_WITH', 'PARTIAL', 'EXACT', 'IN_LIST',
+    'NUMERIC_LESS_THAN', 'NUMERIC_GREATER_THAN', 'NUMERIC_BETWEEN',
+}
+
+class SpecError(ValueError):
+    pass
+
+@functools.lru_cache(maxsize=None)
+def load_specs(path=spec_path):
+    with open(path) as f:
+        return json.load(f)
+
+def expand(node, fragments):
+    # Replace {"$ref": name} by the fragment; other keys next to $ref are merged into a dict fragment
+    if isinstance(node, list):
+        return [expand(n, fragments) for n in node]
+    if not isinstance(node, dict):
+        return node
+    if '$ref' in node:
+        if node['$ref'] not in fragments:
+            raise SpecError(f"Unknown fragment {node['$ref']}")
+        fragment = expand(fragments[node['$ref']], fragments)
+        rest = {k: v for k, v in node.items() if k != '$ref'}
+        if not rest:
+            return fragment
+        if not isinstance(fragment, dict):
+            raise SpecError(f"Fragment {node['$ref']} can not be merged with {sorted(rest)}")
+        return dict(fragment, **expand(rest, fragments))
+    return {k: expand(v, fragments) for k, v in node.items()}
+
+def check_name(name, report_name):
+    if not name_pattern.match(name):
+        raise SpecError(f"Invalid dimension or metric name {name} in report {report_name}")
+
+def compile_segment_filter(segment_filter, report_name):
+    # {"not": bool, "and": [[clause, ...], ...]} : the inner lists are OR groups, and-ed together
+    or_filters = []
+    for or_group in segment_filter['and']:
+        clauses = []
+        for clause in or_group:
+            check_name(clause['dimension'], report_name)
+            if clause['operator'] not in segment_operators:
+                raise SpecError(f"Invalid segment operator {clause['operator']} in report {report_name}")
+            clauses.append({'dimensionFilter': {
+                'dimensionName': clause['dimension'],
+                'operator': clause['operator'],
+                'expressions': clause['expressions'],
+            }})
+        or_filters.append({'segmentFilterClauses': clauses})
+
+    compiled = {'simpleSegment': {'orFiltersForSegment': or_filters}}
+    if segment_filter.get('not'):
+        compiled['not'] = True
+    return compiled
+
+def compile_segment(segment, report_name):
+    return {'dynamicSegment': {
+        'name': segment['name'],
+        'sessionSegment': {'segmentFilters': [compile_segment_filter(f, report_name) for f in segment['session']]},
+    }}
+
+@functools.lru_cache(maxsize=None)
+def compile_report(report_name, path=spec_path):
+    # Compile a report spec into (constant columns, request template) pairs, one pair per filter
+    specs = load_specs(path)
+    if report_name not in specs['reports']:
+        raise SpecError(f"Unknown report {report_name}")
+    spec = expand(specs['reports'][report_name], specs.get('fragments', {}))
+
+    dimensions = spec.get('dimensions', [])
+    metrics = spec['metrics']
+    for d in dimensions:
+        check_name(d['name'], report_name)
+    for m in metrics:
+        check_name(m['expression'], report_name)
+        if m.get('type', 'INTEGER') not in ga_metric_types:
+            raise SpecError(f"Invalid metric type {m['type']} in report {report_name}")
+
+    columns = [c.get('column') for c in dimensions + metrics if c.get('column')]
+    if len(columns) != len(set(columns)):
+        raise SpecError(f"Duplicate output columns in report {report_name}")
+
+    template = dict(spec.get('options', {}))
+    template['metrics'] = [{'expression': m['expression'], 'formattingType': m.get('type', 'INTEGER')} for m in metrics]
+    template['dimensions'] = [{'name': d['name']} for d in dimensions]
+
+    if spec.get('segments'):
+        if 'ga:segment' not in [d['name'] for d in dimensions]:
+            raise SpecError(f"Report {report_name} has segments but no ga:segment dimension")
+        template['segments'] = [compile_segment(s, report_name) for s in spec['segments']]
+
+    if not spec.get('filters'):
+        return (({}, template),)
+    return tuple(({'filter': f}, dict(template, filtersExpression=f)) for f in spec['filters'])
+
+def report_requests(report_name, view_id, dt):
+    # (constant columns, report request) pairs of a report for one view and date
+    return [
+        (constants, dict(template, viewId=view_id, dateRanges=[{'startDate': dt, 'endDate': dt}]))
+        for constants, template in compile_report(report_name)
+    ]
+
+@functools.lru_cache(maxsize=None)
+def report_columns(report_name, path=spec_path):
+    # GA name -> output column name, as expected by ga_decoder
+    spec = expand(load_specs(path)['reports'][report_name], load_specs(path).get('fragments', {}))
+    columns = {}
+    for d in spec.get('dimensions', []):
+        columns[d['name']] = d.get('column', d['name'].replace('ga:', ''))
+    for m in spec['metrics']:
+        columns[m['expression']] = m.get('column', m['expression'].replace('ga:', ''))
+    return columns
+
+@functools.lru_cache(maxsize=None)
+def output_schema(report_name, path=spec_path):
+    # Arrow schema of the report's output files : constant columns first (the filter, dictionary-
+    # encoded, and the sampling percentage of the report), then the dimensions and metrics in
+    # request order with the types of arrow_schemas, as produced by ga_decoder
+    spec = expand(load_specs(path)['reports'][report_name], load_specs(path).get('fragments', {}))
+    columns = report_columns(report_name, path)
+
+    fields = []
+    if spec.get('filters'):
+        fields.append(pa.field('filter', category))
+    fields.append(pa.field('sampling', pa.float64()))
+    for d in spec.get('dimensions', []):
+        fields.append(pa.field(columns[d['name']], ga_dimension_type(d['name'])))
+    for m in spec['metrics']:
+        fields.append(pa.field(columns[m['expression']], ga_metric_types[m.get('type', 'INTEGER')]))
+    return pa.schema(fields)
@@ -0,0 +1,150 @@
+import os
+import json
+import time
+import resource
+import threading
+import functools
+import contextlib
+from concurrent.futures import ThreadPoolExecutor
+
+# Per-stage metrics of the Lambda invocations. The handlers are wrapped with @instrumented(source),
+# the shared modules time their stages with `with stage('decode'):` and add counts with
+# count('rows', n). At the end of each invocation a single CloudWatch Embedded Metric Format record
+# is printed : CloudWatch Logs turns it into metrics of the namespace per source, without any API
+# call. With METRICS=False in the environment, stage() and count() do nothing.
+#
+# Stages : secret_fetch, auth, throttle_wait, api_call, export_wait, decode, parquet_encode,
+# s3_upload, athena_submit, athena_wait, refresh_planning, archive_read. Stage times are exclusive : the time of
+# a stage run inside another one (ex. a part uploaded while a row group is encoded) is only
+# counted in the inner stage. Times are summed over the threads of the invocation : the record of
+# an invocation is kept by its thread and handed to the worker threads of InstrumentedExecutor.
+# Counts : rows, output_bytes, archive_bytes, api_pages, retries, queries, snapshot_changes.
+
+namespace = 'MarketingAnalytics'
+enabled = os.environ.get('METRICS', 'True') != 'False'
+
+# local.record : metrics of the invocation run by the thread, None outside an instrumented handler
+# or when disabled
+local = threading.local()
+no_stage = contextlib.nullcontext()
+
+class Stage:
+    __slots__ = ('record', 'name', 'start', 'nested')
+
+    def __init__(self, record, name):
+        self.record = record
+        self.name = name
+
+    def __enter__(self):
+        self.record.stack().append(self)
+        self.nested = 0.0
+        self.start = time.perf_counter()
+
+    def __exit__(self, *exc_info):
+        elapsed = time.perf_counter() - self.start
+        stack = self.record.stack()
+        stack.pop()
+        if stack:
+            stack[-1].nested += elapsed
+        self.record.add_time(self.name, elapsed - self.nested)
+
+class Record:
+    def __init__(self):
+        self.stages = {}
+        self.counts = {}
+        self.lock = threading.Lock()
+        self.local = threading.local()
+
+    def stack(self):
+        stack = getattr(self.local, 'stack', None)
+        if stack is None:
+            stack = self.local.stack = []
+        return stack
+
+    def add_time(self, name, seconds):
+        with self.lock:
+            self.stages[name] = self.stages.get(name, 0.0) + seconds
+
+    def add_count(self, name, value):
+        with self.lock:
+            self.counts[name] = self.counts.get(name, 0) + value
+
+def active_record():
+    return getattr(local, 'record', None)
+
+def stage(name):
+    record = active_record()
+    return Stage(record, name) if record is not None else no_stage
+
+def count(name, value=1):
+    record = active_record()
+    if record is not None:
+        record.add_count(name, value)
+
+def bound(function):
+    # function run with the record of the calling thread, from any thread
+    record = active_record()
+
+    def run(*args, **kwargs):
+        previous = active_record()
+        local.record = record
+        try:
+            return function(*args, **kwargs)
+        finally:
+            local.record = previous
+    return run
+
+class InstrumentedExecutor(ThreadPoolExecutor):
+    # Thread pool whose tasks add their stages and counts to the invocation that submitted them
+    def submit(self, function, /, *args, **kwargs):
+        return super().submit(bound(function), *args, **kwargs)
+
+def metric_unit(name):
+    if name.endswith('_seconds'):
+        return 'Seconds'
+    if name.endswith('_bytes'):
+        return 'Bytes'
+    if name.endswith('_mb'):
+        return 'Megabytes'
+    return 'Count'
+
+def emf_record(record, source, status, duration):
+    metrics = {f'{name}_seconds': round(seconds, 4) for name, seconds in record.stages.items()}
+    metrics.update(record.counts)
+    metrics['duration_seconds'] = round(duration, 4)
+    # maximum since the start of the container, warm invocations report the peak of earlier ones
+    metrics['peak_rss_mb'] = round(resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024, 1)
+    return dict({
+        '_aws': {
+            'Timestamp': int(time.time() * 1000),
+            'CloudWatchMetrics': [{
+                'Namespace': namespace,
+                'Dimensions': [['source']],
+                'Metrics': [{'Name': name, 'Unit': metric_unit(name)} for name in metrics],
+            }],
+        },
+        'source': source,
+        'status': status,
+    }, **metrics)
+
+def instrumented(source):
+    # Decorator of a lambda_handler : records the stages of the invocation and prints its metrics
+    def decorator(handler):
+        if not enabled:
+            return handler
+
+        @functools.wraps(handler)
+        def wrapper(event, context):
+            previous = active_record()
+            record = local.record = Record()
+            status = 'error'
+            start = time.perf_counter()
+            try:
+                response = handler(event, context)
+                status = 'ok'
+                return response
+            finally:
+                local.record = previous
+                print(json.dumps(emf_record(record, source, status, time.perf_counter() - start)))
+        return wrapper
+    return decorator
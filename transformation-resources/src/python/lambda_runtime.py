@@ -0,0 +1,98 @@
+import ast
+import time
+import threading
+import boto3
+from lambda_metrics import stage
+
+# Objects kept at module scope are reused by the following invocations of a warm Lambda container
+
+ssm = boto3.client('ssm')
+
+# Decrypted SSM parameters are kept for parameter_ttl seconds so rotated secrets are picked up
+parameter_ttl = 900
+# Refresh the Marketo access token when it expires in less than token_margin seconds
+token_margin = 60
+
+parameter_cache = {}
+cache_lock = threading.Lock()
+thread_clients = threading.local()
+marketo_clients = {}
+object_cache = {}
+
+def get_parameters(*names):
+    # Values of the SSM parameters, decrypted, fetched with a single get_parameters call for all
+    # the names missing from the cache or expired
+    now = time.time()
+    with cache_lock:
+        missing = [n for n in names if n not in parameter_cache or parameter_cache[n][1] < now]
+
+        for offset in range(0, len(missing), 10):
+            with stage('secret_fetch'):
+                response = ssm.get_parameters(Names=missing[offset:offset + 10], WithDecryption=True)
+            if response['InvalidParameters']:
+                raise ValueError(f"SSM parameters not found : {response['InvalidParameters']}")
+            for parameter in response['Parameters']:
+                parameter_cache[parameter['Name']] = (parameter['Value'], now + parameter_ttl)
+
+        return [parameter_cache[n][0] for n in names]
+
+def get_parameter(name):
+    return get_parameters(name)[0]
+
+def get_cached_object(s3, bucket, key, parse=None):
+    # (ETag, content) of an S3 object, parsed with parse(text) when given. The object is only
+    # downloaded again when it changed : later calls send a conditional GET with the cached ETag
+    # and S3 answers 304 Not Modified without a body.
+    from botocore.exceptions import ClientError
+
+    cached = object_cache.get((bucket, key))
+    try:
+        if cached is None:
+            response = s3.get_object(Bucket=bucket, Key=key)
+        else:
+            response = s3.get_object(Bucket=bucket, Key=key, IfNoneMatch=cached[0])
+    except ClientError as e:
+        if cached is not None and e.response['ResponseMetadata'].get('HTTPStatusCode') == 304:
+            return cached
+        raise
+
+    text = response['Body'].read().decode('utf-8')
+    cached = (response['ETag'], parse(text) if parse else text)
+    object_cache[(bucket, key)] = cached
+    return cached
+
+def get_analytics(key_path, scope):
+    # Google Analytics Reporting API client of the calling thread (httplib2 is not thread-safe).
+    # The client is rebuilt when the service account key is refreshed from SSM.
+    key = get_parameter(key_path)
+    cached = getattr(thread_clients, 'analytics', None)
+    if cached is not None and cached[0] == key:
+        return cached[1]
+
+    with stage('auth'):
+        from apiclient.discovery import build
+        from oauth2client.service_account import ServiceAccountCredentials
+
+        credentials = ServiceAccountCredentials.from_json_keyfile_dict(ast.literal_eval(key), scope)
+        analytics = build('analyticsreporting', 'v4', credentials=credentials, cache_discovery=False)
+    thread_clients.analytics = (key, analytics)
+    return analytics
+
+def get_marketo_client(munchkin_id_path, client_id_path, client_secret_path, api_limit=None, max_retry_time=None):
+    # Marketo client shared by the invocations of the container, so its access token is reused
+    # until it is about to expire instead of requesting a new one on every run
+    credentials = tuple(get_parameters(munchkin_id_path, client_id_path, client_secret_path))
+
+    with cache_lock:
+        mc = marketo_clients.get(credentials)
+        if mc is None:
+            from marketorestpython.client import MarketoClient
+            mc = MarketoClient(*credentials, api_limit, max_retry_time)
+            marketo_clients.clear()
+            marketo_clients[credentials] = mc
+
+        if not mc.token or (mc.valid_until or 0) - time.time() < token_margin:
+            with stage('auth'):
+                mc.authenticate()
+
+    return mc
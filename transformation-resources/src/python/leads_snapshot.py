@@ -0,0 +1,126 @@
+import io
+import os
+import pyarrow as pa
+import pyarrow.compute as pc
+import pyarrow.parquet as pq
+from s3_parquet_sink import S3ParquetSink
+from datalake_paths import partition_key
+from lambda_metrics import stage, count, InstrumentedExecutor
+from arrow_schemas import conform
+
+# Current state of the Marketo leads, merged from the export files.
+#
+# The snapshot is one file per bucket of ids (id % nb_buckets), sorted by id. A merge only reads and
+# rewrites the buckets of the ids of the export, so its cost depends on the changed leads and not
+# on the number of leads. Every merge also writes a change log file with the new state of the
+# changed leads and their state before the merge (previous_* columns, null for new leads) : the
+# state of the leads at an earlier date is the snapshot for the leads not updated since, and the
+# previous state of their first change after the date for the others.
+#
+# An export is merged in two steps :
+#   1. the change log file of the export is written, computed from the buckets
+#   2. the touched buckets are rewritten, each bucket file being replaced by a single S3 object
+# A rerun after a failure between the steps applies the saved change log again instead of
+# computing the changes from buckets that may already be rewritten. Exports are merged in date
+# order : the changes of an export merged after a later one only keep the leads not updated since.
+
+# Merging is enabled when the function has a snapshot bucket
+snapshot_bucket = os.environ.get('SNAPSHOT_BUCKET')
+
+snapshot_prefix = 'marketo/leads-snapshot'
+changes_prefix = 'marketo/leads-changes'
+
+# Changing the number of buckets needs a rebuild of the snapshot (delete it and merge the exports again)
+nb_buckets = 64
+
+max_workers = 8
+
+def bucket_key(bucket):
+    return f'{snapshot_prefix}/leads_{bucket:02d}.parquet'
+
+def changes_key(start_date, end_date):
+    # In the partition of the first day of the export, like the export file
+    return partition_key(changes_prefix, start_date, f'leads_changes_{start_date}_{end_date}.parquet')
+
+def changes_schema(schema):
+    return pa.schema(list(schema) + [
+        pa.field(f'previous_{field.name}', field.type) for field in schema if field.name != 'id'])
+
+def bucket_of(ids):
+    return pc.subtract(ids, pc.multiply(pc.divide(ids, nb_buckets), nb_buckets))
+
+def read_table(s3, bucket, key):
+    try:
+        body = s3.get_object(Bucket=bucket, Key=key)['Body'].read()
+    except s3.exceptions.NoSuchKey:
+        return None
+    with stage('decode'):
+        return pq.read_table(io.BytesIO(body))
+
+def write_table(s3, bucket, key, table):
+    writer = S3ParquetSink(s3, bucket, key, table.schema)
+    writer.write(table)
+    writer.close()
+
+def latest_per_id(table):
+    # Last state of every lead of the export
+    table = table.filter(pc.is_valid(table['id'])).sort_by([('id', 'ascending'), ('updatedAt', 'descending')])
+    if table.num_rows == 0:
+        return table
+    ids = table['id'].combine_chunks()
+    first = pc.not_equal(ids.slice(1), ids.slice(0, len(ids) - 1))
+    return table.filter(pa.concat_arrays([pa.array([True]), first]))
+
+def bucket_changes(current, updates, schema):
+    # Rows of the updates newer than the snapshot rows of their ids, with the snapshot rows as previous_*
+    if current is None:
+        current = schema.empty_table()
+    previous = conform(current, schema).take(pc.index_in(updates['id'], value_set=current['id'].combine_chunks()))
+    changes = updates
+    for name in schema.names[1:]:
+        changes = changes.append_column(f'previous_{name}', previous[name])
+    newer = pc.or_kleene(pc.is_null(changes['previous_updatedAt']),
+                         pc.greater(changes['updatedAt'], changes['previous_updatedAt']))
+    return changes.filter(newer)
+
+def apply_changes(current, changes, schema):
+    new = conform(changes, schema)
+    if current is None:
+        return new.sort_by('id')
+    kept = conform(current, schema).filter(pc.invert(pc.is_in(current['id'], value_set=changes['id'].combine_chunks())))
+    return pa.concat_tables([kept, new]).sort_by('id')
+
+def split_by_bucket(table):
+    # {bucket: rows of the bucket}
+    buckets = bucket_of(table['id'])
+    return {bucket: table.filter(pc.equal(buckets, bucket)) for bucket in pc.unique(buckets).to_pylist()}
+
+def merge_export(s3, export_bucket, export_key, start_date, end_date, schema, bucket=None):
+    # Merge the export file into the snapshot; returns the number of changed leads and rewritten buckets
+    bucket = bucket or snapshot_bucket
+    key = changes_key(start_date, end_date)
+
+    changes = read_table(s3, bucket, key)
+    if changes is None:
+        updates = latest_per_id(conform(read_table(s3, export_bucket, export_key), schema))
+
+        def compute(item):
+            number, rows = item
+            return bucket_changes(read_table(s3, bucket, bucket_key(number)), rows, schema)
+
+        with InstrumentedExecutor(max_workers=max_workers) as executor:
+            parts = list(executor.map(compute, split_by_bucket(updates).items()))
+        changes = pa.concat_tables(parts) if parts else changes_schema(schema).empty_table()
+        write_table(s3, bucket, key, conform(changes, changes_schema(schema)))
+
+    def rewrite(item):
+        number, rows = item
+        write_table(s3, bucket, bucket_key(number), apply_changes(read_table(s3, bucket, bucket_key(number)), rows, schema))
+
+    touched = split_by_bucket(changes) if changes.num_rows else {}
+    with InstrumentedExecutor(max_workers=max_workers) as executor:
+        list(executor.map(rewrite, touched.items()))
+
+    count('snapshot_changes', changes.num_rows)
+    print(f'Leads snapshot : {changes.num_rows} leads changed by {export_key}, {len(touched)} of {nb_buckets} buckets rewritten')
+    return {'changes': changes.num_rows, 'buckets': len(touched)}
@@ -1,81 +1,108 @@
 import boto3
 from datetime import datetime, timedelta
 import os
-from marketorestpython.client import MarketoClient
-import pandas as pd
-import pyarrow as pa
-import pyarrow.parquet as pq
+from lambda_runtime import get_marketo_client
+from lambda_metrics import instrumented, InstrumentedExecutor
+from arrow_schemas import activity_schema, delta_encoding
+from marketo_activity import run_activity_extraction, replay_day, slice_hours, max_concurrent_calls, row_group_rows
+from s3_parquet_sink import S3ParquetSink
+from datalake_paths import partition_key
+from raw_archive import ArchiveWriter, archive_bucket, archive_key, read_archive
 
 s3 = boto3.client('s3')
-ssm = boto3.client('ssm')
 
-# Hard code dates used to run daily query
-start_date = (datetime.today() - timedelta(days=1)).strftime('%Y-%m-%d')
-end_date = datetime.today().strftime('%Y-%m-%d')
+def output_writer(day):
+    # The file is streamed to S3 with a multipart upload; zstd as the attributes compress well, and
+    # activityDate delta encoded as the activities are sorted on it
+    key = partition_key('marketo/activity', day, f'activity_data_{day}.parquet')
+    return S3ParquetSink(s3, 'datalake-dev-raw', key, activity_schema, compression='zstd', row_group_rows=row_group_rows,
+                         column_encoding=delta_encoding('activityDate'))
 
+def activity_archive_key(day, list_activity_ids):
+    return archive_key('marketo/activity', day, sorted(str(i) for i in list_activity_ids))
+
+def days_between(start_date, end_date):
+    start = datetime.strptime(start_date, '%Y-%m-%d')
+    return [(start + timedelta(days=i)).strftime('%Y-%m-%d')
+            for i in range((datetime.strptime(end_date, '%Y-%m-%d') - start).days)]
+
+def replay(start_date, end_date, list_activity_ids, max_workers):
+    # Replay mode : the files of the days are rebuilt from the archived pages, days in parallel,
+    # without any API call
+    def replay_one(day):
+        records = read_archive(s3, archive_bucket, activity_archive_key(day, list_activity_ids))
+        writer = output_writer(day)
+        writer.write(replay_day(list(records)))
+        writer.close()
+        return writer.key
+
+    with InstrumentedExecutor(max_workers=max_workers) as executor:
+        output_filenames = list(executor.map(replay_one, days_between(start_date, end_date)))
+
+    return {
+        'statusCode': 200,
+        'body': f'Marketo Activity replayed for {start_date} until {end_date} exclusive and uploaded to {", ".join(output_filenames)}'
+    }
+
+@instrumented('marketo-activity')
 def lambda_handler(event, context):
     munchkin_id_path = os.environ['MUNCHKIN_ID']
     client_id_path = os.environ['CLIENT_ID']
     client_secret_path = os.environ['CLIENT_SECRET']
-    
-    munchkin_id = ssm.get_parameter(Name=munchkin_id_path, WithDecryption=True)['Parameter']['Value']
-    client_id = ssm.get_parameter(Name=client_id_path, WithDecryption=True)['Parameter']['Value']
-    client_secret = ssm.get_parameter(Name=client_secret_path, WithDecryption=True)['Parameter']['Value']
-
-    ## TO DO (IMPROVE) : add start_date and end_date to cron message and overwrite hard coded date to allow flexibility
-    # start_date = event['start_date']
-    # end_date = event['end_date_exclusive']
+
+    # Daily query dates by default, computed on each run as a warm container can outlive the day it started on
+    start_date = event.get('start_date') or (datetime.today() - timedelta(days=1)).strftime('%Y-%m-%d')
+    end_date = event.get('end_date_exclusive') or datetime.today().strftime('%Y-%m-%d')
     list_activity_ids = event['list_activity_ids']
-    
-    api_limit = None
-    max_retry_time = None
-    
-    mc = MarketoClient(munchkin_id, client_id, client_secret, api_limit, max_retry_time)
+
+    if event.get('replay') == "True":
+        return replay(start_date, end_date, list_activity_ids, int(event.get('max_workers', 4)))
+
+    # Parameters, client and access token are cached across warm invocations
+    mc = get_marketo_client(munchkin_id_path, client_id_path, client_secret_path)
 
     # Activity ids for daily => 2 : Form Filled; 12 : New Person; 22 : Change Score; 34 : Add to Opportunity;
     # 36 : Update Opportunity; 100001 : Drift Conversation URL
-    act = mc.execute(
-        method = 'get_lead_activities', 
-        activityTypeIds = list_activity_ids,
-        sinceDatetime = start_date, 
-        untilDatetime = end_date) #not inclusive
-    df = pd.DataFrame(act)
-
-    output_filename = f'marketo/activity/{start_date[0:4]}/{start_date[5:7]}/activity_data_{start_date}_{end_date}.parquet'
-    
-    print(df.info())
-    
-    print(df.head())
-    
-    # explicitly define types to avoid errors due to missing data
-    fields = [
-        pa.field('id', pa.int64()),
-        pa.field('marketoGUID', pa.int64()),
-        pa.field('leadId', pa.int64()),
-        pa.field('activityDate', pa.string()),
-        pa.field('activityTypeId', pa.int64()),
-        pa.field('campaignId', pa.float64()),
-        pa.field('primaryAttributeValueId', pa.int64()),
-        pa.field('primaryAttributeValue', pa.string()),
-        pa.field('attributes', pa.string()),
-    ]
-    
-    # ensure attributes column is read in as string and not a list
-    df['marketoGUID'] = df['marketoGUID'].astype('int')
-    df['attributes'] = df['attributes'].astype(str)
-    
-    df_schema = pa.schema(fields)
-
-    table = pa.Table.from_pandas(df, schema=df_schema, preserve_index=False)
-    
-    writer = pa.BufferOutputStream()
-    pq.write_table(table, writer)
-    body = bytes(writer.getvalue())
-    
-
-    s3.put_object(Bucket='datalake-dev-raw', Body=body, Key=output_filename)  
+    # Each activity type and time slice is queried concurrently; time slices are written in order,
+    # sorted by activityDate, into the file of their day as soon as they are complete
+    writers = {}
+
+    def write(table, day):
+        if day not in writers:
+            if writers:
+                # slices come in time order : the file of the previous day is complete
+                writers[max(writers)].close()
+            writers[day] = output_writer(day)
+        writers[day].write(table)
+
+    # The pages read are archived per day when the function has an archive bucket, for the replay mode
+    archives = {}
+    if archive_bucket:
+        archives = {day: ArchiveWriter(s3, archive_bucket, activity_archive_key(day, list_activity_ids))
+                    for day in days_between(start_date, end_date)}
+
+    def archive(activity_type_id, since, until, page):
+        archives[since[0:10]].write({'activity_type_id': activity_type_id, 'since': since, 'until': until, 'page': page})
+
+    try:
+        run_activity_extraction(
+            mc, list_activity_ids, start_date, end_date, write,
+            hours=int(event.get('slice_hours', slice_hours)),
+            max_workers=int(event.get('max_workers', max_concurrent_calls)),
+            on_page=archive if archives else None)
+        # no file when the range is empty (start_date == end_date)
+        if writers:
+            writers[max(writers)].close()
+    finally:
+        # upload of the file of the day being written when the extraction failed
+        for writer in writers.values():
+            writer.abort()
+    for writer in archives.values():
+        writer.close()
+
+    output_filenames = [writer.key for writer in writers.values()]
 
     return {
         'statusCode': 200,
-        'body': f'Marketo Activity API queried for {start_date} until {end_date} exclusive and uploaded to {output_filename}'
-    }
\ No newline at end of file
+        'body': f'Marketo Activity API queried for {start_date} until {end_date} exclusive and uploaded to {", ".join(output_filenames)}'
+    }
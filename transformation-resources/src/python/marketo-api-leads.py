@@ -1,100 +1,143 @@
 import boto3
 from datetime import datetime, timedelta
 import os
-from marketorestpython.client import MarketoClient
+from lambda_runtime import get_marketo_client
+from lambda_metrics import instrumented
+from marketo_export import start_export_job, wait_for_export_job, iter_export_file, load_job_state, save_job_state, terminal_statuses, export_windows, run_export_schedule
+from s3_parquet_sink import S3ParquetSink
+from datalake_paths import partition_key
+from leads_snapshot import merge_export, snapshot_bucket
+from arrow_schemas import leads_schema
 import json
-import pandas as pd
-import io
-import time
-import pyarrow as pa
-import pyarrow.parquet as pq
 
 s3 = boto3.client('s3')
-ssm = boto3.client('ssm')
+lambda_client = boto3.client('lambda')
 
-# Hard code dates used to run daily query
-start_date = (datetime.today() - timedelta(days=1)).strftime('%Y-%m-%d')
-end_date = datetime.today().strftime('%Y-%m-%d')
+output_bucket = 'datalake-dev-raw'
 
+# Fields written in and not as variables because output used to create Athena table
+export_fields = ['id', 'BU__c', 'webformRequestMostrecent', 'leadStatus', 'SFDCType', 'createdAt', 'updatedAt']
+
+def export_key(start_date, end_date):
+    # The file is in the partition of the first day of the export
+    return partition_key('marketo/leads', start_date, f'leads_data_{start_date}_{end_date}.parquet')
+
+def write_export_file(mc, export_id, start_date, end_date):
+    # Stream the CSV file into parquet row groups uploaded to S3 as the blocks arrive
+    output_filename = export_key(start_date, end_date)
+    writer = S3ParquetSink(s3, output_bucket, output_filename, leads_schema)
+    try:
+        for batch in iter_export_file(mc, export_id, leads_schema):
+            writer.write(batch)
+        if writer.nb_rows == 0:
+            writer.write(leads_schema.empty_table())
+        writer.close()
+    finally:
+        # upload left open when the download of the export failed
+        writer.abort()
+    return output_filename
+
+def merge_snapshot(start_date, end_date):
+    # Merge the export file into the current leads snapshot, when the function has a snapshot bucket
+    if not snapshot_bucket:
+        return None
+    return merge_export(s3, output_bucket, export_key(start_date, end_date), start_date, end_date, leads_schema)
+
+def merge_windows(manifest, save_manifest, context, margin=60):
+    # The written windows are merged in date order once they are all exported, so the change log
+    # holds the previous state of every change; returns False when the timeout is close
+    if not snapshot_bucket:
+        return True
+    for window in sorted(manifest['windows'], key=lambda w: w['start_date']):
+        if window['status'] != 'Written' or window.get('merged'):
+            continue
+        if context is not None and context.get_remaining_time_in_millis() / 1000 < margin:
+            return False
+        merge_snapshot(window['start_date'], window['end_date_exclusive'])
+        window['merged'] = True
+        save_manifest(manifest)
+    return True
+
+def invoke_again(context, event):
+    # Asynchronous invocation of this function, to continue a wait that would exceed the timeout
+    lambda_client.invoke(
+        FunctionName=context.invoked_function_arn,
+        InvocationType='Event',
+        Payload=json.dumps(event).encode('utf-8'))
+
+def backfill(event, context, mc, start_date, end_date):
+    # Ranges longer than the 31 days allowed by an export are split in windows exported by
+    # run_export_schedule; the state of every window is kept in a manifest so the function can
+    # invoke itself again until the whole range is written
+    manifest_key = f'marketo/leads/_jobs/backfill_{start_date}_{end_date}.json'
+    manifest = load_job_state(s3, output_bucket, manifest_key) or {'windows': export_windows(start_date, end_date)}
+
+    done = run_export_schedule(
+        mc, export_fields, manifest,
+        lambda m: save_job_state(s3, output_bucket, manifest_key, m),
+        lambda window: write_export_file(mc, window['export_id'], window['start_date'], window['end_date_exclusive']),
+        context)
+
+    statuses = [w['status'] for w in manifest['windows']]
+    summary = {status: statuses.count(status) for status in set(statuses)}
+    if not done:
+        invoke_again(context, {'start_date': start_date, 'end_date_exclusive': end_date})
+        return {'statusCode': 202, 'body': f'Marketo leads backfill from {start_date} until {end_date} exclusive continues in a new run : {summary}'}
+
+    if not merge_windows(manifest, lambda m: save_job_state(s3, output_bucket, manifest_key, m), context):
+        invoke_again(context, {'start_date': start_date, 'end_date_exclusive': end_date})
+        return {'statusCode': 202, 'body': f'Marketo leads backfill from {start_date} until {end_date} exclusive continues with the snapshot merge : {summary}'}
+
+    return {'statusCode': 200, 'body': f'Marketo leads backfill from {start_date} until {end_date} exclusive done : {summary}'}
+
+@instrumented('marketo-leads')
 def lambda_handler(event, context):
     munchkin_id_path = os.environ['MUNCHKIN_ID']
     client_id_path = os.environ['CLIENT_ID']
     client_secret_path = os.environ['CLIENT_SECRET']
-    
-    munchkin_id = ssm.get_parameter(Name=munchkin_id_path, WithDecryption=True)['Parameter']['Value']
-    client_id = ssm.get_parameter(Name=client_id_path, WithDecryption=True)['Parameter']['Value']
-    client_secret = ssm.get_parameter(Name=client_secret_path, WithDecryption=True)['Parameter']['Value']
-
-    ## TO DO (IMPROVE) : add start_date and end_date to cron message and overwrite hard coded date to allow flexibility
-    # start_date = event['start_date']
-    # end_date = event['end_date_exclusive']
-    
-    api_limit = None
-    max_retry_time = None
-    
-    mc = MarketoClient(munchkin_id, client_id, client_secret, api_limit, max_retry_time)
-
-    # Fields written in and not as variables because output used to create Athena table
-    # Create API query
-    new_export_job_details = mc.execute(method='create_leads_export_job',
-                                        fields=['id',
-                                                'BU__c',
-                                                'webformRequestMostrecent',
-                                                'leadStatus',
-                                                'SFDCType',
-                                                'createdAt',
-                                                'updatedAt'
-                                            ],
-                                            filters= {'updatedAt': {'endAt': end_date, 'startAt': start_date}})
-
-    # Send query to queue
-    enqueued_job_details = mc.execute(method='enqueue_leads_export_job', job_id=new_export_job_details[0]['exportId'])
-
-    # Check status of query to check if it is complete
-    status = "Queued"
-    i = 0
-    while status != "Completed" and i < 5:
-        export_job_status = mc.execute(method='get_leads_export_job_status', job_id=new_export_job_details[0]['exportId'])
-        status = export_job_status[0]['status']
-        if status == "Completed":
-            export_file_contents = mc.execute(method='get_leads_export_job_file', job_id=new_export_job_details[0]['exportId'])
-            f = io.BytesIO(export_file_contents)
-            df = pd.read_csv(f)
-        elif i == 4:
-            print("DataFrame not created; query status was never completed")
-        else:
-            # increment while loop to avoid indefinite processing
-            i += 1
-            # wait for query to be processed by Marketo
-            time.sleep(180)
-
-    output_filename = f'marketo/leads/{start_date[0:4]}/{start_date[5:7]}/leads_data_{start_date}_{end_date}.parquet'
-
-    print(df.info())
-    
-    # explicitly define types to avoid errors due to missing data
-    fields = [
-        pa.field('id', pa.int64()),
-        pa.field('BU__c', pa.string()),
-        pa.field('webformRequestMostrecent', pa.string()),
-        pa.field('leadStatus', pa.string()),
-        pa.field('SFDCType', pa.string()),
-        pa.field('createdAt', pa.string()),
-        pa.field('updatedAt', pa.string())
-    ]
-    
-    df_schema = pa.schema(fields)
-
-    table = pa.Table.from_pandas(df, schema=df_schema, preserve_index=False)
-    
-    writer = pa.BufferOutputStream()
-    pq.write_table(table, writer)
-    body = bytes(writer.getvalue())
-    
-
-    s3.put_object(Bucket='datalake-dev-raw', Body=body, Key=output_filename)  
+
+    # Daily query dates by default, computed on each run as a warm container can outlive the day it started on
+    start_date = event.get('start_date') or (datetime.today() - timedelta(days=1)).strftime('%Y-%m-%d')
+    end_date = event.get('end_date_exclusive') or datetime.today().strftime('%Y-%m-%d')
+
+    # Parameters, client and access token are cached across warm invocations
+    mc = get_marketo_client(munchkin_id_path, client_id_path, client_secret_path)
+
+    if len(export_windows(start_date, end_date)) > 1:
+        return backfill(event, context, mc, start_date, end_date)
+
+    # Resume the export job of these dates if a previous run handed it off, otherwise create it
+    job_key = f'marketo/leads/_jobs/{start_date}_{end_date}.json'
+    job_state = load_job_state(s3, output_bucket, job_key)
+    if job_state is None:
+        job_state = {
+            'export_id': start_export_job(mc, export_fields, start_date, end_date),
+            'start_date': start_date,
+            'end_date_exclusive': end_date,
+        }
+        save_job_state(s3, output_bucket, job_key, job_state)
+    export_id = job_state['export_id']
+
+    # "wait": false only starts the job; a later run with the same dates picks it up
+    if event.get('wait', True) is False:
+        return {'statusCode': 202, 'body': f'Marketo export job {export_id} started for {start_date} until {end_date} exclusive'}
+
+    job_status = wait_for_export_job(mc, export_id, context)
+
+    if job_status['status'] not in terminal_statuses:
+        # Lambda timeout is close : invoke the function again to keep waiting for the same job
+        invoke_again(context, {'start_date': start_date, 'end_date_exclusive': end_date})
+        return {'statusCode': 202, 'body': f'Marketo export job {export_id} is {job_status["status"]}, wait handed off'}
+
+    if job_status['status'] != 'Completed':
+        s3.delete_object(Bucket=output_bucket, Key=job_key)
+        raise RuntimeError(f'Marketo export job {export_id} ended with status {job_status["status"]}')
+
+    output_filename = write_export_file(mc, export_id, start_date, end_date)
+    merge_snapshot(start_date, end_date)
+    s3.delete_object(Bucket=output_bucket, Key=job_key)
 
     return {
         'statusCode': 200,
-        'body': f'Marketo Activity API queried for {start_date} until {end_date} exclusive and uploaded to {output_filename}'
-    }
\ No newline at end of file
+        'body': f'Marketo Leads API queried for {start_date} until {end_date} exclusive and uploaded to {output_filename}'
+    }
@@ -0,0 +1,140 @@
+from collections import deque
+from datetime import datetime, timedelta
+import pyarrow as pa
+from throttling import TokenBucket
+from lambda_metrics import stage, count, InstrumentedExecutor
+from arrow_schemas import activity_schema, parse_strings, cast_column
+
+# Conversion of Marketo lead activity pages into Arrow record batches, and concurrent extraction
+# of the activities of a date range split by activity type and time slice
+
+# Row group size of the activity files : time slices hold a few hundred activities, they are grouped
+# by the parquet sink until this number of rows
+row_group_rows = 50000
+
+# REST API limits : 100 calls per 20 seconds and 10 concurrent calls per instance. The rate is
+# kept under the limit as the other integrations of the instance share it.
+calls_per_second = 100 / 20 * 0.8
+max_concurrent_calls = 10
+
+# Default length of the time slices a date range is split into
+slice_hours = 6
+
+# Columns sent as strings by the API and cast by Arrow (marketoGUID is a numeric string,
+# activityDate an ISO 8601 datetime)
+string_columns = {'marketoGUID', 'activityDate'}
+
+def iter_activity_pages(mc, activity_type_ids, start_date, end_date):
+    # Pages of activities, requested one at a time with the nextPageToken of the previous one.
+    # Both datetimes are inclusive : the layer keeps the activities with activityDate <= end_date.
+    # The first page also requests the paging token of start_date (two API calls).
+    return mc.execute(
+        method='get_lead_activities_yield',
+        activityTypeIds=activity_type_ids,
+        sinceDatetime=start_date,
+        untilDatetime=end_date)
+
+def last_second_before(until):
+    # activityDate has a one second precision : the activities before until are the ones up to
+    # the second before
+    return (datetime.strptime(until, '%Y-%m-%dT%H:%M:%SZ') - timedelta(seconds=1)).strftime('%Y-%m-%dT%H:%M:%SZ')
+
+def attribute_values(attributes):
+    # Attribute values can be numbers, booleans or strings : they are all stored as strings
+    return [{'name': a['name'], 'value': None if a.get('value') is None else str(a['value'])}
+            for a in attributes or []]
+
+def activities_to_batch(activities):
+    columns = {name: [] for name in activity_schema.names}
+    for activity in activities:
+        for name, values in columns.items():
+            if name == 'attributes':
+                values.append(attribute_values(activity.get('attributes')))
+            else:
+                values.append(activity.get(name))
+
+    arrays = []
+    for field in activity_schema:
+        if field.name in string_columns:
+            values = [None if v is None else str(v) for v in columns[field.name]]
+            arrays.append(parse_strings(pa.array(values, pa.string()), field.type))
+        elif pa.types.is_dictionary(field.type):
+            arrays.append(cast_column(pa.array(columns[field.name], field.type.value_type), field.type))
+        else:
+            arrays.append(pa.array(columns[field.name], field.type))
+    return pa.RecordBatch.from_arrays(arrays, schema=activity_schema)
+
+def time_slices(start_date, end_date, hours=slice_hours):
+    # Consecutive [since, until) datetimes of at most `hours` hours covering [start_date, end_date) :
+    # an activity at the end of a slice belongs to the next one. Slices do not span midnight so
+    # every slice belongs to a single day partition.
+    start = datetime.strptime(start_date, '%Y-%m-%d')
+    end = datetime.strptime(end_date, '%Y-%m-%d')
+    slices = []
+    while start < end:
+        next_day = datetime.combine(start.date() + timedelta(days=1), datetime.min.time())
+        until = min(start + timedelta(hours=hours), next_day, end)
+        slices.append((start.strftime('%Y-%m-%dT%H:%M:%SZ'), until.strftime('%Y-%m-%dT%H:%M:%SZ')))
+        start = until
+    return slices
+
+def fetch_slice(mc, activity_type_id, since, until, limiter, on_page=None):
+    # Activities of one type and time slice [since, until) as a table; a token is taken before each
+    # API call. on_page(activity_type_id, since, until, page) is called with every page read (ex. to
+    # archive it).
+    pages = iter_activity_pages(mc, [activity_type_id], since, last_second_before(until))
+    batches = []
+    # the first page is read after the paging token request
+    nb_calls = 2
+    while True:
+        with stage('throttle_wait'):
+            for _ in range(nb_calls):
+                limiter.acquire()
+        nb_calls = 1
+        with stage('api_call'):
+            page = next(pages, None)
+        if page is None:
+            break
+        count('api_pages')
+        if on_page is not None:
+            on_page(activity_type_id, since, until, page)
+        with stage('decode'):
+            batches.append(activities_to_batch(page))
+    return pa.Table.from_batches(batches, schema=activity_schema)
+
+def run_activity_extraction(mc, activity_type_ids, start_date, end_date, write, hours=slice_hours,
+                            max_workers=max_concurrent_calls, on_page=None):
+    # Fetch every (activity type, time slice) pair concurrently and write(table, day) each time
+    # slice, in time order and sorted by activityDate, as soon as all of its types are fetched.
+    # Only a few time slices are fetched ahead of the one being written, to bound memory.
+    limiter = TokenBucket(calls_per_second, capacity=max_workers)
+    slices = deque(time_slices(start_date, end_date, hours))
+    lookahead = max(2, max_workers)
+    nb_rows = 0
+
+    with InstrumentedExecutor(max_workers=min(max_workers, max_concurrent_calls)) as executor:
+        pending = deque()
+
+        def submit_next():
+            since, until = slices.popleft()
+            pending.append((since[0:10], [executor.submit(fetch_slice, mc, type_id, since, until, limiter, on_page) for type_id in activity_type_ids]))
+
+        while slices and len(pending) < lookahead:
+            submit_next()
+
+        while pending:
+            day, futures = pending.popleft()
+            if slices:
+                submit_next()
+            table = pa.concat_tables([f.result() for f in futures])
+            write(table.sort_by('activityDate'), day)
+            nb_rows += table.num_rows
+
+    return nb_rows
+
+def replay_day(records):
+    # Table of the activities of a day rebuilt from its archived pages (records of raw_archive with
+    # the page of an activity type and time slice), sorted by activityDate as run_activity_extraction writes it
+    with stage('decode'):
+        batches = [activities_to_batch(record['page']) for record in records]
+        return pa.Table.from_batches(batches, schema=activity_schema).sort_by('activityDate')
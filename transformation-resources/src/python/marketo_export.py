@@ -0,0 +1,208 @@
+import json
+import time
+from datetime import datetime, timedelta, timezone
+import requests
+import pyarrow.csv as pv
+from lambda_metrics import stage, count, InstrumentedExecutor
+
+# Driver for Marketo bulk lead export jobs : create + enqueue, poll, and stream the CSV file
+
+terminal_statuses = ('Completed', 'Failed', 'Cancelled')
+
+# Poll delays in seconds. A queued job waits for one of the 2 processing slots of the instance, so
+# it is polled slowly; a processing job is polled after a fraction of the time it has been
+# processing (short exports are picked up within seconds, long ones are not polled every few seconds).
+queued_poll_delay = 60
+min_poll_delay = 5
+max_poll_delay = 60
+processing_poll_ratio = 0.25
+
+# Hand the wait off when less than this time is left before the Lambda timeout
+handoff_margin = 60
+
+# Bulk export limits : 31 days per updatedAt filter, 2 jobs processing at a time per instance and
+# 10 jobs in the queue (processing jobs included)
+max_window_days = 31
+max_processing_jobs = 2
+max_queued_jobs = 10
+max_window_attempts = 3
+
+# Size of the CSV blocks read from the export file; each block becomes one parquet row group
+csv_block_size = 8 << 20
+
+def start_export_job(mc, fields, start_date, end_date):
+    # Create and enqueue an export of the leads updated from start_date to end_date, returns its id
+    with stage('api_call'):
+        job = mc.execute(method='create_leads_export_job', fields=fields,
+                         filters={'updatedAt': {'startAt': start_date, 'endAt': end_date}})
+        export_id = job[0]['exportId']
+        mc.execute(method='enqueue_leads_export_job', job_id=export_id)
+    return export_id
+
+def parse_marketo_datetime(value):
+    return datetime.fromisoformat(value.replace('Z', '+00:00'))
+
+def next_poll_delay(job_status):
+    if job_status['status'] != 'Processing' or not job_status.get('startedAt'):
+        return queued_poll_delay
+    processing = (datetime.now(timezone.utc) - parse_marketo_datetime(job_status['startedAt'])).total_seconds()
+    return min(max_poll_delay, max(min_poll_delay, processing * processing_poll_ratio))
+
+def wait_for_export_job(mc, export_id, context=None):
+    # Poll the job until it reaches a terminal status. Returns the last status; when the Lambda
+    # timeout is close the status is returned before the job is done so the caller can hand off.
+    while True:
+        with stage('api_call'):
+            job_status = mc.execute(method='get_leads_export_job_status', job_id=export_id)[0]
+        if job_status['status'] in terminal_statuses:
+            return job_status
+
+        delay = next_poll_delay(job_status)
+        if context is not None and context.get_remaining_time_in_millis() / 1000 - delay < handoff_margin:
+            return job_status
+
+        print(f"Export job {export_id} is {job_status['status']}, next check in {delay:.0f}s")
+        with stage('export_wait'):
+            time.sleep(delay)
+
+def load_job_state(s3, bucket, key):
+    try:
+        return json.loads(s3.get_object(Bucket=bucket, Key=key)['Body'].read())
+    except s3.exceptions.NoSuchKey:
+        return None
+
+def save_job_state(s3, bucket, key, state):
+    s3.put_object(Bucket=bucket, Key=key, Body=json.dumps(state).encode('utf-8'))
+
+def iter_export_file(mc, export_id, schema):
+    # Stream the export file and yield record batches typed with schema.
+    # The CSV is read block by block from the HTTP response instead of being loaded in memory.
+    with stage('auth'):
+        mc.authenticate()
+    url = f'{mc.host}/bulk/v1/leads/export/{export_id}/file.json'
+    with stage('api_call'):
+        response = requests.get(url, headers={'Authorization': f'Bearer {mc.token}'}, stream=True)
+    response.raise_for_status()
+    response.raw.decode_content = True
+
+    # the file is downloaded while it is parsed : decode includes the transfer
+    try:
+        with stage('decode'):
+            reader = pv.open_csv(
+                response.raw,
+                read_options=pv.ReadOptions(block_size=csv_block_size),
+                convert_options=pv.ConvertOptions(
+                    column_types={field.name: field.type for field in schema},
+                    include_columns=schema.names,
+                    null_values=['', 'null'],
+                    strings_can_be_null=True,
+                ))
+        batches = iter(reader)
+        while True:
+            with stage('decode'):
+                batch = next(batches, None)
+            if batch is None:
+                break
+            count('api_pages')
+            yield batch
+    finally:
+        response.close()
+
+def export_windows(start_date, end_date, max_days=max_window_days):
+    # Split [start_date, end_date) into consecutive windows of at most max_days days
+    start = datetime.strptime(start_date, '%Y-%m-%d')
+    end = datetime.strptime(end_date, '%Y-%m-%d')
+    windows = []
+    while start < end:
+        window_end = min(start + timedelta(days=max_days), end)
+        windows.append({
+            'start_date': start.strftime('%Y-%m-%d'),
+            'end_date_exclusive': window_end.strftime('%Y-%m-%d'),
+            'status': 'Pending',
+            'attempts': 0,
+        })
+        start = window_end
+    return windows
+
+def run_export_schedule(mc, fields, manifest, save_manifest, download, context=None):
+    # Export every window of the manifest with as many jobs queued as Marketo allows, downloading
+    # each finished file (download(window)) while the following jobs are still processing.
+    # Window states : Pending -> Queued (export job enqueued) -> Completed -> Written.
+    # The manifest is saved after every change so a run stopped by the Lambda timeout can resume;
+    # returns True when every window is written or failed.
+    windows = manifest['windows']
+
+    def time_left():
+        return context.get_remaining_time_in_millis() / 1000 if context is not None else float('inf')
+
+    def window_of(key):
+        return next(w for w in windows if (w['start_date'], w['end_date_exclusive']) == key)
+
+    def collect(key, future):
+        window = window_of(key)
+        try:
+            window['output'] = future.result()
+            window['status'] = 'Written'
+        except Exception as e:
+            # the export file stays available : retry the download, not the export
+            print(f"Download of the export of {window['start_date']} failed : {e}")
+            window['download_attempts'] = window.get('download_attempts', 0) + 1
+            window['status'] = 'Completed' if window['download_attempts'] < max_window_attempts else 'Failed'
+
+    with InstrumentedExecutor(max_workers=max_processing_jobs) as executor:
+        downloads = {}
+        while True:
+            # keep the queue full
+            queued = [w for w in windows if w['status'] == 'Queued']
+            for window in [w for w in windows if w['status'] == 'Pending'][:max(0, max_queued_jobs - len(queued))]:
+                if time_left() < handoff_margin:
+                    break
+                try:
+                    window['export_id'] = start_export_job(mc, fields, window['start_date'], window['end_date_exclusive'])
+                except Exception as e:
+                    # the queue is shared with the other exports of the instance and can be full
+                    print(f"Export job of {window['start_date']} not enqueued : {e}")
+                    break
+                window['status'] = 'Queued'
+                window['attempts'] += 1
+                save_manifest(manifest)
+
+            # check the queued jobs and start the download of the completed ones
+            delays = []
+            for window in [w for w in windows if w['status'] == 'Queued']:
+                with stage('api_call'):
+                    job_status = mc.execute(method='get_leads_export_job_status', job_id=window['export_id'])[0]
+                if job_status['status'] == 'Completed':
+                    window['status'] = 'Completed'
+                    save_manifest(manifest)
+                elif job_status['status'] in terminal_statuses:
+                    print(f"Export job {window['export_id']} of {window['start_date']} ended with status {job_status['status']}")
+                    window['status'] = 'Pending' if window['attempts'] < max_window_attempts else 'Failed'
+                    save_manifest(manifest)
+                else:
+                    delays.append(next_poll_delay(job_status))
+
+            for window in windows:
+                key = (window['start_date'], window['end_date_exclusive'])
+                if window['status'] == 'Completed' and key not in downloads:
+                    downloads[key] = executor.submit(download, window)
+
+            for key, future in list(downloads.items()):
+                if future.done():
+                    collect(key, future)
+                    del downloads[key]
+                    save_manifest(manifest)
+
+            if all(w['status'] in ('Written', 'Failed') for w in windows):
+                return True
+
+            delay = min(delays) if delays else min_poll_delay
+            if time_left() - delay < handoff_margin:
+                # let the running downloads finish, the queued jobs are resumed by the next run
+                for key, future in downloads.items():
+                    collect(key, future)
+                save_manifest(manifest)
+                return False
+
+            with stage('export_wait'):
+                time.sleep(delay)
@@ -0,0 +1,28 @@
+import os
+import boto3
+from raw_compaction import sources, compact_source
+from lambda_metrics import instrumented
+
+s3 = boto3.client('s3')
+glue = boto3.client('glue')
+athena = boto3.client('athena')
+
+raw_bucket = os.environ['RAW_BUCKET']
+output_bucket = os.environ['OUTPUT_BUCKET']
+database = os.environ['DATABASE']
+athena_output = os.environ['ATHENA_OUTPUT']
+
+@instrumented('raw-compaction')
+def lambda_handler(event, context):
+    # Compact the closed months of the daily raw files (all sources by default) into monthly files
+    results = {}
+    for source_name in event.get('sources', list(sources)):
+        results[source_name] = compact_source(
+            s3, glue, athena, raw_bucket, output_bucket, database, f's3://{athena_output}/compaction/',
+            source_name, context)
+        print(f'{source_name} : {results[source_name]}')
+
+    return {
+        'statusCode': 200,
+        'body': results
+    }
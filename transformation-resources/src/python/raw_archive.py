@@ -0,0 +1,63 @@
+import os
+import json
+import hashlib
+import threading
+import pyarrow as pa
+from datalake_paths import partition_key
+from lambda_metrics import stage, count
+
+# Archive of the raw API responses. The pages read by the ingestion functions are kept as JSON
+# lines compressed with zstd in the archive bucket, which has no expiration, so the raw files can
+# be rebuilt after a change of the transformation by replaying the archive instead of querying
+# the APIs again. An archive file holds the pages of one source, view and date; its name ends with
+# a hash of the requests sent, so a replay never reads pages of other report definitions.
+# The files can be read with `zstd -dc <file> | head`.
+
+# Archiving is enabled when the function has an archive bucket
+archive_bucket = os.environ.get('ARCHIVE_BUCKET')
+
+compression = 'zstd'
+
+def spec_hash(spec):
+    return hashlib.sha256(json.dumps(spec, sort_keys=True).encode('utf-8')).hexdigest()[:12]
+
+def archive_key(source, dt, spec, **partitions):
+    # ex. google-analytics/stats/view_id=1/year=2022/month=03/day=10/stats_2022-03-10_<hash>.jsonl.zst
+    name = source.split('/')[-1]
+    return partition_key(source, dt, f'{name}_{dt}_{spec_hash(spec)}.jsonl.zst', **partitions)
+
+class ArchiveWriter:
+    # Records (JSON objects) are compressed as they are written, from any thread; the file is
+    # uploaded with a single put_object on close, empty when the API returned nothing so the
+    # replay of the date finds it
+    def __init__(self, s3, bucket, key):
+        self.s3 = s3
+        self.bucket = bucket
+        self.key = key
+        self.buffer = pa.BufferOutputStream()
+        self.stream = pa.CompressedOutputStream(self.buffer, compression)
+        self.lock = threading.Lock()
+
+    def write(self, record):
+        line = (json.dumps(record, separators=(',', ':')) + '\n').encode('utf-8')
+        with self.lock:
+            self.stream.write(line)
+
+    def close(self):
+        with self.lock:
+            self.stream.close()
+            data = self.buffer.getvalue()
+        with stage('s3_upload'):
+            self.s3.put_object(Bucket=self.bucket, Key=self.key, Body=pa.BufferReader(data))
+        count('archive_bytes', data.size)
+        return self.key
+
+def read_archive(s3, bucket, key):
+    # Records of an archive file, in the order they were written
+    if bucket is None:
+        raise ValueError("No archive bucket to replay from : set the ARCHIVE_BUCKET environment variable")
+    with stage('archive_read'):
+        body = s3.get_object(Bucket=bucket, Key=key)['Body'].read()
+        data = pa.CompressedInputStream(pa.BufferReader(body), compression).read()
+    for line in data.splitlines():
+        yield json.loads(line)
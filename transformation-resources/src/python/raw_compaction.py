@@ -0,0 +1,265 @@
+import io
+import json
+import time
+from datetime import date, timedelta
+import pyarrow as pa
+import pyarrow.compute as pc
+import pyarrow.parquet as pq
+from s3_parquet_sink import S3ParquetSink
+from s3_bulk_delete import delete_keys
+from lambda_metrics import stage, count
+from arrow_schemas import delta_encoding
+
+# Compaction of the daily raw files into one file per month (and view), sorted by date and key.
+# The monthly files and the state are written to the standardized bucket : the raw bucket expires
+# its objects, the daily files of the compacted sources excepted.
+#
+# Readers query a view (ex. google_analytics_stats) that reads the monthly table up to the
+# compaction boundary and the daily table after it. A month is swapped in three steps :
+#   1. the monthly file is written (a single S3 object, replaced atomically on rerun)
+#   2. the boundary is saved and the view is replaced, so readers move from the daily files to
+#      the complete monthly file in one catalog update
+#   3. the daily files of the month are deleted, by key : a daily file written during the
+#      compaction is not deleted with them
+# Daily files found in a month at or before the saved boundary (written by a backfill or a replay
+# after the compaction of the month, or left by a run stopped after the swap) are merged into the
+# monthly file : their days are replaced by their rows, then they are deleted. Until then the
+# views read the month as it was compacted.
+
+# Row groups of the monthly files, large enough for Athena to read them efficiently
+row_group_rows = 1000000
+
+# A month is compacted once this number of days have passed since its end, so late daily runs
+# and reruns are in the monthly file
+grace_days = 3
+
+sources = {
+    'google-analytics-stats': {
+        'prefix': 'google-analytics/stats',
+        'monthly_prefix': 'google-analytics/stats-monthly',
+        'view': 'google_analytics_stats',
+        'partitions': ['view_id'],
+        'sort_by': ['date_hour', 'segment', 'source_medium'],
+        'compression': 'snappy',
+        'column_encoding': delta_encoding('date_hour'),
+    },
+    'google-analytics-forms': {
+        'prefix': 'google-analytics/forms',
+        'monthly_prefix': 'google-analytics/forms-monthly',
+        'view': 'google_analytics_forms',
+        'partitions': ['view_id'],
+        'sort_by': ['date_hour', 'filter'],
+        'compression': 'snappy',
+        'column_encoding': delta_encoding('date_hour'),
+    },
+    'marketo-activity': {
+        'prefix': 'marketo/activity',
+        'monthly_prefix': 'marketo/activity-monthly',
+        'view': 'marketo_activity',
+        'partitions': [],
+        'sort_by': ['activityDate', 'id'],
+        'compression': 'zstd',
+        'column_encoding': delta_encoding('activityDate'),
+    },
+}
+
+def list_folders(s3, bucket, prefix):
+    # Names of the folders directly under prefix (ex. ['view_id=147595912'])
+    names = []
+    for page in s3.get_paginator('list_objects_v2').paginate(Bucket=bucket, Prefix=prefix, Delimiter='/'):
+        names += [p['Prefix'][len(prefix):].rstrip('/') for p in page.get('CommonPrefixes', [])]
+    return names
+
+def list_keys(s3, bucket, prefix):
+    keys = []
+    for page in s3.get_paginator('list_objects_v2').paginate(Bucket=bucket, Prefix=prefix):
+        keys += [o['Key'] for o in page.get('Contents', [])]
+    return keys
+
+def partition_folders(s3, bucket, prefix, names):
+    # [(folder, {name: value})] for every combination of the partitions names found under prefix
+    folders = [(prefix + '/', {})]
+    for name in names:
+        folders = [
+            (f'{folder}{sub}/', dict(values, **{name: sub.split('=', 1)[1]}))
+            for folder, values in folders
+            for sub in list_folders(s3, bucket, folder) if sub.startswith(f'{name}=')
+        ]
+    return folders
+
+def daily_months(s3, bucket, source):
+    # {'YYYY-MM': [(month folder, partition values)]} of the months that have daily files
+    months = {}
+    for folder, values in partition_folders(s3, bucket, source['prefix'], source['partitions'] + ['year', 'month']):
+        month = f"{values.pop('year')}-{values.pop('month')}"
+        months.setdefault(month, []).append((folder, values))
+    return months
+
+def is_closed(month, today=None):
+    year, month_number = int(month[0:4]), int(month[5:7])
+    next_month = date(year + month_number // 12, month_number % 12 + 1, 1)
+    return (today or date.today()) >= next_month + timedelta(days=grace_days)
+
+def sort_table(table, sort_by):
+    # Dictionary columns (ex. filter) are sorted on their values
+    keys = {}
+    for name in sort_by:
+        column = table[name]
+        keys[name] = column.cast(column.type.value_type) if pa.types.is_dictionary(column.type) else column
+    return table.take(pc.sort_indices(pa.table(keys), sort_keys=[(name, 'ascending') for name in sort_by]))
+
+def prepare_day(table, day, sort_by):
+    # The day partition becomes a column of the monthly file
+    table = table.append_column('day', pa.array([day] * table.num_rows, pa.int32()))
+    return sort_table(table, sort_by)
+
+def day_of_key(key):
+    return int(key.split('/day=')[1].split('/')[0])
+
+def monthly_key(source, month, values):
+    folders = [f'{name}={values[name]}' for name in source['partitions']]
+    name = source['prefix'].split('/')[-1]
+    return '/'.join([source['monthly_prefix']] + folders + [f'year={month[0:4]}', f'month={month[5:7]}', f'{name}_{month}.parquet'])
+
+def compact_month(s3, bucket, output_bucket, source, daily_keys, key):
+    # Write the daily files of the month, day by day, into the monthly file
+    sink = S3ParquetSink(s3, output_bucket, key, compression=source['compression'], row_group_rows=row_group_rows,
+                         column_encoding=source['column_encoding'])
+    try:
+        for daily_key in sorted(daily_keys, key=day_of_key):
+            table = pq.read_table(io.BytesIO(s3.get_object(Bucket=bucket, Key=daily_key)['Body'].read()))
+            sink.write(prepare_day(table, day_of_key(daily_key), source['sort_by']))
+        return sink.close()
+    finally:
+        sink.abort()
+
+def merge_month(s3, bucket, output_bucket, source, daily_keys, key):
+    # Rewrite the monthly file with the rows of the days of the daily files replaced by their rows.
+    # The monthly file is sorted by day : its row groups are read in order and the late days are
+    # written at their place.
+    try:
+        body = s3.get_object(Bucket=output_bucket, Key=key)['Body'].read()
+    except s3.exceptions.NoSuchKey:
+        return compact_month(s3, bucket, output_bucket, source, daily_keys, key)
+
+    late = {}
+    for daily_key in daily_keys:
+        late.setdefault(day_of_key(daily_key), []).append(daily_key)
+    pending = sorted(late)
+    sink = S3ParquetSink(s3, output_bucket, key, compression=source['compression'], row_group_rows=row_group_rows,
+                         column_encoding=source['column_encoding'])
+
+    def write_late_days(before):
+        while pending and pending[0] < before:
+            day = pending.pop(0)
+            for daily_key in late[day]:
+                table = pq.read_table(io.BytesIO(s3.get_object(Bucket=bucket, Key=daily_key)['Body'].read()))
+                sink.write(prepare_day(table, day, source['sort_by']))
+
+    monthly = pq.ParquetFile(io.BytesIO(body))
+    try:
+        for i in range(monthly.num_row_groups):
+            table = monthly.read_row_group(i)
+            days = table['day']
+            for day in sorted(pc.unique(days).to_pylist()):
+                write_late_days(day)
+                if day not in late:
+                    sink.write(table.filter(pc.equal(days, day)))
+        write_late_days(32)
+        return sink.close()
+    finally:
+        sink.abort()
+
+def delete_files(s3, bucket, keys):
+    # files left by a failed deletion are deleted by the next run (the month is before the boundary)
+    summary = delete_keys(s3, bucket, keys)
+    if summary['errors']:
+        raise RuntimeError(f"{len(summary['errors'])} daily files could not be deleted : {summary['errors'][:5]}")
+
+def load_state(s3, bucket, key):
+    try:
+        return json.loads(s3.get_object(Bucket=bucket, Key=key)['Body'].read())
+    except s3.exceptions.NoSuchKey:
+        return {'boundary': None}
+
+def save_state(s3, bucket, key, state):
+    s3.put_object(Bucket=bucket, Key=key, Body=json.dumps(state).encode('utf-8'))
+
+def run_query(athena, query, database, output_location):
+    # Run an Athena query and wait for it, polling with an increasing delay
+    with stage('athena_submit'):
+        execution_id = athena.start_query_execution(
+            QueryString=query,
+            QueryExecutionContext={'Database': database},
+            ResultConfiguration={'OutputLocation': output_location})['QueryExecutionId']
+    count('queries')
+    delay = 0.5
+    with stage('athena_wait'):
+        while True:
+            status = athena.get_query_execution(QueryExecutionId=execution_id)['QueryExecution']['Status']
+            if status['State'] == 'SUCCEEDED':
+                return execution_id
+            if status['State'] in ('FAILED', 'CANCELLED'):
+                raise RuntimeError(f"Query {execution_id} {status['State']} : {status.get('StateChangeReason')}")
+            time.sleep(delay)
+            delay = min(delay * 2, 5)
+
+def view_query(source_name, source, columns, boundary):
+    # Monthly files up to the boundary month (included), daily files after it
+    year, month = (int(boundary[0:4]), int(boundary[5:7])) if boundary else (0, 0)
+    select = ', '.join(f'"{c}"' for c in columns + source['partitions'] + ['year', 'month', 'day'])
+    return (
+        f'CREATE OR REPLACE VIEW {source["view"]} AS\n'
+        f'SELECT {select} FROM "{source_name}-monthly"\n'
+        f'WHERE year < {year} OR (year = {year} AND month <= {month})\n'
+        f'UNION ALL\n'
+        f'SELECT {select} FROM "{source_name}"\n'
+        f'WHERE year > {year} OR (year = {year} AND month > {month})'
+    )
+
+def table_columns(glue, database, table_name):
+    table = glue.get_table(DatabaseName=database, Name=table_name)['Table']
+    return [c['Name'] for c in table['StorageDescriptor']['Columns']]
+
+def compact_source(s3, glue, athena, bucket, output_bucket, database, output_location, source_name, context=None, margin=120):
+    # Compact the closed months of the daily files of bucket in order into output_bucket, moving
+    # the view boundary after each month. Stops before the Lambda timeout; the next run continues
+    # with the following months.
+    source = sources[source_name]
+    state_key = f"{source['monthly_prefix']}/_compaction/state.json"
+    state = load_state(s3, output_bucket, state_key)
+    columns = table_columns(glue, database, source_name)
+
+    def replace_view():
+        run_query(athena, view_query(source_name, source, columns, state['boundary']), database, output_location)
+
+    # the view is replaced on every run : it is created by the first run and repaired after a failure
+    replace_view()
+
+    compacted, merged = [], []
+    for month, folders in sorted(daily_months(s3, bucket, source).items()):
+        if context is not None and context.get_remaining_time_in_millis() / 1000 < margin:
+            break
+        if state['boundary'] is not None and month <= state['boundary']:
+            # late daily files of a compacted month
+            for folder, values in folders:
+                keys = list_keys(s3, bucket, folder)
+                if keys:
+                    merge_month(s3, bucket, output_bucket, source, keys, monthly_key(source, month, values))
+                    delete_files(s3, bucket, keys)
+            merged.append(month)
+            continue
+        if not is_closed(month):
+            break
+
+        daily_keys = [list_keys(s3, bucket, folder) for folder, _ in folders]
+        for (folder, values), keys in zip(folders, daily_keys):
+            compact_month(s3, bucket, output_bucket, source, keys, monthly_key(source, month, values))
+        state['boundary'] = month
+        save_state(s3, output_bucket, state_key, state)
+        replace_view()
+        for keys in daily_keys:
+            delete_files(s3, bucket, keys)
+        compacted.append(month)
+
+    return {'boundary': state['boundary'], 'compacted': compacted, 'merged': merged}
@@ -0,0 +1,153 @@
+import json
+import time
+import hashlib
+from botocore.exceptions import ClientError
+
+# Reuse of the results of the dashboard queries. A query is identified by the hash of its SQL text
+# and of the fingerprint of its input files : the same SQL over the same files gives the same
+# result, so a rerun or backfill copies the earlier result file instead of running the query again.
+# The index is a single S3 object keeping the most recently used entries, with the savings. It is
+# written with a conditional put : when another invocation saved it in the meantime (ex. the
+# schedule and a manual run), the index is read again and the changes of this invocation are
+# applied to it before retrying, so neither invocation loses its entries.
+
+index_key = 'dashboard/_result_cache/index.json'
+
+# Entries kept in the index, the least recently used ones are evicted first
+max_entries = 2000
+
+# Conditional puts of the index before giving up
+max_save_attempts = 5
+
+# Errors of a conditional put when the index changed since it was read
+conflict_codes = ('PreconditionFailed', 'ConditionalRequestConflict')
+
+counters = ('hits', 'bytes_saved', 'dollars_saved')
+
+# Athena price per TB scanned, with a minimum of 10 MB per query
+price_per_tb = 5.0
+min_billed_bytes = 10 << 20
+
+def cache_key(query, fingerprint):
+    return hashlib.sha256(f'{query}\n{fingerprint}'.encode('utf-8')).hexdigest()
+
+def query_cost(bytes_scanned):
+    return max(bytes_scanned, min_billed_bytes) / 10**12 * price_per_tb
+
+class ResultCache:
+    # Loaded at the start of an invocation and saved at its end
+    def __init__(self, s3, athena, bucket):
+        self.s3 = s3
+        self.athena = athena
+        self.bucket = bucket
+        self.load()
+        # changes of this invocation : entries added or updated (None when dropped), and counter increments
+        self.updates = {}
+        self.increments = {name: 0 for name in counters}
+        self.changed = False
+
+    def load(self):
+        # Index and its ETag, None when there is no index yet
+        try:
+            response = self.s3.get_object(Bucket=self.bucket, Key=index_key)
+        except self.s3.exceptions.NoSuchKey:
+            self.index = {'entries': {}, 'hits': 0, 'bytes_saved': 0, 'dollars_saved': 0.0}
+            self.etag = None
+        else:
+            self.index = json.loads(response['Body'].read())
+            self.etag = response['ETag']
+
+    def update(self, key, entry):
+        if entry is None:
+            self.index['entries'].pop(key, None)
+        else:
+            self.index['entries'][key] = entry
+        self.updates[key] = entry
+        self.changed = True
+
+    def drop(self, key):
+        self.update(key, None)
+
+    def lookup(self, key):
+        # Entry of a succeeded query whose result file still exists, or None
+        entry = self.index['entries'].get(key)
+        if entry is None:
+            return None
+
+        if 'bytes_scanned' not in entry:
+            # entries are added when the query starts : its state is checked on the first hit
+            try:
+                execution = self.athena.get_query_execution(QueryExecutionId=entry['execution_id'])['QueryExecution']
+            except ClientError:
+                # query history expired
+                self.drop(key)
+                return None
+            state = execution['Status']['State']
+            if state in ('FAILED', 'CANCELLED'):
+                self.drop(key)
+            if state != 'SUCCEEDED':
+                return None
+            entry['bytes_scanned'] = execution.get('Statistics', {}).get('DataScannedInBytes', 0)
+            self.update(key, entry)
+
+        try:
+            self.s3.head_object(Bucket=self.bucket, Key=entry['result_key'])
+        except ClientError as e:
+            if e.response['ResponseMetadata'].get('HTTPStatusCode') != 404:
+                raise
+            # result deleted (ex. output truncated)
+            self.drop(key)
+            return None
+        return entry
+
+    def add(self, key, execution_id, result_key):
+        self.update(key, {'execution_id': execution_id, 'result_key': result_key, 'last_used': time.time()})
+
+    def count(self, name, value):
+        self.index[name] += value
+        self.increments[name] += value
+
+    def reuse(self, key, entry, result_key):
+        # Count a hit; the entry points to the copy at result_key from now on
+        entry['result_key'] = result_key
+        entry['last_used'] = time.time()
+        self.update(key, entry)
+        self.count('hits', 1)
+        self.count('bytes_saved', entry['bytes_scanned'])
+        self.count('dollars_saved', query_cost(entry['bytes_scanned']))
+        print(f"Reused the result of {entry['execution_id']} ({entry['bytes_scanned']} bytes) : "
+              f"{self.index['hits']} hits, {self.index['bytes_saved']} bytes and ${self.index['dollars_saved']:.4f} saved so far")
+
+    def reapply(self):
+        # Read the index saved by another invocation and apply the changes of this one to it
+        self.load()
+        for key, entry in self.updates.items():
+            if entry is None:
+                self.index['entries'].pop(key, None)
+            else:
+                self.index['entries'][key] = entry
+        for name, value in self.increments.items():
+            self.index[name] += value
+
+    def save(self):
+        if not self.changed:
+            return
+        for attempt in range(max_save_attempts):
+            entries = self.index['entries']
+            if len(entries) > max_entries:
+                for key in sorted(entries, key=lambda k: entries[k]['last_used'])[:len(entries) - max_entries]:
+                    del entries[key]
+            # only written over the index that was read, or created when there was none
+            condition = {'IfMatch': self.etag} if self.etag else {'IfNoneMatch': '*'}
+            try:
+                response = self.s3.put_object(Bucket=self.bucket, Key=index_key, Body=json.dumps(self.index).encode('utf-8'), **condition)
+            except ClientError as e:
+                if e.response['Error']['Code'] not in conflict_codes or attempt == max_save_attempts - 1:
+                    raise
+                self.reapply()
+            else:
+                self.etag = response['ETag']
+                break
+        self.updates = {}
+        self.increments = {name: 0 for name in counters}
+        self.changed = False
@@ -0,0 +1,36 @@
+from concurrent.futures import ThreadPoolExecutor
+
+# Deletion of many S3 objects : keys are deleted with delete_objects in batches of 1000 (the API
+# maximum) sent concurrently, instead of one request per object
+
+batch_size = 1000
+max_workers = 8
+
+def delete_batch(s3, bucket, keys):
+    # Errors of the keys that could not be deleted : [{'Key', 'Code', 'Message'}]
+    response = s3.delete_objects(Bucket=bucket, Delete={'Objects': [{'Key': k} for k in keys], 'Quiet': True})
+    return response.get('Errors', [])
+
+def delete_keys(s3, bucket, keys, max_workers=max_workers):
+    # Returns {'deleted': number of keys deleted, 'errors': [{'Key', 'Code', 'Message'}]}
+    batches = [keys[offset:offset + batch_size] for offset in range(0, len(keys), batch_size)]
+    with ThreadPoolExecutor(max_workers=max_workers) as executor:
+        errors = [e for batch_errors in executor.map(lambda batch: delete_batch(s3, bucket, batch), batches) for e in batch_errors]
+    return {'deleted': len(keys) - len(errors), 'errors': errors}
+
+def delete_prefix(s3, bucket, prefix, keep=(), max_workers=max_workers):
+    # Delete the objects under prefix, except the keys in keep. Each listed page (1000 keys) is
+    # deleted while the next one is listed. Returns the same summary as delete_keys.
+    futures = []
+    nb_keys = 0
+    with ThreadPoolExecutor(max_workers=max_workers) as executor:
+        for page in s3.get_paginator('list_objects_v2').paginate(Bucket=bucket, Prefix=prefix):
+            keys = [o['Key'] for o in page.get('Contents', []) if o['Key'] not in keep]
+            if keys:
+                nb_keys += len(keys)
+                futures.append(executor.submit(delete_batch, s3, bucket, keys))
+        errors = [e for future in futures for e in future.result()]
+
+    summary = {'deleted': nb_keys - len(errors), 'errors': errors}
+    print(f"Deleted {summary['deleted']} objects under s3://{bucket}/{prefix}" + (f", {len(errors)} errors : {errors[:5]}" if errors else ''))
+    return summary
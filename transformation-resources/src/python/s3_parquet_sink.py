@@ -0,0 +1,192 @@
+import time
+import threading
+import pyarrow as pa
+import pyarrow.parquet as pq
+from lambda_metrics import stage, count
+from arrow_schemas import conform
+
+# Parquet writer streaming its row groups straight to S3 with a multipart upload, shared by the
+# ingestion Lambda functions
+
+# Size of the multipart upload parts (S3 minimum is 5 MB, except for the last part)
+part_size = 8 << 20
+
+default_compression = 'snappy'
+
+class S3PartStream:
+    # Writable file object for pq.ParquetWriter. Written bytes are appended to an Arrow buffer and
+    # every part_size bytes the buffer is handed to upload_part without being copied to bytes.
+    # Files smaller than one part are sent with a single put_object on complete().
+    def __init__(self, s3, bucket, key, part_size=part_size):
+        self.s3 = s3
+        self.bucket = bucket
+        self.key = key
+        self.part_size = part_size
+        self.buffer = pa.BufferOutputStream()
+        self.upload_id = None
+        self.parts = []
+        self.position = 0
+        self.closed = False
+        self.aborted = False
+
+    def write(self, data):
+        # the parquet writer of an aborted upload still writes its footer when it is garbage collected
+        if self.aborted:
+            return len(data)
+        self.buffer.write(data)
+        self.position += len(data)
+        if self.buffer.tell() >= self.part_size:
+            self.upload_part()
+        return len(data)
+
+    def tell(self):
+        return self.position
+
+    def writable(self):
+        return True
+
+    def flush(self):
+        pass
+
+    def close(self):
+        # called by the parquet writer; the upload itself is finished by complete()
+        self.closed = True
+
+    def upload_part(self):
+        with stage('s3_upload'):
+            self.send_part()
+
+    def send_part(self):
+        data = self.buffer.getvalue()
+        self.buffer = pa.BufferOutputStream()
+        if self.upload_id is None:
+            self.upload_id = self.s3.create_multipart_upload(Bucket=self.bucket, Key=self.key)['UploadId']
+        part_number = len(self.parts) + 1
+        response = self.s3.upload_part(
+            Bucket=self.bucket, Key=self.key, UploadId=self.upload_id,
+            PartNumber=part_number, Body=pa.BufferReader(data))
+        self.parts.append({'PartNumber': part_number, 'ETag': response['ETag']})
+
+    def complete(self):
+        with stage('s3_upload'):
+            if self.upload_id is None:
+                self.s3.put_object(Bucket=self.bucket, Key=self.key, Body=pa.BufferReader(self.buffer.getvalue()))
+                return
+            if self.buffer.tell() > 0:
+                self.send_part()
+            self.s3.complete_multipart_upload(
+                Bucket=self.bucket, Key=self.key, UploadId=self.upload_id,
+                MultipartUpload={'Parts': self.parts})
+            self.upload_id = None
+
+    def abort(self):
+        self.aborted = True
+        if self.upload_id is not None:
+            self.s3.abort_multipart_upload(Bucket=self.bucket, Key=self.key, UploadId=self.upload_id)
+            self.upload_id = None
+
+def column_paths(schema):
+    # Parquet paths of the leaf columns of schema (ex. attributes.list.element.name)
+    def paths(name, type):
+        if pa.types.is_struct(type):
+            return [p for field in type for p in paths(f'{name}.{field.name}', field.type)]
+        if pa.types.is_list(type) or pa.types.is_large_list(type):
+            return paths(f'{name}.list.element', type.value_type)
+        return [name]
+    return [p for field in schema for p in paths(field.name, field.type)]
+
+class S3ParquetSink:
+    # Incremental parquet writer to S3. Pages (tables or record batches) are conformed to schema when
+    # one is given (arrow_schemas.conform) and written as row groups : one per page, or pages grouped until row_group_rows rows.
+    # Pages can be written from several threads. Nothing is uploaded when no page was written.
+    def __init__(self, s3, bucket, key, schema=None, compression=default_compression,
+                 row_group_rows=None, use_dictionary=True, column_encoding=None, part_size=part_size):
+        self.s3 = s3
+        self.bucket = bucket
+        self.key = key
+        self.schema = schema
+        self.compression = compression
+        self.row_group_rows = row_group_rows
+        self.use_dictionary = use_dictionary
+        self.column_encoding = column_encoding
+        self.stream = S3PartStream(s3, bucket, key, part_size)
+        self.writer = None
+        self.pending = []
+        self.nb_rows = 0
+        self.started = None
+        self.lock = threading.Lock()
+
+    def write(self, page):
+        with stage('parquet_encode'):
+            self.write_page(page)
+
+    def write_page(self, page):
+        if isinstance(page, pa.RecordBatch):
+            page = pa.Table.from_batches([page])
+        if self.schema is not None:
+            page = conform(page, self.schema)
+        with self.lock:
+            try:
+                if self.row_group_rows is None:
+                    self.write_row_group(page)
+                else:
+                    self.pending.append(page)
+                    if sum(p.num_rows for p in self.pending) >= self.row_group_rows:
+                        self.write_pending()
+            except Exception:
+                self.stream.abort()
+                raise
+            self.nb_rows += page.num_rows
+
+    def write_row_group(self, table):
+        if self.writer is None:
+            self.started = time.perf_counter()
+            use_dictionary = self.use_dictionary
+            if self.column_encoding and use_dictionary is True:
+                # columns with their own encoding (ex. delta) must not be dictionary encoded
+                use_dictionary = [p for p in column_paths(table.schema) if p.split('.')[0] not in self.column_encoding]
+            self.writer = pq.ParquetWriter(
+                self.stream, table.schema, compression=self.compression, use_dictionary=use_dictionary,
+                column_encoding=self.column_encoding)
+        # pages with different dictionaries in a row group would be written without dictionary encoding
+        self.writer.write_table(table.unify_dictionaries(), row_group_size=max(table.num_rows, 1))
+
+    def write_pending(self):
+        if self.pending:
+            self.write_row_group(pa.concat_tables(self.pending))
+            self.pending = []
+
+    def close(self, metadata=None):
+        # Finish the upload and return {'key', 'rows', 'bytes', 'seconds', 'mb_per_second'},
+        # or None when nothing was written. metadata ({str: str}) is added to the file footer.
+        with self.lock, stage('parquet_encode'):
+            try:
+                self.write_pending()
+                if self.writer is None:
+                    return None
+                if metadata:
+                    self.writer.add_key_value_metadata(metadata)
+                self.writer.close()
+                self.stream.complete()
+            except Exception:
+                self.stream.abort()
+                raise
+
+        seconds = time.perf_counter() - self.started
+        stats = {
+            'key': self.key,
+            'rows': self.nb_rows,
+            'bytes': self.stream.position,
+            'seconds': round(seconds, 3),
+            'mb_per_second': round(self.stream.position / 2**20 / seconds, 2) if seconds > 0 else None,
+        }
+        count('rows', stats['rows'])
+        count('output_bytes', stats['bytes'])
+        print(f"Wrote s3://{self.bucket}/{self.key} : {stats['rows']} rows, {stats['bytes']} bytes in {stats['seconds']}s ({stats['mb_per_second']} MB/s)")
+        return stats
+
+    def abort(self):
+        # Abort the multipart upload of a file that will not be closed (ex. the function failed
+        # between two pages), so its parts are not left in the bucket; nothing to do once closed
+        with self.lock:
+            self.stream.abort()
@@ -0,0 +1,39 @@
+import re
+
+# SQL templates with placeholders (ex. QUERY_DATE) written as plain words in the query.
+# A template is split once into literal parts and placeholder names; rendering fills every
+# placeholder in a single pass, so a value is never replaced again by a following placeholder.
+
+class TemplateError(ValueError):
+    pass
+
+def placeholder_pattern(name):
+    # Placeholders starting or ending with a word character must not be part of a longer word
+    start = r'(?<!\w)' if re.match(r'\w', name[0]) else ''
+    end = r'(?!\w)' if re.match(r'\w', name[-1]) else ''
+    return start + re.escape(name) + end
+
+class Template:
+    def __init__(self, text, placeholders):
+        # placeholders : every name that can be filled in; longer names are matched first
+        self.vocabulary = frozenset(placeholders)
+        names = sorted(self.vocabulary, key=len, reverse=True)
+        if names:
+            pattern = re.compile('(' + '|'.join(placeholder_pattern(n) for n in names) + ')')
+            self.parts = pattern.split(text)
+        else:
+            self.parts = [text]
+        # literals are at even indexes, placeholder names at odd indexes
+        self.placeholders = frozenset(self.parts[1::2])
+
+    def render(self, values):
+        unknown = set(values) - self.vocabulary
+        if unknown:
+            raise TemplateError(f"Unknown placeholders {sorted(unknown)}")
+        unfilled = self.placeholders - set(values)
+        if unfilled:
+            raise TemplateError(f"Placeholders without a value {sorted(unfilled)}")
+
+        parts = list(self.parts)
+        parts[1::2] = [values[name] for name in parts[1::2]]
+        return ''.join(parts)
@@ -0,0 +1,49 @@
+import time
+import random
+import threading
+from lambda_metrics import stage, count
+
+class QuotaExhausted(Exception):
+    # The API answered that a daily quota is used up : the following calls fail until the next day
+    pass
+
+class TokenBucket:
+    # Thread-safe token bucket: refills `rate` tokens per second up to `capacity` (the allowed burst).
+    # Buckets live for one invocation : daily quotas are left to the API, which reports them.
+    def __init__(self, rate, capacity=1):
+        self.rate = float(rate)
+        self.capacity = float(capacity)
+        self.tokens = float(capacity)
+        self.last_refill = time.monotonic()
+        self.lock = threading.Lock()
+
+    def acquire(self):
+        while True:
+            with self.lock:
+                now = time.monotonic()
+                self.tokens = min(self.capacity, self.tokens + (now - self.last_refill) * self.rate)
+                self.last_refill = now
+
+                if self.tokens >= 1:
+                    self.tokens -= 1
+                    return
+                wait = (1 - self.tokens) / self.rate
+            time.sleep(wait)
+
+def retry(call, is_retryable, max_attempts=6, base_delay=1, max_delay=60, limiter=None):
+    # Run call(), retrying errors accepted by is_retryable with exponential backoff and full jitter.
+    # The limiter (ex. TokenBucket) is acquired before every attempt.
+    for attempt in range(max_attempts):
+        if limiter is not None:
+            with stage('throttle_wait'):
+                limiter.acquire()
+        try:
+            return call()
+        except Exception as e:
+            if attempt == max_attempts - 1 or not is_retryable(e):
+                raise
+            delay = random.uniform(0, min(max_delay, base_delay * 2 ** attempt))
+            print(f"Retrying in {delay:.1f}s after error : {e}")
+            count('retries')
+            with stage('throttle_wait'):
+                time.sleep(delay)
@@ -0,0 +1,85 @@
+from datetime import datetime
+from s3_bulk_delete import delete_prefix
+
+# Outputs replaced without deleting them first : each run writes its result to a new version folder
+# and the location of the Glue table is moved to it once the query succeeded, so readers switch
+# from the previous result to the new one in one catalog update. The previous version is kept for
+# the queries still reading it, older versions are deleted after the switch.
+
+versions_prefix = 'dashboard/_versions'
+
+# Athena result types -> types of the table columns (the CSV results are read with OpenCSVSerde)
+column_types = {
+    'varchar': 'string',
+    'char': 'string',
+    'integer': 'int',
+    'tinyint': 'tinyint',
+    'smallint': 'smallint',
+    'bigint': 'bigint',
+    'real': 'float',
+    'float': 'float',
+    'double': 'double',
+    'boolean': 'boolean',
+    'date': 'date',
+}
+
+def new_version():
+    return datetime.utcnow().strftime('v%Y%m%d%H%M%S')
+
+def version_prefix(output_path, version):
+    return f'{versions_prefix}/{output_path}/{version}/'
+
+def table_name(output_path):
+    # same name as the tables of the dashboard crawler
+    return 'dashboard_' + output_path.replace('/', '_')
+
+def result_columns(athena, execution_id):
+    info = athena.get_query_results(QueryExecutionId=execution_id, MaxResults=1)['ResultSet']['ResultSetMetadata']['ColumnInfo']
+    columns = []
+    for column in info:
+        if column['Type'] == 'decimal':
+            column_type = f"decimal({column['Precision']},{column['Scale']})"
+        else:
+            # timestamps are read as strings : OpenCSVSerde only reads them as numbers
+            column_type = column_types.get(column['Type'], 'string')
+        columns.append({'Name': column['Name'], 'Type': column_type})
+    return columns
+
+def table_input(name, location, columns):
+    return {
+        'Name': name,
+        'TableType': 'EXTERNAL_TABLE',
+        'Parameters': {'classification': 'csv', 'skip.header.line.count': '1'},
+        'StorageDescriptor': {
+            'Columns': columns,
+            'Location': location,
+            'InputFormat': 'org.apache.hadoop.mapred.TextInputFormat',
+            'OutputFormat': 'org.apache.hadoop.hive.ql.io.HiveIgnoreKeyTextOutputFormat',
+            'SerdeInfo': {'SerializationLibrary': 'org.apache.hadoop.hive.serde2.OpenCSVSerde'},
+        },
+    }
+
+def delete_result_metadata(s3, bucket, prefix, execution_id):
+    # Athena writes <query id>.csv.metadata next to the result : the table reads every file of its
+    # location and OpenCSVSerde would return this binary file as rows
+    s3.delete_object(Bucket=bucket, Key=f'{prefix}{execution_id}.csv.metadata')
+
+def switch_table(glue, database, name, location, columns):
+    # Point the table to location, creating it on the first switch
+    try:
+        glue.get_table(DatabaseName=database, Name=name)
+    except glue.exceptions.EntityNotFoundException:
+        glue.create_table(DatabaseName=database, TableInput=table_input(name, location, columns))
+    else:
+        glue.update_table(DatabaseName=database, TableInput=table_input(name, location, columns))
+
+def delete_old_versions(s3, bucket, output_path, current):
+    # Delete the versions before the previous one (version names sort by time)
+    prefix = f'{versions_prefix}/{output_path}/'
+    versions = []
+    for page in s3.get_paginator('list_objects_v2').paginate(Bucket=bucket, Prefix=prefix, Delimiter='/'):
+        versions += [p['Prefix'][len(prefix):].rstrip('/') for p in page.get('CommonPrefixes', [])]
+    old = [v for v in sorted(versions) if v < current][:-1]
+    for version in old:
+        delete_prefix(s3, bucket, version_prefix(output_path, version))
+    return old
@@ -0,0 +1,10 @@
+# The tests import the shared modules of the Lambda functions as they are packaged (src/python) and
+# the local stand-ins of the AWS services of the benchmarks (local_aws.py)
+
+import os
+import sys
+
+root = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..')
+for path in (os.path.join(root, 'src', 'python'), os.path.join(root, 'benchmarks')):
+    if path not in sys.path:
+        sys.path.insert(0, path)
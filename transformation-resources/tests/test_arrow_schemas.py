@@ -0,0 +1,65 @@
+from datetime import datetime, timezone
+import pytest
+import pyarrow as pa
+from arrow_schemas import conform, cast_column, parse_strings, schema, delta_encoding, category, utc_timestamp, local_timestamp, leads_schema
+
+def test_conform_keeps_a_table_of_the_schema():
+    table = pa.table({'id': [1, 2]})
+    assert conform(table, table.schema) is table
+
+def test_conform_casts_and_orders_the_columns():
+    page = pa.table({
+        'updatedAt': ['2022-01-01T10:00:00Z', '2022-01-02T10:00:00Z'],
+        'id': pa.array([1, 2], pa.int32()),
+        'leadStatus': ['MQL', 'MQL'],
+        'BU__c': ['BU1', None],
+        'webformRequestMostrecent': [None, 'form'],
+        'SFDCType': ['Lead', 'Contact'],
+        'createdAt': [datetime(2022, 1, 1, tzinfo=timezone.utc)] * 2,
+        'other': [True, False],
+    })
+    table = conform(page, leads_schema)
+    assert table.schema == leads_schema
+    assert table['id'].to_pylist() == [1, 2]
+    assert table['leadStatus'].chunk(0).dictionary.to_pylist() == ['MQL']
+    assert table['BU__c'].to_pylist() == ['BU1', None]
+    assert table['updatedAt'].to_pylist()[1] == datetime(2022, 1, 2, 10, tzinfo=timezone.utc)
+
+def test_conform_rejects_a_missing_column():
+    with pytest.raises(ValueError, match='Column name is missing'):
+        conform(pa.table({'id': [1]}), pa.schema([pa.field('id', pa.int64()), pa.field('name', pa.string())]))
+
+def test_conform_rejects_values_out_of_range():
+    with pytest.raises(ValueError, match='Column sessions can not be stored as int32'):
+        conform(pa.table({'sessions': [1, 2**31]}), pa.schema([pa.field('sessions', pa.int32())]))
+    with pytest.raises(ValueError, match='Column sessions can not be stored as int32'):
+        conform(pa.table({'sessions': ['1', 'a']}), pa.schema([pa.field('sessions', pa.int32())]))
+
+def test_cast_to_dictionaries():
+    strings = cast_column(pa.array(['a', 'b', 'a']), category)
+    assert strings.type == category
+    assert strings.dictionary.to_pylist() == ['a', 'b']
+    integers = cast_column(pa.array([6, 6, 12]), pa.dictionary(pa.int32(), pa.int32()))
+    assert integers.dictionary.to_pylist() == [6, 12]
+    assert integers.to_pylist() == [6, 6, 12]
+
+def test_parse_the_strings_of_the_ga_responses():
+    hours = parse_strings(pa.array(['2022010100', '2022010123']), local_timestamp, '%Y%m%d%H')
+    assert hours.type == local_timestamp
+    assert hours.to_pylist() == [datetime(2022, 1, 1, 0), datetime(2022, 1, 1, 23)]
+    assert parse_strings(pa.array(['20220131']), local_timestamp, '%Y%m%d').to_pylist() == [datetime(2022, 1, 31)]
+    assert parse_strings(pa.array(['12', '3']), pa.int32()).to_pylist() == [12, 3]
+    assert parse_strings(pa.array(['1.5']), pa.float64()).to_pylist() == [1.5]
+
+def test_schemas_of_the_sources():
+    stats = schema('google-analytics-stats')
+    assert stats.field('date_hour').type == local_timestamp
+    assert stats.field('segment').type == category
+    assert stats.field('sessions').type == pa.int32()
+    assert schema('marketo-leads') is leads_schema
+    assert schema('marketo-activity').field('activityDate').type == utc_timestamp
+    with pytest.raises(KeyError):
+        schema('unknown')
+
+def test_delta_encoding():
+    assert delta_encoding('date_hour') == {'date_hour': 'DELTA_BINARY_PACKED'}
@@ -0,0 +1,67 @@
+import pytest
+import athena_orchestrator
+from athena_orchestrator import check_jobs, run_jobs
+
+class Athena:
+    # Queries end with the state of their id (ex. 'a-FAILED') at the first poll, SUCCEEDED by default
+    def batch_get_query_execution(self, QueryExecutionIds):
+        return {'QueryExecutions': [{
+            'QueryExecutionId': i,
+            'Status': {'State': 'FAILED' if i.endswith('FAILED') else 'SUCCEEDED'},
+            'Statistics': {'TotalExecutionTimeInMillis': 10, 'DataScannedInBytes': 100},
+        } for i in QueryExecutionIds]}
+
+def test_check_jobs_accepts_a_dependency_graph():
+    check_jobs([{'name': 'a'}, {'name': 'b', 'depends_on': ['a']}, {'name': 'c', 'depends_on': ['a', 'b']}])
+    check_jobs([])
+
+@pytest.mark.parametrize('jobs, message', [
+    ([{'name': 'a'}, {'name': 'a'}], 'Duplicate job names'),
+    ([{'name': 'a', 'depends_on': ['b']}], 'unknown job b'),
+    ([{'name': 'a', 'depends_on': ['b']}, {'name': 'b', 'depends_on': ['a']}, {'name': 'c'}], 'Dependency cycle'),
+    ([{'name': 'a', 'depends_on': ['a']}], 'Dependency cycle'),
+])
+def test_check_jobs_rejects_invalid_graphs(jobs, message):
+    with pytest.raises(ValueError, match=message):
+        check_jobs(jobs)
+
+def test_run_jobs_starts_jobs_after_their_dependencies(monkeypatch):
+    monkeypatch.setattr(athena_orchestrator, 'min_poll_delay', 0)
+    started = []
+
+    def start_query(job):
+        started.append(job['name'])
+        return job.get('execution_id', job['name'])
+
+    jobs = [
+        {'name': 'c', 'depends_on': ['a', 'b']},
+        {'name': 'a'},
+        {'name': 'b', 'execution_id': 'b-FAILED'},
+        {'name': 'd', 'depends_on': ['a']},
+    ]
+    results = run_jobs(Athena(), jobs, start_query)
+    assert started.index('d') > started.index('a')
+    assert 'c' not in started
+    assert results['a']['state'] == 'SUCCEEDED'
+    assert results['b']['state'] == 'FAILED'
+    assert results['c']['state'] == 'SKIPPED'
+    assert results['d'] == {'state': 'SUCCEEDED', 'execution_id': 'd', 'runtime_ms': 10, 'bytes_scanned': 100, 'reason': None}
+
+def test_run_jobs_combines_the_queries_of_a_job(monkeypatch):
+    monkeypatch.setattr(athena_orchestrator, 'min_poll_delay', 0)
+    reused = {'state': 'SUCCEEDED', 'execution_id': 'old', 'runtime_ms': None, 'bytes_scanned': None, 'reason': None}
+    results = run_jobs(Athena(), [{'name': 'a'}], lambda job: ['a1', 'a2', reused])
+    assert results['a']['state'] == 'SUCCEEDED'
+    assert results['a']['bytes_scanned'] == 200
+    assert sorted(results['a']['executions']) == ['a1', 'a2', 'old']
+
+def test_run_jobs_fails_a_job_when_on_done_raises(monkeypatch):
+    monkeypatch.setattr(athena_orchestrator, 'min_poll_delay', 0)
+
+    def on_done(job, result):
+        raise RuntimeError('watermark not saved')
+
+    results = run_jobs(Athena(), [{'name': 'a'}, {'name': 'b', 'depends_on': ['a']}], lambda job: job['name'], on_done=on_done)
+    assert results['a']['state'] == 'FAILED'
+    assert results['a']['reason'] == 'watermark not saved'
+    assert results['b']['state'] == 'SKIPPED'
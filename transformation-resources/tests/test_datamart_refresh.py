@@ -0,0 +1,81 @@
+import datamart_refresh
+from datamart_refresh import plan_refresh, commit_refresh, fingerprint, load_watermark, save_watermark
+from datalake_paths import partition_key
+from local_aws import LocalS3
+
+def upstream_of(dt):
+    return [('raw', 'google-analytics/stats/')]
+
+def add_day(s3, dt, data=b'rows'):
+    s3.store('raw', partition_key('google-analytics/stats', dt, 'stats.parquet'), data)
+
+def test_fingerprint_changes_with_the_files_of_the_date_and_before():
+    s3 = LocalS3()
+    add_day(s3, '2022-01-01')
+    before = fingerprint(s3, upstream_of('2022-01-01'), '2022-01-01')
+    add_day(s3, '2022-01-02')
+    assert fingerprint(s3, upstream_of('2022-01-01'), '2022-01-01') == before
+    add_day(s3, '2022-01-01', b'late rows')
+    assert fingerprint(s3, upstream_of('2022-01-01'), '2022-01-01') != before
+
+def test_fingerprint_leaves_out_the_state_files():
+    s3 = LocalS3()
+    add_day(s3, '2022-01-01')
+    before = fingerprint(s3, upstream_of('2022-01-01'), '2022-01-01')
+    s3.store('raw', 'google-analytics/stats/_checkpoints/123/2022-01-01_2022-01-31.json', b'{}')
+    s3.store('raw', 'google-analytics/stats/year=2022/month=01/day=01/_jobs/state.json', b'{}')
+    assert fingerprint(s3, upstream_of('2022-01-01'), '2022-01-01') == before
+
+    # monthly files have no day partition and are kept
+    s3.store('raw', 'google-analytics/stats/year=2022/month=01/stats_2022-01.parquet', b'rows')
+    assert fingerprint(s3, upstream_of('2022-01-01'), '2022-01-01') != before
+
+def test_first_run_plans_from_start_date():
+    s3 = LocalS3()
+    state = {'watermark': None, 'fingerprints': {}}
+    assert list(plan_refresh(s3, state, upstream_of, '2022-01-03')) == ['2022-01-03']
+    assert list(plan_refresh(s3, state, upstream_of, '2022-01-03', '2022-01-01')) == ['2022-01-01', '2022-01-02', '2022-01-03']
+
+def test_new_dates_are_limited_per_run(monkeypatch):
+    monkeypatch.setattr(datamart_refresh, 'max_new_dates', 2)
+    s3 = LocalS3()
+    state = {'watermark': '2022-01-01', 'fingerprints': {}}
+    assert list(plan_refresh(s3, state, upstream_of, '2022-01-10')) == ['2022-01-02', '2022-01-03']
+
+def test_recent_dates_are_recomputed_when_their_upstream_changed():
+    s3 = LocalS3()
+    for dt in ('2022-01-01', '2022-01-02', '2022-01-03'):
+        add_day(s3, dt)
+    state = {'watermark': None, 'fingerprints': {}}
+    planned = plan_refresh(s3, state, upstream_of, '2022-01-03', '2022-01-01')
+    state = commit_refresh(state, planned, set(planned))
+    assert state['watermark'] == '2022-01-03'
+
+    # nothing changed and no new date
+    assert plan_refresh(s3, state, upstream_of, '2022-01-03') == {}
+
+    # a late file of 2022-01-02 changes the fingerprints of 2022-01-02 and 2022-01-03
+    add_day(s3, '2022-01-02', b'late rows')
+    add_day(s3, '2022-01-04')
+    assert sorted(plan_refresh(s3, state, upstream_of, '2022-01-04')) == ['2022-01-02', '2022-01-03', '2022-01-04']
+
+def test_commit_refresh_stops_the_watermark_at_the_first_failure():
+    state = {'watermark': '2022-01-01', 'fingerprints': {'2022-01-01': 'a'}}
+    planned = {'2022-01-01': 'b', '2022-01-02': 'c', '2022-01-03': 'd', '2022-01-04': 'e'}
+    state = commit_refresh(state, planned, {'2022-01-01', '2022-01-02', '2022-01-04'})
+    assert state['watermark'] == '2022-01-02'
+    assert state['fingerprints'] == {'2022-01-01': 'b', '2022-01-02': 'c'}
+
+def test_commit_refresh_forgets_old_fingerprints():
+    state = {'watermark': '2022-01-01', 'fingerprints': {'2022-01-01': 'a'}}
+    planned = {'2022-01-%02d' % day: 'f' for day in range(2, 12)}
+    state = commit_refresh(state, planned, set(planned))
+    assert state['watermark'] == '2022-01-11'
+    assert sorted(state['fingerprints']) == ['2022-01-%02d' % day for day in range(5, 12)]
+
+def test_watermark_round_trip():
+    s3 = LocalS3()
+    assert load_watermark(s3, 'std', 'bu_stats/daily') == {'watermark': None, 'fingerprints': {}}
+    save_watermark(s3, 'std', 'bu_stats/daily', {'watermark': '2022-01-01', 'fingerprints': {'2022-01-01': 'a'}})
+    assert load_watermark(s3, 'std', 'bu_stats/daily')['watermark'] == '2022-01-01'
+    assert ('std', 'dashboard/_watermarks/bu_stats.daily.json') in s3.objects
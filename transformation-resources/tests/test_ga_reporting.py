@@ -0,0 +1,31 @@
+from ga_reporting import split_request, with_hours, all_hours
+
+request = {'viewId': '123', 'dateRanges': [{'startDate': '2022-01-01', 'endDate': '2022-01-01'}]}
+
+def test_split_request_by_segment_first():
+    segmented = dict(request, segments=[{'segmentId': 'gaid::1'}, {'segmentId': 'gaid::2'}])
+    parts = split_request(segmented, ('00', '01'))
+    assert parts == [
+        (dict(request, segments=[{'segmentId': 'gaid::1'}]), ('00', '01')),
+        (dict(request, segments=[{'segmentId': 'gaid::2'}]), ('00', '01')),
+    ]
+
+def test_split_request_in_halves_of_the_hours():
+    parts = split_request(request)
+    assert parts == [(request, all_hours[:12]), (request, all_hours[12:])]
+    assert split_request(request, ('00', '01', '02')) == [(request, ('00',)), (request, ('01', '02'))]
+
+def test_split_request_down_to_a_single_hour():
+    hours = all_hours
+    while len(hours) > 1:
+        (_, hours), _ = split_request(request, hours)
+    assert hours == ('00',)
+    assert split_request(request, hours) == []
+    assert split_request(dict(request, segments=[{'segmentId': 'gaid::1'}]), ('05',)) == []
+
+def test_with_hours_adds_a_filter_clause():
+    assert with_hours(request, None) is request
+    filtered = with_hours(request, ('00', '01'))
+    assert filtered['dimensionFilterClauses'] == [
+        {'filters': [{'dimensionName': 'ga:hour', 'operator': 'IN_LIST', 'expressions': ['00', '01']}]}]
+    assert 'dimensionFilterClauses' not in request
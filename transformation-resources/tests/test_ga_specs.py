@@ -0,0 +1,56 @@
+import json
+import pytest
+import pyarrow as pa
+from ga_specs import expand, compile_report, report_requests, report_columns, output_schema, SpecError
+
+def write_specs(tmp_path, reports, fragments=None):
+    path = tmp_path / 'specs.json'
+    path.write_text(json.dumps({'fragments': fragments or {}, 'reports': reports}))
+    return str(path)
+
+def test_expand_merges_the_keys_next_to_a_ref():
+    fragments = {'a': {'x': 1, 'y': [{'$ref': 'b'}]}, 'b': 2}
+    assert expand({'$ref': 'a', 'z': 3}, fragments) == {'x': 1, 'y': [2], 'z': 3}
+    with pytest.raises(SpecError):
+        expand({'$ref': 'c'}, fragments)
+    with pytest.raises(SpecError):
+        expand({'$ref': 'b', 'z': 3}, fragments)
+
+def test_stats_report_compiles_to_one_template_with_segments():
+    (constants, template), = compile_report('stats')
+    assert constants == {}
+    assert [d['name'] for d in template['dimensions']] == ['ga:segment', 'ga:dateHour', 'ga:sourceMedium']
+    assert template['metrics'][1] == {'expression': 'ga:sessionDuration', 'formattingType': 'TIME'}
+    assert [s['dynamicSegment']['name'] for s in template['segments']] == ['Mobile segment - no HQ', 'Desktop segment - no HQ']
+    hq = template['segments'][0]['dynamicSegment']['sessionSegment']['segmentFilters'][1]
+    assert hq['not'] is True
+    assert len(hq['simpleSegment']['orFiltersForSegment']) == 2
+
+def test_forms_report_has_one_request_per_filter():
+    requests = report_requests('forms', '123', '2022-01-01')
+    assert len(requests) == 4
+    for constants, request in requests:
+        assert request['filtersExpression'] == constants['filter']
+        assert request['viewId'] == '123'
+        assert request['dateRanges'] == [{'startDate': '2022-01-01', 'endDate': '2022-01-01'}]
+    assert 'viewId' not in compile_report('forms')[0][1]
+
+def test_output_schema_of_the_forms_report():
+    assert report_columns('forms') == {'ga:dateHour': 'date_hour', 'ga:uniqueEvents': 'uniqueEvents', 'ga:totalEvents': 'totalEvents'}
+    assert output_schema('forms').names == ['filter', 'sampling', 'date_hour', 'uniqueEvents', 'totalEvents']
+    assert output_schema('forms').field('sampling').type == pa.float64()
+
+@pytest.mark.parametrize('report, message', [
+    ({'metrics': [{'expression': 'sessions'}]}, 'Invalid dimension or metric name'),
+    ({'metrics': [{'expression': 'ga:sessions', 'type': 'TEXT'}]}, 'Invalid metric type'),
+    ({'metrics': [{'expression': 'ga:sessions', 'column': 'a'}, {'expression': 'ga:bounces', 'column': 'a'}]}, 'Duplicate output columns'),
+    ({'metrics': [{'expression': 'ga:sessions'}], 'segments': [{'name': 's', 'session': []}]}, 'no ga:segment dimension'),
+])
+def test_invalid_reports(tmp_path, report, message):
+    path = write_specs(tmp_path, {'report': report})
+    with pytest.raises(SpecError, match=message):
+        compile_report('report', path)
+
+def test_unknown_report():
+    with pytest.raises(SpecError):
+        compile_report('unknown')
@@ -0,0 +1,77 @@
+import io
+from datetime import datetime, timezone
+import pyarrow as pa
+import pyarrow.parquet as pq
+import leads_snapshot
+from leads_snapshot import merge_export, bucket_key, changes_key, nb_buckets
+from arrow_schemas import leads_schema
+from local_aws import LocalS3
+
+def utc(day):
+    return datetime(2022, 1, day, tzinfo=timezone.utc)
+
+def leads(rows):
+    # rows : (id, leadStatus, updatedAt day)
+    return pa.table({
+        'id': [r[0] for r in rows],
+        'BU__c': ['BU1'] * len(rows),
+        'webformRequestMostrecent': [None] * len(rows),
+        'leadStatus': [r[1] for r in rows],
+        'SFDCType': ['Lead'] * len(rows),
+        'createdAt': [utc(1)] * len(rows),
+        'updatedAt': [utc(r[2]) for r in rows],
+    })
+
+def put_export(s3, key, rows):
+    buffer = io.BytesIO()
+    pq.write_table(leads(rows), buffer)
+    s3.store('raw', key, buffer.getvalue())
+
+def read(s3, key):
+    return pq.read_table(io.BytesIO(s3.objects[('std', key)][0]))
+
+def snapshot(s3):
+    # {id: (leadStatus, updatedAt day)} of every bucket file
+    state = {}
+    for (bucket, key), (data, _) in s3.objects.items():
+        if bucket == 'std' and key.startswith(leads_snapshot.snapshot_prefix):
+            for row in pq.read_table(io.BytesIO(data)).to_pylist():
+                state[row['id']] = (row['leadStatus'], row['updatedAt'].day)
+    return state
+
+def merge(s3, key, day):
+    dt = '2022-01-%02d' % day
+    return merge_export(s3, 'raw', key, dt, dt, leads_schema, bucket='std')
+
+def test_merge_keeps_the_latest_state_of_every_lead():
+    s3 = LocalS3()
+    put_export(s3, 'export-1.parquet', [(1, 'New', 1), (2, 'New', 1), (1, 'Open', 2), (nb_buckets + 1, 'New', 1)])
+    assert merge(s3, 'export-1.parquet', 1) == {'changes': 3, 'buckets': 2}
+    assert snapshot(s3) == {1: ('Open', 2), 2: ('New', 1), nb_buckets + 1: ('New', 1)}
+    assert read(s3, bucket_key(1))['id'].to_pylist() == [1, nb_buckets + 1]
+
+    # lead 2 is updated, the older state of lead 1 is ignored and lead 3 is new
+    put_export(s3, 'export-2.parquet', [(2, 'Open', 3), (1, 'New', 1), (3, 'New', 3)])
+    assert merge(s3, 'export-2.parquet', 3) == {'changes': 2, 'buckets': 2}
+    assert snapshot(s3) == {1: ('Open', 2), 2: ('Open', 3), 3: ('New', 3), nb_buckets + 1: ('New', 1)}
+
+    changes = read(s3, changes_key('2022-01-03', '2022-01-03')).sort_by('id').to_pylist()
+    assert [(c['id'], c['leadStatus'], c['previous_leadStatus']) for c in changes] == [(2, 'Open', 'New'), (3, 'New', None)]
+
+def test_rerun_applies_the_saved_changes():
+    s3 = LocalS3()
+    put_export(s3, 'export-1.parquet', [(1, 'New', 1)])
+    merge(s3, 'export-1.parquet', 1)
+    put_export(s3, 'export-2.parquet', [(1, 'Open', 2)])
+    merge(s3, 'export-2.parquet', 2)
+
+    # a rerun of the second merge finds its change log and does not compare with the rewritten buckets
+    assert merge(s3, 'export-2.parquet', 2) == {'changes': 1, 'buckets': 1}
+    assert snapshot(s3) == {1: ('Open', 2)}
+
+def test_merge_of_an_empty_export():
+    s3 = LocalS3()
+    put_export(s3, 'export-1.parquet', [])
+    assert merge(s3, 'export-1.parquet', 1) == {'changes': 0, 'buckets': 0}
+    assert read(s3, changes_key('2022-01-01', '2022-01-01')).num_rows == 0
+    assert snapshot(s3) == {}
@@ -0,0 +1,28 @@
+from marketo_activity import time_slices, last_second_before
+
+def test_time_slices_cover_the_range_without_overlap():
+    slices = time_slices('2022-01-01', '2022-01-02')
+    assert slices == [
+        ('2022-01-01T00:00:00Z', '2022-01-01T06:00:00Z'),
+        ('2022-01-01T06:00:00Z', '2022-01-01T12:00:00Z'),
+        ('2022-01-01T12:00:00Z', '2022-01-01T18:00:00Z'),
+        ('2022-01-01T18:00:00Z', '2022-01-02T00:00:00Z'),
+    ]
+    for (_, until), (since, _) in zip(slices, slices[1:]):
+        assert until == since
+
+def test_time_slices_do_not_span_midnight():
+    slices = time_slices('2022-01-01', '2022-01-03', hours=10)
+    assert [until for _, until in slices] == [
+        '2022-01-01T10:00:00Z', '2022-01-01T20:00:00Z', '2022-01-02T00:00:00Z',
+        '2022-01-02T10:00:00Z', '2022-01-02T20:00:00Z', '2022-01-03T00:00:00Z',
+    ]
+    assert all(since[:10] == until[:10] or until[11:] == '00:00:00Z' for since, until in slices)
+
+def test_time_slices_of_an_empty_range():
+    assert time_slices('2022-01-02', '2022-01-02') == []
+    assert time_slices('2022-01-03', '2022-01-02') == []
+
+def test_last_second_before():
+    assert last_second_before('2022-01-02T00:00:00Z') == '2022-01-01T23:59:59Z'
+    assert last_second_before('2022-01-01T06:00:00Z') == '2022-01-01T05:59:59Z'
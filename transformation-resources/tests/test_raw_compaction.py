@@ -0,0 +1,134 @@
+import io
+import json
+from datetime import date, datetime, timedelta
+import pytest
+import pyarrow as pa
+import pyarrow.parquet as pq
+import raw_compaction
+from raw_compaction import compact_source, is_closed, monthly_key, view_query, prepare_day, sources
+from arrow_schemas import schema
+from datalake_paths import partition_key
+from local_aws import LocalS3, LocalGlue, LocalAthena
+
+source = sources['google-analytics-stats']
+stats_schema = schema('google-analytics-stats')
+state_key = 'google-analytics/stats-monthly/_compaction/state.json'
+monthly_file = 'google-analytics/stats-monthly/view_id=1/year=2022/month=01/stats_2022-01.parquet'
+
+def daily_table(dt, sessions, hours=3):
+    day = datetime.strptime(dt, '%Y-%m-%d')
+    return pa.Table.from_pylist([
+        {'sampling': 100.0, 'segment': 'All Users', 'date_hour': day + timedelta(hours=hour), 'source_medium': 'google / cpc',
+         'sessions': sessions, 'total_session_duration': 60.0, 'bounces': 0, 'purchase': 0, 'engaged_users': 1,
+         'registrations': 0, 'checkout': 0}
+        for hour in reversed(range(hours))], schema=stats_schema)
+
+def daily_key(dt):
+    return partition_key('google-analytics/stats', dt, f'stats_{dt}.parquet', view_id='1')
+
+def put_daily(s3, dt, sessions=1):
+    buffer = io.BytesIO()
+    pq.write_table(daily_table(dt, sessions), buffer)
+    s3.store('raw', daily_key(dt), buffer.getvalue())
+
+def read(s3, key):
+    return pq.read_table(io.BytesIO(s3.objects[('std', key)][0]))
+
+def services():
+    s3 = LocalS3()
+    glue = LocalGlue()
+    glue.create_table(DatabaseName='datalake', TableInput={
+        'Name': 'google-analytics-stats',
+        'StorageDescriptor': {'Columns': [{'Name': name} for name in stats_schema.names]}})
+    return s3, glue, LocalAthena(s3)
+
+def compact(s3, glue, athena):
+    return compact_source(s3, glue, athena, 'raw', 'std', 'datalake', 's3://results/compaction/', 'google-analytics-stats')
+
+def test_months_close_after_the_grace_days():
+    assert not is_closed('2022-01', today=date(2022, 2, 3))
+    assert is_closed('2022-01', today=date(2022, 2, 4))
+    assert not is_closed('2022-12', today=date(2023, 1, 3))
+    assert is_closed('2022-12', today=date(2023, 1, 4))
+
+def test_monthly_keys():
+    assert monthly_key(source, '2022-01', {'view_id': '1'}) == monthly_file
+    assert monthly_key(sources['marketo-activity'], '2022-01', {}) == 'marketo/activity-monthly/year=2022/month=01/activity_2022-01.parquet'
+
+def test_view_query_reads_the_monthly_table_up_to_the_boundary():
+    query = view_query('google-analytics-stats', source, ['sessions'], '2022-01')
+    assert query.startswith('CREATE OR REPLACE VIEW google_analytics_stats AS')
+    assert 'FROM "google-analytics-stats-monthly"\nWHERE year < 2022 OR (year = 2022 AND month <= 1)' in query
+    assert 'FROM "google-analytics-stats"\nWHERE year > 2022 OR (year = 2022 AND month > 1)' in query
+    assert '"sessions", "view_id", "year", "month", "day"' in query
+    # before the first compaction, every row comes from the daily table
+    assert 'WHERE year < 0 OR (year = 0 AND month <= 0)' in view_query('google-analytics-stats', source, ['sessions'], None)
+
+def test_days_are_sorted_on_the_dictionary_values():
+    table = pa.table({
+        'date_hour': [datetime(2022, 1, 1)] * 3,
+        'segment': pa.array(['c', 'a', 'b']).dictionary_encode(),
+        'source_medium': ['x', 'x', 'x'],
+    })
+    table = prepare_day(table, 1, source['sort_by'])
+    assert table['segment'].to_pylist() == ['a', 'b', 'c']
+    assert table['day'].type == pa.int32()
+
+def test_closed_months_are_compacted():
+    s3, glue, athena = services()
+    for dt in ['2022-01-02', '2022-01-01', '2022-01-31', '2022-02-01']:
+        put_daily(s3, dt)
+
+    assert compact(s3, glue, athena) == {'boundary': '2022-02', 'compacted': ['2022-01', '2022-02'], 'merged': []}
+    table = read(s3, monthly_file)
+    assert table['day'].to_pylist() == [1] * 3 + [2] * 3 + [31] * 3
+    assert table['date_hour'].to_pylist()[:3] == [datetime(2022, 1, 1, hour) for hour in range(3)]
+    assert not [key for bucket, key in s3.objects if bucket == 'raw']
+    assert json.loads(s3.objects[('std', state_key)][0]) == {'boundary': '2022-02'}
+    queries = [e['query'] for e in athena.executions.values()]
+    assert 'month <= 0' in queries[0]
+    assert 'month <= 2' in queries[-1]
+
+    # nothing is left to compact
+    assert compact(s3, glue, athena) == {'boundary': '2022-02', 'compacted': [], 'merged': []}
+    assert read(s3, monthly_file) == table
+
+def test_current_month_is_not_compacted():
+    s3, glue, athena = services()
+    today = date.today().isoformat()
+    put_daily(s3, '2022-01-01')
+    put_daily(s3, today)
+
+    assert compact(s3, glue, athena) == {'boundary': '2022-01', 'compacted': ['2022-01'], 'merged': []}
+    assert ('raw', daily_key(today)) in s3.objects
+
+def test_late_files_replace_their_day(monkeypatch):
+    # one row group per day of the monthly file
+    monkeypatch.setattr(raw_compaction, 'row_group_rows', 3)
+    s3, glue, athena = services()
+    for dt in ['2022-01-01', '2022-01-02', '2022-01-03']:
+        put_daily(s3, dt)
+    compact(s3, glue, athena)
+    assert pq.ParquetFile(io.BytesIO(s3.objects[('std', monthly_file)][0])).num_row_groups == 3
+
+    # a replay after the compaction
+    put_daily(s3, '2022-01-02', sessions=5)
+    assert compact(s3, glue, athena) == {'boundary': '2022-01', 'compacted': [], 'merged': ['2022-01']}
+    table = read(s3, monthly_file)
+    assert table['day'].to_pylist() == [1] * 3 + [2] * 3 + [3] * 3
+    assert table['sessions'].to_pylist() == [1] * 3 + [5] * 3 + [1] * 3
+    assert ('raw', daily_key('2022-01-02')) not in s3.objects
+
+class FailingDeleteS3(LocalS3):
+    def delete_objects(self, Bucket, Delete):
+        return {'Errors': [{'Key': o['Key'], 'Code': 'AccessDenied', 'Message': 'Access Denied'} for o in Delete['Objects']]}
+
+def test_daily_files_not_deleted_are_an_error():
+    _, glue, _ = services()
+    s3 = FailingDeleteS3()
+    put_daily(s3, '2022-01-01')
+
+    with pytest.raises(RuntimeError, match='1 daily files could not be deleted'):
+        compact(s3, glue, LocalAthena(s3))
+    # the month is swapped : the file left is merged by the next run
+    assert json.loads(s3.objects[('std', state_key)][0]) == {'boundary': '2022-01'}
@@ -0,0 +1,104 @@
+import json
+import pytest
+from botocore.exceptions import ClientError
+import result_cache
+from result_cache import ResultCache, cache_key, query_cost, index_key
+from local_aws import LocalS3
+
+class Athena:
+    # Queries are in the state ending their id (ex. 'q-RUNNING'), SUCCEEDED by default; ids
+    # ending with EXPIRED are no longer in the query history
+    def get_query_execution(self, QueryExecutionId):
+        if QueryExecutionId.endswith('EXPIRED'):
+            raise ClientError({'Error': {'Code': 'InvalidRequestException', 'Message': 'not found'}}, 'GetQueryExecution')
+        state = QueryExecutionId.split('-')[-1] if '-' in QueryExecutionId else 'SUCCEEDED'
+        return {'QueryExecution': {'Status': {'State': state}, 'Statistics': {'DataScannedInBytes': 100 << 20}}}
+
+def saved_index(s3):
+    return json.loads(s3.objects[('results', index_key)][0])
+
+def cache_with(s3, *execution_ids):
+    # cache with one entry and its result file per execution id, keyed by the execution id
+    cache = ResultCache(s3, Athena(), 'results')
+    for execution_id in execution_ids:
+        s3.store('results', f'dashboard/{execution_id}.csv', b'"value"\n"1"\n')
+        cache.add(execution_id, execution_id, f'dashboard/{execution_id}.csv')
+    return cache
+
+def test_cache_key_depends_on_the_query_and_the_fingerprint():
+    assert cache_key('SELECT 1', 'a') == cache_key('SELECT 1', 'a')
+    assert cache_key('SELECT 1', 'a') != cache_key('SELECT 1', 'b')
+    assert cache_key('SELECT 1', 'a') != cache_key('SELECT 2', 'a')
+
+def test_query_cost_has_a_minimum_of_10_mb():
+    assert query_cost(0) == query_cost(10 << 20) == (10 << 20) / 10**12 * 5.0
+    assert query_cost(10**12) == 5.0
+
+def test_lookup_of_a_succeeded_query():
+    s3 = LocalS3()
+    cache = cache_with(s3, 'q')
+    entry = cache.lookup('q')
+    assert entry['bytes_scanned'] == 100 << 20
+    assert cache.lookup('unknown') is None
+
+    cache.reuse('q', entry, 'dashboard/copy.csv')
+    cache.save()
+    index = saved_index(s3)
+    assert index['entries']['q']['result_key'] == 'dashboard/copy.csv'
+    assert index['hits'] == 1
+    assert index['bytes_saved'] == 100 << 20
+    assert index['dollars_saved'] == query_cost(100 << 20)
+
+@pytest.mark.parametrize('execution_id, kept', [
+    ('q-RUNNING', True),
+    ('q-FAILED', False),
+    ('q-CANCELLED', False),
+    ('q-EXPIRED', False),
+])
+def test_lookup_of_a_query_not_succeeded(execution_id, kept):
+    cache = cache_with(LocalS3(), execution_id)
+    assert cache.lookup(execution_id) is None
+    assert (execution_id in cache.index['entries']) == kept
+
+def test_lookup_drops_the_entries_of_deleted_results():
+    s3 = LocalS3()
+    cache = cache_with(s3, 'q')
+    s3.delete_object(Bucket='results', Key='dashboard/q.csv')
+    assert cache.lookup('q') is None
+    assert 'q' not in cache.index['entries']
+
+def test_least_recently_used_entries_are_evicted(monkeypatch):
+    monkeypatch.setattr(result_cache, 'max_entries', 2)
+    s3 = LocalS3()
+    cache = cache_with(s3, 'a', 'b', 'c')
+    cache.index['entries']['a']['last_used'] = cache.index['entries']['c']['last_used'] + 1
+    cache.save()
+    assert sorted(saved_index(s3)['entries']) == ['a', 'c']
+
+def test_concurrent_saves_keep_the_changes_of_both_invocations():
+    s3 = LocalS3()
+    cache_with(s3, 'old', 'dropped').save()
+    first = ResultCache(s3, Athena(), 'results')
+    second = ResultCache(s3, Athena(), 'results')
+
+    first.add('first', 'first', 'dashboard/first.csv')
+    first.count('hits', 1)
+    second.add('second', 'second', 'dashboard/second.csv')
+    second.drop('dropped')
+    second.count('hits', 2)
+    first.save()
+    # the index changed since second read it
+    second.save()
+
+    index = saved_index(s3)
+    assert sorted(index['entries']) == ['first', 'old', 'second']
+    assert index['hits'] == 3
+
+def test_other_save_errors_are_raised():
+    class DeniedS3(LocalS3):
+        def put_object(self, **kwargs):
+            raise ClientError({'Error': {'Code': 'AccessDenied', 'Message': 'Access Denied'}}, 'PutObject')
+
+    cache = cache_with(DeniedS3(), 'q')
+    with pytest.raises(ClientError, match='AccessDenied'):
+        cache.save()
@@ -0,0 +1,45 @@
+from s3_bulk_delete import delete_keys, delete_prefix
+from local_aws import LocalS3
+
+class S3(LocalS3):
+    # Records the number of keys of each delete_objects call; keys starting with locked/ are not deleted
+    def __init__(self):
+        super().__init__()
+        self.batches = []
+
+    def delete_objects(self, Bucket, Delete):
+        self.batches.append(len(Delete['Objects']))
+        locked = [o['Key'] for o in Delete['Objects'] if o['Key'].startswith('locked/')]
+        super().delete_objects(Bucket, {'Objects': [o for o in Delete['Objects'] if o['Key'] not in locked]})
+        return {'Errors': [{'Key': k, 'Code': 'AccessDenied', 'Message': 'Access Denied'} for k in locked]} if locked else {}
+
+def store_keys(s3, keys):
+    for key in keys:
+        s3.store('bucket', key, b'data')
+
+def test_keys_are_deleted_in_batches_of_1000():
+    s3 = S3()
+    keys = [f'files/{i:05d}' for i in range(2500)]
+    store_keys(s3, keys)
+    assert delete_keys(s3, 'bucket', keys) == {'deleted': 2500, 'errors': []}
+    assert sorted(s3.batches) == [500, 1000, 1000]
+    assert s3.objects == {}
+
+def test_keys_not_deleted_are_reported():
+    s3 = S3()
+    store_keys(s3, ['files/a', 'locked/b'])
+    summary = delete_keys(s3, 'bucket', ['files/a', 'locked/b'])
+    assert summary == {'deleted': 1, 'errors': [{'Key': 'locked/b', 'Code': 'AccessDenied', 'Message': 'Access Denied'}]}
+    assert list(s3.objects) == [('bucket', 'locked/b')]
+
+def test_no_call_without_keys():
+    s3 = S3()
+    assert delete_keys(s3, 'bucket', []) == {'deleted': 0, 'errors': []}
+    assert s3.batches == []
+
+def test_prefix_is_deleted_page_by_page_except_the_kept_keys():
+    s3 = S3()
+    store_keys(s3, [f'files/{i:05d}' for i in range(1500)] + ['other/file'])
+    assert delete_prefix(s3, 'bucket', 'files/', keep=['files/00000']) == {'deleted': 1499, 'errors': []}
+    assert sorted(s3.batches) == [500, 999]
+    assert sorted(key for _, key in s3.objects) == ['files/00000', 'other/file']
@@ -0,0 +1,124 @@
+import gc
+import io
+import pytest
+import pyarrow as pa
+import pyarrow.parquet as pq
+from s3_parquet_sink import S3ParquetSink, column_paths
+from local_aws import LocalS3
+
+schema = pa.schema([pa.field('id', pa.int64()), pa.field('name', pa.string())])
+
+class S3(LocalS3):
+    # Records the names of the calls
+    def __init__(self):
+        super().__init__()
+        self.calls = []
+
+    def put_object(self, **kwargs):
+        self.calls.append('put_object')
+        return super().put_object(**kwargs)
+
+    def create_multipart_upload(self, **kwargs):
+        self.calls.append('create_multipart_upload')
+        return super().create_multipart_upload(**kwargs)
+
+    def upload_part(self, **kwargs):
+        self.calls.append('upload_part')
+        return super().upload_part(**kwargs)
+
+    def complete_multipart_upload(self, **kwargs):
+        self.calls.append('complete_multipart_upload')
+        return super().complete_multipart_upload(**kwargs)
+
+    def abort_multipart_upload(self, **kwargs):
+        self.calls.append('abort_multipart_upload')
+        return super().abort_multipart_upload(**kwargs)
+
+def page(start, nb_rows):
+    ids = list(range(start, start + nb_rows))
+    return pa.table({'id': ids, 'name': [f'name {i:08d}' for i in ids]})
+
+def read(s3, key):
+    return pq.ParquetFile(io.BytesIO(s3.objects[('bucket', key)][0]))
+
+def test_small_file_is_sent_with_one_put():
+    s3 = S3()
+    sink = S3ParquetSink(s3, 'bucket', 'small.parquet', schema)
+    sink.write(page(0, 10))
+    sink.write(page(10, 5).to_batches()[0])
+    stats = sink.close(metadata={'source': 'test'})
+    assert s3.calls == ['put_object']
+    assert stats['rows'] == 15
+    f = read(s3, 'small.parquet')
+    assert f.num_row_groups == 2
+    assert f.read()['id'].to_pylist() == list(range(15))
+    assert f.metadata.metadata[b'source'] == b'test'
+
+def test_large_file_is_streamed_in_parts():
+    s3 = S3()
+    sink = S3ParquetSink(s3, 'bucket', 'large.parquet', schema, part_size=64 << 10)
+    for start in range(0, 50000, 5000):
+        sink.write(page(start, 5000))
+    sink.close()
+    assert s3.calls[0] == 'create_multipart_upload'
+    assert s3.calls.count('upload_part') > 2
+    assert s3.calls[-1] == 'complete_multipart_upload'
+    assert s3.uploads == {}
+    assert read(s3, 'large.parquet').read()['id'].to_pylist() == list(range(50000))
+
+def test_pages_are_grouped_in_row_groups():
+    s3 = S3()
+    sink = S3ParquetSink(s3, 'bucket', 'grouped.parquet', schema, row_group_rows=25)
+    for start in range(0, 60, 10):
+        sink.write(page(start, 10))
+    sink.close()
+    f = read(s3, 'grouped.parquet')
+    assert [f.metadata.row_group(i).num_rows for i in range(f.num_row_groups)] == [30, 30]
+
+def test_nothing_is_written_without_pages():
+    s3 = S3()
+    assert S3ParquetSink(s3, 'bucket', 'empty.parquet', schema).close() is None
+    assert s3.calls == []
+
+def test_pages_are_conformed_to_the_schema():
+    s3 = S3()
+    sink = S3ParquetSink(s3, 'bucket', 'conformed.parquet', schema)
+    sink.write(pa.table({'name': ['a'], 'id': pa.array([1], pa.int32()), 'other': [True]}))
+    sink.close()
+    assert read(s3, 'conformed.parquet').schema_arrow == schema
+    with pytest.raises(ValueError, match='Column name is missing'):
+        S3ParquetSink(s3, 'bucket', 'invalid.parquet', schema).write(pa.table({'id': [1]}))
+
+def test_abort_removes_the_parts_of_a_file_not_closed():
+    s3 = S3()
+    sink = S3ParquetSink(s3, 'bucket', 'failed.parquet', schema, part_size=64 << 10)
+    for start in range(0, 20000, 5000):
+        sink.write(page(start, 5000))
+    assert s3.uploads
+    sink.abort()
+    assert s3.calls[-1] == 'abort_multipart_upload'
+    assert s3.uploads == {}
+
+    # the footer written when the parquet writer is garbage collected does not start a new upload
+    del sink
+    gc.collect()
+    assert s3.calls.count('create_multipart_upload') == 1
+    assert s3.uploads == {}
+    assert ('bucket', 'failed.parquet') not in s3.objects
+
+def test_abort_after_close_keeps_the_file():
+    s3 = S3()
+    sink = S3ParquetSink(s3, 'bucket', 'done.parquet', schema, part_size=64 << 10)
+    for start in range(0, 20000, 5000):
+        sink.write(page(start, 5000))
+    sink.close()
+    sink.abort()
+    assert 'abort_multipart_upload' not in s3.calls
+    assert read(s3, 'done.parquet').metadata.num_rows == 20000
+
+def test_column_paths_of_nested_columns():
+    nested = pa.schema([
+        pa.field('id', pa.int64()),
+        pa.field('attributes', pa.list_(pa.struct([pa.field('name', pa.string()), pa.field('value', pa.string())]))),
+    ])
+    assert column_paths(nested) == ['id', 'attributes.list.element.name', 'attributes.list.element.value']
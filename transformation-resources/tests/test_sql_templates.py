@@ -0,0 +1,31 @@
+import pytest
+from sql_templates import Template, TemplateError
+
+placeholders = ['QUERY_DATE', 'QUERY_DATE_END', 'DATABASE']
+
+def test_render_fills_every_placeholder():
+    template = Template("SELECT * FROM DATABASE.t WHERE dt BETWEEN 'QUERY_DATE' AND 'QUERY_DATE_END'", placeholders)
+    assert template.placeholders == {'QUERY_DATE', 'QUERY_DATE_END', 'DATABASE'}
+    sql = template.render({'QUERY_DATE': '2022-01-01', 'QUERY_DATE_END': '2022-01-31', 'DATABASE': 'db'})
+    assert sql == "SELECT * FROM db.t WHERE dt BETWEEN '2022-01-01' AND '2022-01-31'"
+
+def test_placeholders_inside_longer_words_are_left():
+    template = Template("SELECT QUERY_DATE AS MY_QUERY_DATE, DATABASES FROM DATABASE.t", placeholders)
+    assert template.placeholders == {'QUERY_DATE', 'DATABASE'}
+    assert template.render({'QUERY_DATE': 'x', 'DATABASE': 'db'}) == "SELECT x AS MY_QUERY_DATE, DATABASES FROM db.t"
+
+def test_values_are_not_replaced_again():
+    template = Template("QUERY_DATE DATABASE", placeholders)
+    assert template.render({'QUERY_DATE': 'DATABASE', 'DATABASE': 'QUERY_DATE'}) == "DATABASE QUERY_DATE"
+
+def test_render_checks_the_values():
+    template = Template("SELECT QUERY_DATE", placeholders)
+    with pytest.raises(TemplateError, match='Unknown placeholders'):
+        template.render({'QUERY_DATE': 'x', 'OTHER': 'y'})
+    with pytest.raises(TemplateError, match='without a value'):
+        template.render({'DATABASE': 'db'})
+    # placeholders of the vocabulary absent from the text can be given
+    assert template.render({'QUERY_DATE': 'x', 'DATABASE': 'db'}) == "SELECT x"
+
+def test_template_without_placeholders():
+    assert Template("SELECT 1", []).render({}) == "SELECT 1"
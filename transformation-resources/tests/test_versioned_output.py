@@ -0,0 +1,62 @@
+import re
+from versioned_output import new_version, version_prefix, table_name, result_columns, switch_table, delete_result_metadata, delete_old_versions
+from local_aws import LocalS3, LocalGlue
+
+class Athena:
+    def __init__(self, columns):
+        self.columns = columns
+
+    def get_query_results(self, QueryExecutionId, MaxResults=None):
+        return {'ResultSet': {'ResultSetMetadata': {'ColumnInfo': self.columns}, 'Rows': []}}
+
+def test_version_names():
+    assert re.fullmatch(r'v\d{14}', new_version())
+    assert version_prefix('ga/daily_sessions', 'v20220101000000') == 'dashboard/_versions/ga/daily_sessions/v20220101000000/'
+    assert table_name('ga/daily_sessions') == 'dashboard_ga_daily_sessions'
+
+def test_result_columns():
+    athena = Athena([
+        {'Name': 'view_id', 'Type': 'varchar'},
+        {'Name': 'sessions', 'Type': 'bigint'},
+        {'Name': 'rate', 'Type': 'decimal', 'Precision': 10, 'Scale': 2},
+        {'Name': 'date_hour', 'Type': 'timestamp'},
+        {'Name': 'day', 'Type': 'date'},
+    ])
+    assert result_columns(athena, 'q') == [
+        {'Name': 'view_id', 'Type': 'string'},
+        {'Name': 'sessions', 'Type': 'bigint'},
+        {'Name': 'rate', 'Type': 'decimal(10,2)'},
+        {'Name': 'date_hour', 'Type': 'string'},
+        {'Name': 'day', 'Type': 'date'},
+    ]
+
+def test_switch_table_creates_then_moves_the_table():
+    glue = LocalGlue()
+    columns = [{'Name': 'sessions', 'Type': 'bigint'}]
+    switch_table(glue, 'datalake', 'dashboard_ga', 's3://output/v1/', columns)
+    switch_table(glue, 'datalake', 'dashboard_ga', 's3://output/v2/', columns)
+    table = glue.get_table(DatabaseName='datalake', Name='dashboard_ga')['Table']
+    assert table['StorageDescriptor']['Location'] == 's3://output/v2/'
+    assert table['StorageDescriptor']['Columns'] == columns
+
+def test_result_metadata_is_deleted():
+    s3 = LocalS3()
+    prefix = version_prefix('ga', 'v1')
+    s3.store('output', f'{prefix}q.csv', b'"value"\n')
+    s3.store('output', f'{prefix}q.csv.metadata', b'\x00')
+    delete_result_metadata(s3, 'output', prefix, 'q')
+    assert list(s3.objects) == [('output', f'{prefix}q.csv')]
+
+def test_versions_before_the_previous_one_are_deleted():
+    s3 = LocalS3()
+    versions = ['v20220101000000', 'v20220102000000', 'v20220103000000', 'v20220104000000']
+    for version in versions:
+        s3.store('output', version_prefix('ga', version) + 'q.csv', b'"value"\n')
+    s3.store('output', version_prefix('other', versions[0]) + 'q.csv', b'"value"\n')
+
+    assert delete_old_versions(s3, 'output', 'ga', versions[3]) == versions[:2]
+    assert sorted(s3.objects) == sorted([
+        ('output', version_prefix('ga', versions[2]) + 'q.csv'),
+        ('output', version_prefix('ga', versions[3]) + 'q.csv'),
+        ('output', version_prefix('other', versions[0]) + 'q.csv'),
+    ])